@@ -0,0 +1,145 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+callback_listener.py: Receives the job completion notifications that the
+batch scripts send when they end, so the workflow does not have to wait for
+the next poll to know it.
+"""
+import configparser
+import hmac
+import json
+import os
+import secrets
+import threading
+from socketserver import ThreadingMixIn
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class CallbackListener(object):
+    """
+    HTTP listener of job completion notifications
+
+    Jobs POST to <url>/jobs/<job name> a JSON document with the job name,
+    the listener token, the exit code of the script and some audit data (see
+    InfrastructureInterface._build_callback_epilogue).
+    """
+    # Period of the state queries of the jobs that will notify their end,
+    # to reconcile the notifications lost or never sent (e.g. killed jobs)
+    RECONCILIATION_PERIOD = 300
+    MAX_BODY_SIZE = 64 * 1024
+
+    def __init__(self, url, port=0, address='0.0.0.0'):
+        """
+        @type url: string
+        @param url: base URL of the listener as seen from the HPC compute
+            nodes, {port} is replaced by the port listened
+        @type port: int
+        @param port: port to listen on, 0 for any free one
+        """
+        self.token = secrets.token_hex(16)
+        self._notifications = {}
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+        self._server = _ThreadingHTTPServer((address, port), self._handler())
+        self.port = self._server.server_address[1]
+        self.url = url.format(port=self.port).rstrip('/')
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def from_config(config_file=None):
+        """
+        Listener configured in the [Callbacks] section of Croupier.cfg (url,
+        port and address), None if callbacks are not enabled
+        """
+        config = configparser.RawConfigParser()
+        config.read(config_file or os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Croupier.cfg'))
+        if not config.has_option('Callbacks', 'url') or not config.get('Callbacks', 'url'):
+            return None
+        port = config.getint('Callbacks', 'port') if config.has_option('Callbacks', 'port') else 0
+        address = config.get('Callbacks', 'address') if config.has_option('Callbacks', 'address') else '0.0.0.0'
+        return CallbackListener(config.get('Callbacks', 'url'), port, address)
+
+    def callback(self):
+        """ Callback settings to give to the jobs (job_options['callback']) """
+        return {'url': self.url, 'token': self.token}
+
+    def pop_notifications(self):
+        """ dict of job name -> (state, audit) received since the last call """
+        with self._lock:
+            notifications = self._notifications
+            self._notifications = {}
+        return notifications
+
+    def wait(self, timeout):
+        """ Sleeps until a notification arrives or timeout seconds pass """
+        if self._event.wait(timeout):
+            self._event.clear()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _notify(self, name, document):
+        exit_code = int(document['exit_code'])
+        audit = {'exit_status': str(exit_code)}
+        for key in ('job_id', 'start_time', 'completion_time'):
+            if document.get(key):
+                audit[key] = document[key]
+        with self._lock:
+            self._notifications[name] = ('COMPLETED' if exit_code == 0 else 'FAILED', audit)
+        self._event.set()
+
+    def _handler(self):
+        listener = self
+
+        class CallbackHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                parts = self.path.strip('/').split('/')
+                length = int(self.headers.get('Content-Length') or 0)
+                if len(parts) != 2 or parts[0] != 'jobs' or length > CallbackListener.MAX_BODY_SIZE:
+                    self.send_error(404)
+                    return
+                try:
+                    document = json.loads(self.rfile.read(length).decode('utf-8'))
+                    if not hmac.compare_digest(str(document.get('token', '')), listener.token) or \
+                            document.get('name') != parts[1]:
+                        self.send_error(403)
+                        return
+                    listener._notify(parts[1], document)
+                except (ValueError, KeyError, TypeError):
+                    self.send_error(400)
+                    return
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return CallbackHandler
@@ -1,5 +1,5 @@
 from croupier_plugin.data_management.data_management import DataTransfer
-from croupier_plugin.ssh import SshClient
+from croupier_plugin.ssh import SshConnectionPool
 from ckanapi import RemoteCKAN, ServerIncompatibleError, NotAuthorized, ValidationError
 
 
@@ -80,8 +80,8 @@ class CKANAPIDataTransfer(DataTransfer):
         if self.apikey:
             command += " -H 'Authorization: {0}'".format(self.apikey)
 
-        ssh_client = SshClient(ssh_credentials)
-        exit_code, exit_msg = ssh_client.execute_shell_command(command, workdir, wait_result=True)
+        with SshConnectionPool().connection(ssh_credentials) as ssh_client:
+            exit_code, exit_msg = ssh_client.execute_shell_command(command, workdir, wait_result=True)
         if exit_code != 0:
             self.logger.error('There was a problem publishing the results in CKAN ({0}):\n{1}'
                               .format(exit_code, exit_msg))
@@ -1,3 +1,6 @@
+from croupier_plugin import metrics
+
+
 def isDataManagementNode(node):
     return ('croupier.nodes.DataAccessInfrastructure' in node.type_hierarchy or
             'croupier.nodes.DataTransfer' in node.type_hierarchy or
@@ -39,7 +42,8 @@ def processDataTransfer(job, logger, direction):
     dt_instances = getDataTransferInstances(direction, job)
     for dt_config in dt_instances:
         dt = DataTransfer.factory(dt_config, logger)
-        dt.process()
+        with metrics.command_class('transfer'):
+            dt.process()
 
 
 class DataTransfer:
@@ -1,5 +1,5 @@
 from croupier_plugin.data_management.data_management import DataTransfer
-from croupier_plugin.ssh import SshClient
+from croupier_plugin.ssh import SshConnectionPool
 from cloudify import ctx
 from cloudify.exceptions import CommandExecutionError
 import tempfile
@@ -97,31 +97,27 @@ class HttpDataTransfer(DataTransfer):
                 wget_command += auth_header
                 curl_command += auth_header
 
-            ssh_client = SshClient(to_target_infra_credentials)
-
             # Execute data transfer command
-
-            exit_msg, exit_code = ssh_client.execute_shell_command(wget_command, workdir=workdir, wait_result=True)
-            if exit_code != 0:
-                error_msg = 'Could not download using wget, trying with curl (exit code: {0}, error:{1})\n'.format(
-                    str(exit_code), exit_msg)
-                ctx.logger.warning(error_msg)
-                exit_msg, exit_code = ssh_client.execute_shell_command(curl_command, workdir=workdir, wait_result=True)
-
+            with SshConnectionPool().connection(to_target_infra_credentials) as ssh_client:
+                exit_msg, exit_code = ssh_client.execute_shell_command(wget_command, workdir=workdir, wait_result=True)
                 if exit_code != 0:
-                    error_msg = 'Could not download using curl (exit code: {0}, error:{1})\n'.format(
+                    error_msg = 'Could not download using wget, trying with curl (exit code: {0}, error:{1})\n'.format(
                         str(exit_code), exit_msg)
-                    raise CommandExecutionError(error_msg)
+                    ctx.logger.warning(error_msg)
+                    exit_msg, exit_code = ssh_client.execute_shell_command(curl_command, workdir=workdir,
+                                                                           wait_result=True)
+
+                    if exit_code != 0:
+                        error_msg = 'Could not download using curl (exit code: {0}, error:{1})\n'.format(
+                            str(exit_code), exit_msg)
+                        raise CommandExecutionError(error_msg)
+                    else:
+                        ctx.logger.info("Data downloaded successfully with curl")
                 else:
-                    ctx.logger.info("Data downloaded successfully with curl")
-            else:
-                ctx.logger.info("Data downloaded successfully with wget")
+                    ctx.logger.info("Data downloaded successfully with wget")
         except Exception as exp:
             ctx.logger.error("There was a problem executing the data transfer: " + str(exp))
             raise
-        finally:
-            if 'ssh_client' in locals():
-                ssh_client.close_connection()
 
     def process_http_transfer_with_proxy(self):
         temporary_dir = None
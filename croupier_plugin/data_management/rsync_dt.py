@@ -1,5 +1,5 @@
 from croupier_plugin.data_management.data_management import DataTransfer
-from croupier_plugin.ssh import SshClient, SFtpClient
+from croupier_plugin.ssh import SshConnectionPool, SFtpClient
 from cloudify import ctx
 from cloudify.exceptions import CommandExecutionError
 import tempfile
@@ -192,82 +192,84 @@ class RSyncDataTransfer(DataTransfer):
             else:
                 credentials = to_target_infra_credentials
 
-            ssh_client = SshClient(credentials)
-            ftp_client = SFtpClient(credentials)
+            with SshConnectionPool().connection(credentials) as ssh_client:
+                ftp_client = SFtpClient(credentials)
 
-            if rsync_source_to_target:
-                if "user" in to_target_infra_credentials and "password" in to_target_infra_credentials:
-                    # NOTE rsync authentication with username/password requires sshpass which it is not installed
-                    # some HPC frontends
-                    target_username = to_target_infra_credentials['user']
-                    target_password = to_target_infra_credentials['password']
-                    dt_command = 'rsync -ratlz --rsh="/usr/bin/sshpass -p {password} ssh -o StrictHostKeyChecking=no ' \
-                                 '-o IdentitiesOnly=yes -l {username}" {ds_source}  {target_endpoint}:{ds_target}'\
-                        .format(
-                            username=target_username, password=target_password,
-                            target_endpoint=to_target_infra_endpoint, ds_source=from_source_data_url,
-                            ds_target=to_target_data_url
-                        )
-                elif "user" in to_target_infra_credentials and "private_key" in to_target_infra_credentials:
-                    target_username = to_target_infra_credentials['user']
-                    target_key = to_target_infra_credentials['private_key']
-                    # Save key in temporary file
-                    with tempfile.NamedTemporaryFile() as key_file:
-                        key_file.write(bytes(target_key, 'utf-8'))
-                        key_file.flush()
-                        key_filepath = key_file.name
-                        target_key_filepath = key_file.name.split('/')[-1]
-                        # Transfer key_file
-                        ftp_client.sendKeyFile(ssh_client, key_filepath, target_key_filepath)
-                        dt_command = 'rsync -ratlz -e "ssh -o IdentitiesOnly=yes -o StrictHostKeyChecking=no -i ~/{key_file}" {ds_source} ' \
-                                     '{username}@{target_endpoint}:{ds_target}'.format(
-                                        username=target_username, key_file=target_key_filepath,
-                                        target_endpoint=to_target_infra_endpoint,
-                                        ds_source=from_source_data_url, ds_target=to_target_data_url
-                                        )
-            else:
-                if "user" in from_source_infra_credentials and "password" in from_source_infra_credentials:
-                    # NOTE rsync authentication with username/password requires sshpass which it is not installed
-                    # some HPC frontends
+                if rsync_source_to_target:
+                    if "user" in to_target_infra_credentials and "password" in to_target_infra_credentials:
+                        # NOTE rsync authentication with username/password requires sshpass which it is not installed
+                        # some HPC frontends
+                        target_username = to_target_infra_credentials['user']
+                        target_password = to_target_infra_credentials['password']
+                        dt_command = 'rsync -ratlz --rsh="/usr/bin/sshpass -p {password} ssh ' \
+                                     '-o StrictHostKeyChecking=no -o IdentitiesOnly=yes -l {username}" ' \
+                                     '{ds_source}  {target_endpoint}:{ds_target}'\
+                            .format(
+                                username=target_username, password=target_password,
+                                target_endpoint=to_target_infra_endpoint, ds_source=from_source_data_url,
+                                ds_target=to_target_data_url
+                            )
+                    elif "user" in to_target_infra_credentials and "private_key" in to_target_infra_credentials:
+                        target_username = to_target_infra_credentials['user']
+                        target_key = to_target_infra_credentials['private_key']
+                        # Save key in temporary file
+                        with tempfile.NamedTemporaryFile() as key_file:
+                            key_file.write(bytes(target_key, 'utf-8'))
+                            key_file.flush()
+                            key_filepath = key_file.name
+                            target_key_filepath = key_file.name.split('/')[-1]
+                            # Transfer key_file
+                            ftp_client.sendKeyFile(ssh_client, key_filepath, target_key_filepath)
+                            dt_command = 'rsync -ratlz -e "ssh -o IdentitiesOnly=yes -o StrictHostKeyChecking=no -i ~/{key_file}" {ds_source} ' \
+                                         '{username}@{target_endpoint}:{ds_target}'.format(
+                                            username=target_username, key_file=target_key_filepath,
+                                            target_endpoint=to_target_infra_endpoint,
+                                            ds_source=from_source_data_url, ds_target=to_target_data_url
+                                            )
+                else:
+                    if "user" in from_source_infra_credentials and "password" in from_source_infra_credentials:
+                        # NOTE rsync authentication with username/password requires sshpass which it is not installed
+                        # some HPC frontends
 
-                    source_username = from_source_infra_credentials['user']
-                    source_password = from_source_infra_credentials['password']
-                    dt_command = 'rsync -ratlz --rsh="/usr/bin/sshpass -p {password} ssh -o StrictHostKeyChecking=no ' \
-                                 '-o IdentitiesOnly=yes -l {username}" {source_endpoint}:{ds_source} {ds_target}'\
-                        .format(
-                            username=source_username, password=source_password,
-                            source_endpoint=from_source_infra_endpoint, ds_source=from_source_data_url,
-                            ds_target=to_target_data_url
-                        )
-                elif "username" in from_source_infra_credentials and "private_key" in from_source_infra_credentials:
-                    source_username = from_source_infra_credentials['user']
-                    source_key = from_source_infra_credentials['private_key']
-                    # Save key in temporary file
-                    with tempfile.NamedTemporaryFile() as key_file:
-                        key_file.write(bytes(source_key, 'utf-8'))
-                        key_file.flush()
-                        key_filepath = key_file.name
-                        source_key_filepath = key_file.name.split('/')[-1]
-                        # Transfer key_file
-                        ftp_client.sendKeyFile(ssh_client, key_filepath, source_key_filepath)
-                        dt_command = 'rsync -ratlz -e "ssh -o IdentitiesOnly=yes -o StrictHostKeyChecking=no -i ~/{key_file}" ' \
-                                     '{username}@{source_endpoint}:{ds_source} {ds_target}'.format(
-                                        username=source_username, key_file=source_key_filepath,
-                                        source_endpoint=from_source_infra_endpoint,
-                                        ds_source=from_source_data_url, ds_target=to_target_data_url
-                                        )
+                        source_username = from_source_infra_credentials['user']
+                        source_password = from_source_infra_credentials['password']
+                        dt_command = 'rsync -ratlz --rsh="/usr/bin/sshpass -p {password} ssh ' \
+                                     '-o StrictHostKeyChecking=no -o IdentitiesOnly=yes -l {username}" ' \
+                                     '{source_endpoint}:{ds_source} {ds_target}'\
+                            .format(
+                                username=source_username, password=source_password,
+                                source_endpoint=from_source_infra_endpoint, ds_source=from_source_data_url,
+                                ds_target=to_target_data_url
+                            )
+                    elif "username" in from_source_infra_credentials and "private_key" in from_source_infra_credentials:
+                        source_username = from_source_infra_credentials['user']
+                        source_key = from_source_infra_credentials['private_key']
+                        # Save key in temporary file
+                        with tempfile.NamedTemporaryFile() as key_file:
+                            key_file.write(bytes(source_key, 'utf-8'))
+                            key_file.flush()
+                            key_filepath = key_file.name
+                            source_key_filepath = key_file.name.split('/')[-1]
+                            # Transfer key_file
+                            ftp_client.sendKeyFile(ssh_client, key_filepath, source_key_filepath)
+                            dt_command = 'rsync -ratlz -e "ssh -o IdentitiesOnly=yes -o StrictHostKeyChecking=no -i ~/{key_file}" ' \
+                                         '{username}@{source_endpoint}:{ds_source} {ds_target}'.format(
+                                            username=source_username, key_file=source_key_filepath,
+                                            source_endpoint=from_source_infra_endpoint,
+                                            ds_source=from_source_data_url, ds_target=to_target_data_url
+                                            )
 
-            # Execute data transfer command
-            ctx.logger.info('rsync data transfer: executing command: {}'.format(dt_command))
-            exit_msg, exit_code = ssh_client.execute_shell_command(dt_command, wait_result=True)
+                # Execute data transfer command
+                ctx.logger.info('rsync data transfer: executing command: {}'.format(dt_command))
+                exit_msg, exit_code = ssh_client.execute_shell_command(dt_command, wait_result=True)
 
-            if exit_code != 0:
-                raise CommandExecutionError(
-                    "Failed executing rsync data transfer: exit code " + str(exit_code) + " and msg: " + exit_msg)
+                if exit_code != 0:
+                    raise CommandExecutionError(
+                        "Failed executing rsync data transfer: exit code " + str(exit_code) + " and msg: " + exit_msg)
 
         except Exception as exp:
             raise CommandExecutionError(
                 "Failed trying to connect to data source infrastructure: " + str(exp))
         finally:
-            ftp_client.close_connection()
-            ssh_client.close_connection()
+            if 'ftp_client' in locals():
+                ftp_client.close_connection()
@@ -31,8 +31,13 @@ import io
 import os
 import string
 import random
+from collections import OrderedDict
 from datetime import datetime
-from croupier_plugin.ssh import SshClient
+from threading import Lock
+from croupier_plugin import metrics
+from croupier_plugin.poll_scheduler import max_time_to_seconds
+from croupier_plugin.ssh import AsyncSshClient, SshClient, SshConnectionPool, SSHException
+from croupier_plugin.utilities import shlex_quote
 
 BOOTFAIL = 0
 CANCELLED = 1
@@ -105,6 +110,39 @@ _STATES_PRECEDENCE = [
 ]
 
 
+# States of the jobs that will not change anymore
+TERMINAL_STATES = {JOBSTATESLIST[state] for state in (BOOTFAIL, CANCELLED, COMPLETED, FAILED, NODEFAIL, REVOKED,
+                                                      TIMEOUT)}
+
+
+# job ids per state query, so the command line does not grow unbounded
+JOB_IDS_CHUNK_SIZE = 200
+
+# (state, audit) of the finished jobs by (host, job id), they are not queried again
+MAX_FINISHED_JOBS = 100000
+_finished_jobs = OrderedDict()
+_finished_jobs_lock = Lock()
+
+
+def get_finished_job(host, job_id):
+    """(state, audit) of a finished job, None if it is not known to be finished"""
+    with _finished_jobs_lock:
+        return _finished_jobs.get((host, job_id))
+
+
+def set_finished_job(host, job_id, state, audit):
+    with _finished_jobs_lock:
+        _finished_jobs[(host, job_id)] = (state, audit)
+        while len(_finished_jobs) > MAX_FINISHED_JOBS:
+            _finished_jobs.popitem(last=False)
+
+
+def chunks(items, size):
+    """consecutive slices of a list of at most size items"""
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
 def state_int_to_str(value):
     """state on its int value to its string value"""
     return JOBSTATESLIST[int(value)]
@@ -116,6 +154,14 @@ def state_str_to_int(value):
     return JOBSTATESDICT[state]
 
 
+def iter_lines(output):
+    """lines of a command output, given as a string or as an iterable of
+    lines (e.g. a CommandStream)"""
+    if isinstance(output, basestring):
+        return output.splitlines()
+    return output
+
+
 def get_prevailing_state(state1, state2):
     """receives two string states and decides which one prevails"""
     _st1 = state_str_to_int(state1)
@@ -133,6 +179,8 @@ def get_prevailing_state(state1, state2):
 
 class InfrastructureInterface(object):
     infrastructure_interface = None
+    # seconds a state query may take before the connection is given up
+    STATE_QUERY_TIMEOUT = 300
 
     def __init__(self, infrastructure_interface, logger, workdir, monitor_start_time=None, timezone='UTC'):
         self.infrastructure_interface = infrastructure_interface
@@ -158,6 +206,7 @@ class InfrastructureInterface(object):
             return Shell(infrastructure_interface, logger, workdir)
         return None
 
+    @metrics.classified('submit')
     def submit_job(self,
                    ssh_client,
                    name,
@@ -194,7 +243,15 @@ class InfrastructureInterface(object):
         # self.audit_inserted = False
 
         # generate script content
-        if 'remote_script' in job_settings and job_settings['remote_script']:
+        scripts = []
+        if 'packed_jobs' in job_settings and job_settings['packed_jobs']:
+            scripts = self._build_pack_scripts(name, job_settings, ssh_client)
+            if scripts is None:
+                self.logger.error('pack scripts are None')
+                return False
+
+            settings = {"script": name + ".script"}
+        elif 'remote_script' in job_settings and job_settings['remote_script']:
             settings = job_settings
             settings["script"] = job_settings['remote_script']
         else:
@@ -209,9 +266,7 @@ class InfrastructureInterface(object):
                 self.logger.error('script_content is None')
                 return False
 
-            if not self.create_shell_script(ssh_client, name + ".script", script_content):
-                self.logger.error('_create_shell_script failed')
-                return False
+            scripts.append((name + ".script", script_content))
 
             # @TODO: use more general type names (e.g., BATCH/INLINE, etc)
             settings = {"script": name + ".script"}
@@ -224,6 +279,9 @@ class InfrastructureInterface(object):
             if 'scale_max_in_parallel' in job_settings:
                 settings['scale_max_in_parallel'] = job_settings['scale_max_in_parallel']
 
+        if 'dependencies' in job_settings:
+            settings['dependencies'] = job_settings['dependencies']
+
         # build the call to submit the job
         response = self._build_job_submission_call(name, settings, ssh_client, timezone=timezone)
 
@@ -231,26 +289,56 @@ class InfrastructureInterface(object):
             self.logger.error("Couldn't build the call to send the job: " + response['error'])
             return False
 
-        # prepare the scale env variables
-        if 'scale_env_mapping_call' in response:
-            scale_env_mapping_call = response['scale_env_mapping_call']
-            output, exit_code = ssh_client.execute_shell_command(scale_env_mapping_call, workdir=self.workdir,
-                                                                 wait_result=True)
-            if exit_code != 0:
-                self.logger.error("Scale env vars mapping '" + scale_env_mapping_call + "' failed with code " +
-                                  str(exit_code) + ":\n" + output)
-                return False
+        if 'scripts' in response:
+            scripts += response['scripts']
 
-        # submit the job
-        call = response['call']
+        # upload the scripts, then prepare the scale env variables and submit the job in a single round trip
+        if scripts and not self.upload_scripts(ssh_client, scripts):
+            return False
 
-        output, exit_code = ssh_client.execute_shell_command(call, env=environment, workdir=self.workdir,
-                                                             wait_result=True)
-        if exit_code != 0:
-            self.logger.error("Job submission '" + call + "' exited with code " + str(exit_code) + ":\n" + output)
+        calls = []
+        if 'scale_env_mapping_call' in response:
+            calls.append(response['scale_env_mapping_call'])
+        calls.append(response['call'])
+
+        results = ssh_client.execute_batch(calls, env=environment, workdir=self.workdir, stop_on_error=True)
+        for call, (output, exit_code) in zip(calls, results):
+            if exit_code == 0:
+                continue
+            if call != response['call']:
+                self.logger.error("Scale env vars mapping '" + call + "' failed with code " +
+                                  str(exit_code) + ":\n" + str(output))
+            else:
+                self.logger.error("Job submission '" + call + "' exited with code " + str(exit_code) + ":\n" +
+                                  str(output))
             return False
 
-        return self._get_jobid(output)
+        return self._get_jobid(results[-1][0])
+
+    async def submit_job_async(self,
+                               credentials,
+                               name,
+                               job_settings,
+                               is_singularity,
+                               context=None,
+                               environment=None,
+                               timezone=None):
+        """
+        asyncio variant of submit_job, that connects to the HPC itself
+
+        @type credentials: dictionary
+        @param credentials: SSH credentials to connect to the HPC
+        @rtype string
+        @return job id sent, see submit_job.
+        """
+        return await AsyncSshClient(credentials).run(
+            lambda ssh_client: self.submit_job(ssh_client,
+                                               name,
+                                               job_settings,
+                                               is_singularity,
+                                               context=context,
+                                               environment=environment,
+                                               timezone=timezone))
 
     def _get_jobid(self, output):
         """
@@ -258,6 +346,14 @@ class InfrastructureInterface(object):
         """
         return None
 
+    def get_array_task_ids(self, job_id, size):
+        """
+        Ids of the tasks of a job array, by index, to monitor every task on
+        its own. Implemented in child classes that support arrays.
+        """
+        return None
+
+    @metrics.classified('cleanup')
     def clean_job_aux_files(self, ssh_client, name, is_singularity):
         """
         Cleans no more needed job files in the HPC
@@ -302,19 +398,22 @@ class InfrastructureInterface(object):
 
         return ssh_client.execute_shell_command(call, workdir=self.workdir)
 
-    def create_new_workdir(self, ssh_client, base_dir, base_name):
+    def create_new_workdir(self, ssh_client, base_dir, base_name, candidates=5):
         workdir = self._get_time_name(base_name)
 
-        # we make sure that the workdir does not exists
-        base_name = workdir
-        while self._exists_path(ssh_client, base_dir + "/" + workdir):
-            workdir = self._get_random_name(base_name)
+        # mkdir fails if the workdir already exists, so the first candidate
+        # that can be created is the new workdir, all in one round trip
+        names = [workdir] + [self._get_random_name(workdir) for _ in range(candidates - 1)]
+        # base_dir is left unquoted so the shell expands ~ or $HOME in it
+        create_call = 'for name in {names}; do mkdir {base_dir}/"$name" 2>/dev/null && echo "$name" && exit 0; ' \
+                      'done; exit 1'.format(names=' '.join(names), base_dir=base_dir)
+        results = ssh_client.execute_batch(['mkdir -p ' + base_dir, create_call], stop_on_error=True)
 
-        full_path = base_dir + "/" + workdir
-        if ssh_client.execute_shell_command("mkdir -p " + base_dir + "/" + workdir):
-            return full_path
+        output, exit_code = results[-1]
+        if exit_code == 0:
+            return base_dir + "/" + output.strip()
         else:
-            self.logger.warning("Failed to create '" + base_dir + "/" + workdir + "' directory.")
+            self.logger.warning("Failed to create a new working directory in '" + base_dir + "'.")
             return None
 
     #   ################ ABSTRACT METHODS ################
@@ -375,16 +474,86 @@ class InfrastructureInterface(object):
             "'_get_envar' not implemented.")
 
     # Monitor
-    def get_states(self, credentials, job_names):
+    def get_states(self, credentials, job_names, job_ids=None):
         """
         Get the states of the jobs names
         @type credentials: dictionary
         @param credentials: SSH credentials to connect to the HPC
+        @type job_ids: dictionary
+        @param job_ids: ids of the jobs by name, for the interfaces that can
+            query them by id (optional)
         @rtype dict
         @return a dictionary of job names and its states
         """
         raise NotImplementedError("'get_states' not implemented.")
 
+    def get_packed_states(self, credentials, job_names, job_ids, packs):
+        """
+        Get the states of the jobs names, some of them run in a batch job
+        with others (see _build_pack_scripts). Those are queued and running
+        as their batch job is, and end with the exit code written to its
+        status file (failed if the batch job ended without writing it)
+
+        @type packs: dictionary
+        @param packs: name of the batch job of the packed jobs, by job name
+        @rtype tuple
+        @return (states, audits) by job name
+        """
+        query_names = [name for name in job_names if name not in packs]
+        query_ids = {name: job_id for name, job_id in (job_ids or {}).items() if name not in packs}
+        for name in job_names:
+            if name in packs and packs[name] not in query_names:
+                query_names.append(packs[name])
+            if name in packs and job_ids and job_ids.get(name):
+                query_ids[packs[name]] = job_ids[name]
+        states, audits = self.get_states(credentials, query_names, job_ids=query_ids)
+
+        # the jobs that ended write their exit code once the batch job runs
+        started = sorted({pack for name, pack in packs.items()
+                          if name in job_names and states.get(pack) and states[pack] != 'PENDING'})
+        exit_codes = {}
+        if started:
+            call = 'cat ' + ' '.join(shlex_quote(pack + '.status') for pack in started) + ' 2> /dev/null'
+            with SshConnectionPool().connection(credentials) as client:
+                with client.stream_shell_command(call, workdir=self.workdir,
+                                                 timeout=self.STATE_QUERY_TIMEOUT) as output:
+                    for line in output.lines():
+                        fields = line.split()
+                        if len(fields) == 2 and fields[1].isdigit():
+                            exit_codes[fields[0]] = int(fields[1])
+
+        for name in job_names:
+            if name not in packs or packs[name] not in states:
+                continue
+            pack_state = states[packs[name]]
+            if name in exit_codes:
+                states[name] = 'COMPLETED' if exit_codes[name] == 0 else 'FAILED'
+                audits[name] = dict(audits.get(packs[name], {}), exit_status=str(exit_codes[name]))
+            elif pack_state.split()[0] in TERMINAL_STATES:
+                # e.g. the batch job timed out or was cancelled before the job ended
+                states[name] = pack_state if pack_state != 'COMPLETED' else 'FAILED'
+                audits[name] = audits.get(packs[name], {})
+            else:
+                states[name] = pack_state
+        for pack in set(packs.values()):
+            if pack not in job_names:
+                states.pop(pack, None)
+                audits.pop(pack, None)
+        return states, audits
+
+    async def get_states_async(self, credentials, job_names, job_ids=None):
+        """
+        asyncio variant of get_states
+        @type credentials: dictionary
+        @param credentials: SSH credentials to connect to the HPC
+        @rtype dict
+        @return a dictionary of job names and its states
+        """
+        def get_states():
+            with metrics.command_class('state_query'):
+                return self.get_states(credentials, job_names, job_ids=job_ids)
+        return await AsyncSshClient.run_in_executor(get_states)
+
     #   ##################################################
 
     def delete_reservation(self, ssh_client, reservation_id, deletion_path):
@@ -452,6 +621,9 @@ class InfrastructureInterface(object):
 
         script += response['data']
 
+        if 'callback' in job_settings and job_settings['callback']:
+            script += self._build_callback_epilogue(name, job_settings['callback'])
+
         script += '\n# DYNAMIC VARIABLES\n\n'
 
         # Force use WORKDIR
@@ -489,6 +661,80 @@ class InfrastructureInterface(object):
 
         return script
 
+    def _build_pack_scripts(self, name, job_settings, ssh_client):
+        """
+        Creates the scripts to run several jobs in a single batch job: the
+        batch script, that runs the script of every job one after another
+        and writes their exit codes to <name>.status, and the job scripts
+
+        @type name: string
+        @param name: name of the batch job
+        @type job_settings: dictionary
+        @param job_settings: job options of the batch job, with the 'name'
+            and 'job_options' of every job in 'packed_jobs'. The jobs ask for
+            the same resources (see workflows.pack_instances), so they run
+            in turn in the allocation of one of them, whose time limit is the
+            sum of their limits
+        @rtype list
+        @return (file name, content) of the scripts. None if an error arise.
+        """
+        scripts = []
+        launches = ''
+        max_time = 0
+        for job in job_settings['packed_jobs']:
+            script = self._build_script(job['name'], job['job_options'], ssh_client)
+            if script is None:
+                return None
+            job_max_time = max_time_to_seconds(job['job_options'].get('max_time'))
+            if job_max_time is None:
+                self.logger.error("Packed job " + job['name'] + " without a valid 'max_time'")
+                return None
+            max_time += job_max_time
+            scripts.append((job['name'] + ".script", script))
+            launches += 'croupier_run ' + shlex_quote(job['name']) + '\n'
+
+        settings = dict(job_settings)
+        settings['max_time'] = '{0:02d}:{1:02d}:{2:02d}'.format(max_time // 3600, max_time // 60 % 60, max_time % 60)
+        response = self._parse_job_settings(name, settings, script=True)
+        if 'error' in response and response['error']:
+            self.logger.error(response['error'])
+            return None
+
+        status = shlex_quote(name + '.status')
+        script = '#!/bin/bash -l\n\n' + response['data'] + \
+                 '\n# DYNAMIC VARIABLES\n\n' \
+                 'cd $CURRENT_WORKDIR\n\n' \
+                 ': > ' + status + '\n' \
+                 'croupier_run() {\n' \
+                 '    bash "$1.script" > "$1.out" 2> "$1.err"\n' \
+                 '    echo "$1 $?" >> ' + status + '\n' \
+                 '}\n\n' + launches
+        return [(name + ".script", script)] + scripts
+
+    def _build_callback_epilogue(self, name, callback):
+        """
+        Script lines that notify the end of the job to a CallbackListener
+
+        @type name: string
+        @param name: name of the job
+        @type callback: dictionary
+        @param callback: url and token of the listener
+        @rtype string
+        @return string with the lines, that set an EXIT trap.
+        """
+        document = '{{\\"name\\": \\"{name}\\", \\"token\\": \\"{token}\\", ' \
+                   '\\"exit_code\\": $CROUPIER_EXIT_CODE, \\"job_id\\": \\"${{SLURM_JOB_ID:-$PBS_JOBID}}\\", ' \
+                   '\\"start_time\\": $CROUPIER_START_TIME, \\"completion_time\\": $(date +%s)}}' \
+            .format(name=name, token=callback['token'])
+        return '\n# COMPLETION CALLBACK\n' \
+               'CROUPIER_START_TIME=$(date +%s)\n' \
+               'croupier_callback() {\n' \
+               '    CROUPIER_EXIT_CODE=$?\n' \
+               '    curl -s -m 10 -o /dev/null -H "Content-Type: application/json" -d "' + document + '" ' + \
+               shlex_quote(callback['url'] + '/jobs/' + name) + ' || true\n' \
+               '}\n' \
+               'trap croupier_callback EXIT\n'
+
     def _build_job_submission_call(self, name, job_settings, ssh_client, timezone):
         """
         Generates submission command line as a string
@@ -572,7 +818,7 @@ class InfrastructureInterface(object):
                     scale_count=self._get_envar(
                         'SCALE_COUNT', job_settings['scale']),
                     scale_max=self._get_envar('SCALE_MAX', scale_max),
-                    script=job_settings['remote_script'].split()[0])  # file name only
+                    script=job_settings['script'].split()[0])  # file name only
 
             response['scale_env_mapping_call'] = scale_env_mapping_call
 
@@ -582,32 +828,25 @@ class InfrastructureInterface(object):
                             ssh_client,
                             name,
                             script_content):
-        # @TODO: why not to use ctx.download_resource and
-        #        ssh_client.open_sftp().put(...)?
-        # escape for echo command
-        # Converting script_content to str or array of str
-        try:
-            script_content = script_content.decode()
-        except (UnicodeDecodeError, AttributeError):
-            pass
-
-        script_data = script_content \
-            .replace("\\", "\\\\") \
-            .replace("$", "\\$") \
-            .replace("`", "\\`") \
-            .replace('"', '\\"')
-
-        create_call = "echo \"" + script_data + "\" >> " + name + \
-                      "; chmod +x " + name
-        _, exit_code = ssh_client.execute_shell_command(
-            create_call,
-            workdir=self.workdir,
-            wait_result=True)
+        return self.upload_scripts(ssh_client, [(name, script_content)])
+
+    def upload_scripts(self, ssh_client, scripts, permissions=0o755):
+        """
+        Writes scripts in the workdir, replacing existing ones
 
-        if exit_code != 0:
-            self.logger.error(
-                "failed to create script: call '" + create_call +
-                "', exit code " + str(exit_code))
+        @type ssh_client: SshClient
+        @param ssh_client: ssh client connected to an HPC login node
+        @type scripts: list of (string, string) tuples
+        @param scripts: name and content of every script
+        @type permissions: int
+        @param permissions: mode of the scripts
+        @rtype bool
+        @return True if every script was written.
+        """
+        try:
+            ssh_client.upload_files(scripts, workdir=self.workdir, mode=permissions)
+        except (IOError, SSHException) as err:
+            self.logger.error("failed to upload scripts " + str([name for name, _ in scripts]) + ": " + str(err))
             return False
 
         return True
@@ -658,29 +897,8 @@ class InfrastructureInterface(object):
             return False
 
     def sendScript(self, name, script, permissions, ssh_client):
-        # Create invocation with ssh to send script and set its permissions
-        # escape for echo command
-        script_data = script \
-            .replace("\\", "\\\\") \
-            .replace("$", "\\$") \
-            .replace("`", "\\`") \
-            .replace('"', '\\"')
-
-        create_call = u'echo \"{script_data}\" >> {name}; chmod {permissions} {name}'\
-            .format(script_data=script_data, name=name, permissions=permissions)
-
-        _, exit_code = ssh_client.execute_shell_command(
-            create_call,
-            workdir=self.workdir,
-            wait_result=True)
-
-        if exit_code != 0:
-            self.logger.error(
-                "failed to send script: call '" + create_call +
-                "', exit code " + str(exit_code))
-            return False
-
-        return True
+        # permissions as given to chmod, e.g. 700
+        return self.upload_scripts(ssh_client, [(name, script)], permissions=int(str(permissions), 8))
 
     def _add_audit(self, job_id, job_settings, script=False, ssh_client=None):
         """
@@ -33,11 +33,82 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import str
 from builtins import map
-from croupier_plugin.ssh import SshClient
-from .infrastructure_interface import InfrastructureInterface
+from croupier_plugin.ssh import SshConnectionPool
+from .infrastructure_interface import (
+    InfrastructureInterface,
+    JOB_IDS_CHUNK_SIZE,
+    TERMINAL_STATES,
+    chunks,
+    get_finished_job,
+    iter_lines,
+    set_finished_job)
 from croupier_plugin.utilities import shlex_quote
 import re
+import json
 import datetime, time
+from collections import OrderedDict
+from threading import Lock
+
+# qstat prints JSON (-F json) since PBS Pro 19
+JSON_MIN_VERSION = (19,)
+# whether the qstat of every host supports -F json, detected once
+_json_support = {}
+_json_support_lock = Lock()
+# start of the jobs object of `qstat -F json`, after the server attributes
+_JSON_JOBS_START = re.compile(r'"Jobs"\s*:\s*\{')
+_JSON_WHITESPACE = re.compile(r'[\s,]*')
+
+
+def _iter_output_chunks(output):
+    """ text chunks of a command output, given as a string, a CommandStream
+    or an iterable of lines """
+    if isinstance(output, str):
+        return [output]
+    if hasattr(output, 'chunks'):
+        return output.chunks()
+    return (line + '\n' for line in output)
+
+
+def _iter_qstat_json_jobs(chunks):
+    """
+    (job id, attributes) of the jobs of a `qstat -F json` output, decoded
+    one by one as the output arrives, so only the jobs of a chunk are kept
+    in memory at a time. Raises ValueError if the output is not valid JSON
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ''
+    match = None
+    for chunk in chunks:
+        buffer += chunk
+        match = _JSON_JOBS_START.search(buffer)
+        if match:
+            break
+    if not match:  # no job known, the whole (short) document was read
+        if buffer.strip():
+            json.loads(buffer)
+        return
+    # the buffer is only trimmed when a chunk is added, to not copy it per job
+    start = match.end()
+    while True:
+        position = _JSON_WHITESPACE.match(buffer, start).end()
+        if buffer[position:position + 1] == '}':  # end of the jobs
+            return
+        try:
+            job_id, position = decoder.raw_decode(buffer, position)
+            position = _JSON_WHITESPACE.match(buffer, position).end()
+            if buffer[position:position + 1] != ':':
+                raise ValueError("Expecting ':' after job id " + str(job_id))
+            position = _JSON_WHITESPACE.match(buffer, position + 1).end()
+            attributes, start = decoder.raw_decode(buffer, position)
+        except ValueError:
+            chunk = next(chunks, None)
+            if chunk is None:  # the job is not complete, and will not be
+                raise
+            buffer = buffer[start:] + chunk
+            start = 0
+            continue
+        yield job_id, attributes
 
 
 class Pbspro(InfrastructureInterface):
@@ -46,6 +117,10 @@ class Pbspro(InfrastructureInterface):
     def _get_jobid(self, output):
         return output.split(' ')[-1].strip()
 
+    def get_array_task_ids(self, job_id, size):
+        # qsub returns e.g. 123[].server, its subjobs are 123[0].server...
+        return [job_id.replace('[]', '[' + str(index) + ']', 1) for index in range(size)]
+
     def _parse_job_settings(
             self,
             job_id,
@@ -156,13 +231,18 @@ class Pbspro(InfrastructureInterface):
             if 'scale' in job_settings and \
                     int(job_settings['scale']) > 1:
                 # set the job array
-                _settings['data'] += ' -t 0-{}'.format(
+                _settings['data'] += ' -J 0-{}'.format(
                     job_settings['scale'] - 1)
                 if 'scale_max_in_parallel' in job_settings and \
                         int(job_settings['scale_max_in_parallel']) > 0:
                     _settings['data'] += '%{}'.format(
                         job_settings['scale_max_in_parallel'])
 
+            if job_settings.get('dependencies'):
+                # held until all the jobs given end successfully
+                _settings['data'] += ' -W depend=afterok:{}'.format(
+                    ':'.join(str(dependency) for dependency in job_settings['dependencies']))
+
             _settings['data'] += ' ' + job_settings['script']
             if _check_job_settings_key('arguments'):
                 args = ''
@@ -205,18 +285,21 @@ class Pbspro(InfrastructureInterface):
 
     def _get_envar(self, envar, default):
         if envar == 'SCALE_INDEX':
-            return '$PBS_ARRAYID'
+            return '$PBS_ARRAY_INDEX'
         else:
             return default
 
     # Monitor
 
-    def get_states(self, job_names):
-        return self._get_states_detailed(job_names) if job_names else {}
+    def get_states(self, credentials, job_names, job_ids=None):
+        return self._get_states_detailed(
+            credentials,
+            job_names,
+            job_ids) if job_names else ({}, {})
 
-    def _get_states_detailed(self, job_names):
+    def _get_states_detailed(self, credentials, job_names, job_ids=None):
         """
-        Get job states by job names
+        Get job states by job ids
 
         This function uses `qstat` command to query PBSPro.
         Please don't launch this call very frequently. Polling it
@@ -226,109 +309,190 @@ class Pbspro(InfrastructureInterface):
 
         It allows to a precise mapping of Torque states to
         Slurm states by taking into account `exit_code`.
-        Unlike `get_states_tabular` it parses output on host
-        and uses several SSH commands.
+        Unlike `get_states_tabular` it parses output on host.
+
+        Jobs are queried by the id `qsub` returned, all of them in a
+        single `qstat -x -f` call. Only jobs without id are looked up by
+        name with `qselect`. Finished jobs are cached and not queried again.
         """
-        # identify job ids
+        host = credentials['host']
+        job_states = {}
+        audits = {}
+        names_by_id = OrderedDict()
+        names_without_id = []
+        for name in job_names:
+            if job_ids and job_ids.get(name):
+                job_id = str(job_ids[name])
+                finished = get_finished_job(host, job_id)
+                if finished is not None:
+                    job_states[name], audits[name] = finished
+                else:
+                    names_by_id[job_id] = name
+            else:
+                names_without_id.append(name)
+
         # Read environment, required by some HPC (e.g. HLRS Hawk)
         read_environment = "source /etc/profile > /dev/null 2>&1; "
-        call = read_environment + "echo {} | xargs -n 1 qselect -x -N".format(
-            shlex_quote(' '.join(map(shlex_quote, job_names))))
+        with SshConnectionPool().connection(credentials) as client:
+            if names_without_id:
+                # identify job ids
+                call = read_environment + "echo {} | xargs -n 1 qselect -x -N".format(
+                    shlex_quote(' '.join(map(shlex_quote, names_without_id))))
+                with client.stream_shell_command(call, workdir=self.workdir,
+                                                 timeout=self.STATE_QUERY_TIMEOUT) as output:
+                    for job_id in Pbspro._parse_qselect(output):
+                        names_by_id.setdefault(str(job_id), None)
+
+            # get detailed information about jobs, parsed as it arrives
+            for ids in chunks(list(names_by_id), JOB_IDS_CHUNK_SIZE):
+                result = None
+                if self._supports_json(client, host, read_environment):
+                    result = self._query_qstat_json(client, host, read_environment + "qstat -x -f -F json {}".format(
+                        ' '.join(ids)))
+                if result is None:
+                    result = self._query_qstat_text(client, read_environment + "qstat -x -f {}".format(' '.join(ids)))
+                ids_states, ids_audits = result
+                job_states.update((name, state) for name, state in ids_states.items() if name in job_names)
+                audits.update((name, audit) for name, audit in ids_audits.items() if name in job_names)
+                for job_id in ids:
+                    name = names_by_id[job_id]
+                    key = _subjob_key(job_id)
+                    if key is not None and name is not None and key in ids_states:
+                        job_states[name] = ids_states[key]
+                        audits[name] = ids_audits.get(key, {})
+                    if name in job_states and job_states[name] in TERMINAL_STATES:
+                        set_finished_job(host, job_id, job_states[name], audits.get(name, {}))
 
-        client = SshClient(self.credentials)
-
-        output, exit_code = client.execute_shell_command(
-            call,
-            workdir=self.workdir,
-            wait_result=True)
-        job_ids = Pbspro._parse_qselect(output)
-        if not job_ids:
-            return {}
-
-        # get detailed information about jobs
-        call = read_environment + "qstat -x -f {}".format(' '.join(map(str, job_ids)))
+        return job_states, audits
 
+    def _supports_json(self, client, host, read_environment):
+        """ Whether the qstat of the host prints JSON, asked once per host """
+        with _json_support_lock:
+            if host in _json_support:
+                return _json_support[host]
         output, exit_code = client.execute_shell_command(
-            call,
+            read_environment + "qstat --version",
             workdir=self.workdir,
             wait_result=True)
-        client.close_connection()
-        try:
-            job_states, audits = Pbspro._parse_qstat_detailed(output)
-        except SyntaxError as e:
-            self.logger.warning(
-                "cannot parse state response for job ids=[{}]".format(
-                    ','.join(map(str, job_ids))))
-            self.logger.warning(
-                "{err}\n`qstat -x -f` output to parse:\n\\[\n{text}\n\\]".format(
-                    err=str(e), text=output))
-            # TODO: think whether error ignoring is better
-            #       for the correct lifecycle
-            raise e
-
-        return job_states, audits
+        version = _parse_pbs_version(output) if exit_code == 0 else ()
+        self.logger.debug("PBS Pro version of " + host + ": " + '.'.join(map(str, version)))
+        with _json_support_lock:
+            _json_support[host] = version >= JSON_MIN_VERSION
+            return _json_support[host]
+
+    def _query_qstat_json(self, client, host, call):
+        """ states and audits of a `qstat -F json` call, None if its output
+        can not be parsed (then the text output is used from now on) """
+        with client.stream_shell_command(call, workdir=self.workdir, timeout=self.STATE_QUERY_TIMEOUT) as output:
+            try:
+                result = Pbspro._parse_qstat_json(output)
+            except ValueError as e:
+                # some versions do not escape all the attribute values
+                self.logger.warning("cannot parse `qstat -F json` output, using the text one: " + str(e))
+                with _json_support_lock:
+                    _json_support[host] = False
+                return None
+        if output.exit_code != 0:
+            # e.g. some of the jobs were purged from the server
+            self.logger.debug("qstat failed for some jobs: " + output.stderr)
+        return result
+
+    def _query_qstat_text(self, client, call):
+        """ states and audits of a `qstat -x -f` call """
+        with client.stream_shell_command(call, workdir=self.workdir, timeout=self.STATE_QUERY_TIMEOUT) as output:
+            try:
+                result = Pbspro._parse_qstat_detailed(output)
+            except SyntaxError as e:
+                self.logger.warning(
+                    "cannot parse state response of `{}`".format(call))
+                self.logger.warning(
+                    "{err} in `qstat -x -f` output".format(err=str(e)))
+                # TODO: think whether error ignoring is better
+                #       for the correct lifecycle
+                raise e
+        if output.exit_code != 0:
+            # e.g. some of the jobs were purged from the server
+            self.logger.debug("qstat failed for some jobs: " + output.stderr)
+        return result
 
     @staticmethod
     def _parse_qselect(qselect_output):
         """ Parse `qselect` output and returns
         list of job ids without host names """
-        jobs = qselect_output.splitlines()
-        if not jobs or (len(jobs) == 1 and jobs[0] == ''):
-            return []
-        return [int(job.split('.')[0]) for job in jobs]
+        return [int(job.split('.')[0]) for job in iter_lines(qselect_output) if job.strip()]
 
     @staticmethod
     def _parse_qstat_detailed(qstat_output):
-        from io import StringIO
         jobs = {}
         audits = {}
-        for job in Pbspro._tokenize_qstat_detailed(StringIO(qstat_output)):
-            name = job.get("Job_Id", None)
-            state_code = job.get('job_state', None)
-            audit = {}
-            if name and state_code:
-                if state_code == 'F':
-                    # Process timestamps from this format 'Tue Sep 22 13:29:49 2020'
-                    # to this one "2020-04-15 01:26:59.000403"
-                    start_time = datetime.datetime.strptime(job.get("stime"), '%a %b %d %H:%M:%S %Y')
-                    completion_time = datetime.datetime.strptime(job.get("mtime"), '%a %b %d %H:%M:%S %Y')
-                    queued_time = datetime.datetime.strptime(job.get("qtime"), '%a %b %d %H:%M:%S %Y')
-                    audit["start_time"] = start_time.strftime("%Y-%m-%d %H:%M:%S.%f")
-                    audit["completion_time"] = completion_time.strftime("%Y-%m-%d %H:%M:%S.%f")
-                    audit["queued_time"] = queued_time.strftime("%Y-%m-%d %H:%M:%S.%f")
-                    audit["cput"] = convert_to_seconds(job.get("resources_used.cput"))
-                    audit["cpupercent"] = job.get("resources_used.cpupercent")
-                    audit["ncpus"] = job.get("resources_used.ncpus")
-                    audit["vmem"] = remove_trailing_unit(job.get("resources_used.vmem"), 'kb')
-                    audit["walltime"] = convert_to_seconds(job.get("resources_used.walltime"))
-                    audit["mem"] = remove_trailing_unit(job.get("resources_used.mem"), 'kb')
-                    audit["queued_time"] = time.mktime(queued_time.timetuple())
-                    audit["completion_time"] = time.mktime(completion_time.timetuple())
-                    audit["start_time"] = time.mktime(start_time.timetuple())
-                    audit["job_id"] = job.get("Job_Id")
-                    audit['job_name'] = job.get("Job_Name")
-                    audit["job_owner"] = job.get("Job_Owner")
-                    audit["queue"] = job.get("queue")
-                    audit["exit_status"] = job.get("Exit_status")
-                    audit["mpiprocs"] = job.get("Resource_List.mpiprocs")
-
-                    pattern = re.compile('-l ([a-zA-Z0-9=:]*)')
-                    audit["workflow_parameters"] = ','.join(pattern.findall(job.get("Submit_arguments")))
-                    exit_status = int(job.get('exit_status', 0))
-                    state = Pbspro._job_exit_status.get(
-                        exit_status, "FAILED")  # unknown failure by default
+        for job in Pbspro._tokenize_qstat_detailed(iter_lines(qstat_output)):
+            Pbspro._add_job(jobs, audits, job)
+        return jobs, audits
+
+    @staticmethod
+    def _parse_qstat_json(qstat_output):
+        """ Parse `qstat -F json` output, where the resources of the jobs are
+        nested objects, into the same states and audits as the text one """
+        jobs = {}
+        audits = {}
+        for job_id, attributes in _iter_qstat_json_jobs(_iter_output_chunks(qstat_output)):
+            job = {'Job_Id': job_id}
+            for key, value in attributes.items():
+                if isinstance(value, dict):
+                    for resource, resource_value in value.items():
+                        job[key + '.' + resource] = str(resource_value)
                 else:
-                    state = Pbspro._job_states[state_code]
-            jobs[name] = state
-            audits[name] = audit
+                    job[key] = str(value)
+            Pbspro._add_job(jobs, audits, job)
         return jobs, audits
 
+    @staticmethod
+    def _add_job(jobs, audits, job):
+        """ Adds the state and audit of a job, given as its flat qstat attributes """
+        # the subjobs of an array are named as the array, keyed by id instead
+        name = _subjob_key(job.get("Job_Id", "")) or job.get("Job_Name", None)
+        state_code = job.get('job_state', None)
+        audit = {}
+        if not name or not state_code:
+            return
+        if state_code in ('F', 'X'):  # X: subjob finished
+            # Process timestamps from this format 'Tue Sep 22 13:29:49 2020'
+            # to timestamps
+            start_time = datetime.datetime.strptime(job.get("stime"), '%a %b %d %H:%M:%S %Y')
+            completion_time = datetime.datetime.strptime(job.get("mtime"), '%a %b %d %H:%M:%S %Y')
+            queued_time = datetime.datetime.strptime(job.get("qtime"), '%a %b %d %H:%M:%S %Y')
+            audit["cput"] = convert_to_seconds(job.get("resources_used.cput"))
+            audit["cpupercent"] = job.get("resources_used.cpupercent")
+            audit["ncpus"] = job.get("resources_used.ncpus")
+            audit["vmem"] = remove_trailing_unit(job.get("resources_used.vmem"), 'kb')
+            audit["walltime"] = convert_to_seconds(job.get("resources_used.walltime"))
+            audit["mem"] = remove_trailing_unit(job.get("resources_used.mem"), 'kb')
+            audit["queued_time"] = time.mktime(queued_time.timetuple())
+            audit["completion_time"] = time.mktime(completion_time.timetuple())
+            audit["start_time"] = time.mktime(start_time.timetuple())
+            audit["job_id"] = job.get("Job_Id")
+            audit['job_name'] = job.get("Job_Name")
+            audit["job_owner"] = job.get("Job_Owner")
+            audit["queue"] = job.get("queue")
+            audit["exit_status"] = job.get("Exit_status")
+            audit["mpiprocs"] = job.get("Resource_List.mpiprocs")
+
+            pattern = re.compile('-l ([a-zA-Z0-9=:]*)')
+            audit["workflow_parameters"] = ','.join(pattern.findall(job.get("Submit_arguments")))
+            exit_status = int(job.get('Exit_status', 0))
+            state = Pbspro._job_exit_status.get(
+                exit_status, "FAILED")  # unknown failure by default
+        else:
+            state = Pbspro._job_states[state_code]
+        jobs[name] = state
+        audits[name] = audit
+
     @staticmethod
     def _tokenize_qstat_detailed(fp):
         import re
         # regexps for tokenization (buiding AST) of `qstat -x -f` output
         pattern_attribute_first = re.compile(
-            r"^(?P<key>Job Id): (?P<value>(\w|\.)+)", re.M)
+            r"^(?P<key>Job Id): (?P<value>(\w|\.|\[|\])+)", re.M)
         pattern_attribute_next = re.compile(
             r"^    (?P<key>\w+(\.\w+)*) = (?P<value>.*)", re.M)
         pattern_attribute_continue = re.compile(
@@ -336,7 +500,7 @@ class Pbspro(InfrastructureInterface):
 
         # tokenizes stream output and
         job_attr_tokens = {}
-        for line_no, line in enumerate(fp.readlines()):
+        for line_no, line in enumerate(fp):
             line = line.rstrip('\n\r')  # strip trailing newline character
             if len(line) > 1:  # skip empty lines
                 # find match for the new attribute
@@ -373,6 +537,7 @@ class Pbspro(InfrastructureInterface):
         H="PENDING",  # Job is held
         Q="PENDING",  # Job is queued
         R="RUNNING",  # Job is running
+        B="RUNNING",  # Job array has begun
         T="PENDING",  # Job is being moved to new location
         W="PENDING",  # Job is waiting for its submitter-assigned start time to be reached
         S="SUSPENDED",  # Job is suspended
@@ -399,7 +564,7 @@ class Pbspro(InfrastructureInterface):
         -12: "TIMEOUT",  # OVERLIMIT_CPUT Job exceeded a CPU time limit
     }
 
-    def _get_states_tabular(self, ssh_client, job_names):
+    def _get_states_tabular(self, ssh_client, job_names, job_ids=None):
         """
         Get job states by job names
 
@@ -410,13 +575,17 @@ class Pbspro(InfrastructureInterface):
         scheduling to a crawl.
 
         It invokes `tail/awk` to make simple parsing on the remote HPC.
+        Jobs are selected by id when job_ids (job id by name) is given.
         """
-        # TODO:(emepetres) set start day of consulting
-        # @caution This code fails to manage the situation
-        #          if several jobs have the same name
-        call = "qstat -i `echo {} | xargs -n 1 qselect -N` " \
-               "| tail -n+6 | awk '{{ print $4 \"|\" $10 }}'".format(
-            shlex_quote(' '.join(map(shlex_quote, job_names))))
+        if job_ids:
+            selection = ' '.join(str(job_ids[name]) for name in job_names if job_ids.get(name))
+        else:
+            # TODO:(emepetres) set start day of consulting
+            # @caution This code fails to manage the situation
+            #          if several jobs have the same name
+            selection = "`echo {} | xargs -n 1 qselect -N`".format(
+                shlex_quote(' '.join(map(shlex_quote, job_names))))
+        call = "qstat -i {} | tail -n+6 | awk '{{ print $4 \"|\" $10 }}'".format(selection)
         output, exit_code = ssh_client.send_command(call, wait_result=True)
 
         return Pbspro._parse_qstat_tabular(output) if exit_code == 0 else {}
@@ -429,15 +598,27 @@ class Pbspro(InfrastructureInterface):
             name, state_code = list(map(str.strip, record.split('|')))
             return name, Pbspro._job_states[state_code]
 
-        jobs = qstat_output.splitlines()
-        parsed = {}
+        jobs = [job for job in iter_lines(qstat_output) if job]
         # @TODO: think of catch-and-log parsing exceptions
-        if jobs and (len(jobs) > 1 or jobs[0] != ''):
-            parsed = dict(list(map(parse_qstat_record, jobs)))
+        parsed = dict(list(map(parse_qstat_record, jobs)))
 
         return parsed
 
 
+def _subjob_key(job_id):
+    """ Id of a subjob of an array without the server (e.g. 123[4]), None
+    if it is not a subjob """
+    job_id = str(job_id).split('.')[0]
+    return job_id if job_id.endswith(']') and not job_id.endswith('[]') else None
+
+
+def _parse_pbs_version(output):
+    """ (major, minor, ...) of a `qstat --version` output (e.g.
+    "pbs_version = 19.1.3"), () if there is none """
+    match = re.search(r'(\d+(?:\.\d+)*)', output or '')
+    return tuple(int(number) for number in match.group(1).split('.')) if match else ()
+
+
 def execute_ssh_command(command, workdir, ssh_client, logger):
     _, exit_code = ssh_client.execute_shell_command(command, workdir=workdir, wait_result=True)
     if exit_code != 0:
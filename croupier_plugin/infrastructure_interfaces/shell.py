@@ -25,9 +25,16 @@ bash.py
 """
 
 
-from croupier_plugin.ssh import SshClient
+from threading import Lock
+
+from croupier_plugin.ssh import SshConnectionPool
 from croupier_plugin.infrastructure_interfaces import infrastructure_interface
 
+# byte offset read and states parsed of the croupier-monitor.dat of every host
+# and workdir, so only the lines appended since are fetched
+_monitor_files = {}
+_monitor_files_lock = Lock()
+
 
 class Shell(infrastructure_interface.InfrastructureInterface):
 
@@ -47,9 +54,9 @@ class Shell(infrastructure_interface.InfrastructureInterface):
         @param job_settings: dictionary with the job options
         @rtype dict
         @return dict with two keys:
-         'call' string to call slurm with its parameters, and
-         'scale_env_mapping_call' to push the scale env variables on
-         the batch scripts
+         'call' string to call the job script in background, and
+         'scripts' list of (name, content) of the scripts the call needs,
+         that are created in the same round trip as the call itself
             None if an error arise.
         """
         # Build single line command
@@ -69,12 +76,10 @@ class Shell(infrastructure_interface.InfrastructureInterface):
                               "echo {name},$exit_code >> croupier-monitor.dat".\
             format(script_name=script_name, name=name, args=args)
         call_name = name + "_call.sh"
-        if not self.create_shell_script(ssh_client, call_name, call_script_content):
-            return {'error': 'could not create the call script'}
 
         _call = "nohup ./{call_name} >/dev/null 2>/dev/null &".format(call_name=call_name)
 
-        response = {'call': _call}
+        response = {'call': _call, 'scripts': [(call_name, call_script_content)]}
 
         return response
 
@@ -82,34 +87,71 @@ class Shell(infrastructure_interface.InfrastructureInterface):
         return "pkill -f " + name
 
 # Monitor
-    def get_states(self, credentials, job_names):
-        call = "cat croupier-monitor.dat"
-
-        client = SshClient(credentials)
-
-        output, exit_code = client.execute_shell_command(
-            call,
-            workdir=self.workdir,
-            wait_result=True)
-
-        client.close_connection()
+    def get_states(self, credentials, job_names, job_ids=None):
+        """
+        Every job appends "name,exit code" to croupier-monitor.dat when it
+        ends. Only the bytes appended since the last call are fetched, unless
+        the file was truncated or replaced (rotated) since.
+        """
+        key = (credentials['host'], self.workdir)
+        with _monitor_files_lock:
+            monitor_file = _monitor_files.setdefault(key, {'inode': '', 'offset': 0, 'states': {}})
+            inode, offset = monitor_file['inode'], monitor_file['offset']
+
+        # first line "<inode> <size>", then the new bytes (or the whole file)
+        call = 'set -- $(stat -c "%i %s" croupier-monitor.dat) && echo "$1 $2" && ' \
+               'if [ "$1" = "{inode}" ] && [ "$2" -ge {offset} ]; then tail -c +{start} croupier-monitor.dat; ' \
+               'else cat croupier-monitor.dat; fi'.format(inode=inode, offset=offset, start=offset + 1)
+
+        with SshConnectionPool().connection(credentials) as client:
+            with client.stream_shell_command(call, workdir=self.workdir, timeout=self.STATE_QUERY_TIMEOUT) as output:
+                header, read, states = self._parse_monitor_file(output)
+
+        with _monitor_files_lock:
+            if output.exit_code == 0 and header:
+                if header[0] != inode or int(header[1]) < offset:
+                    # truncated or rotated, read from the beginning
+                    monitor_file['inode'], offset = header[0], 0
+                monitor_file['offset'] = offset + read
+                monitor_file['states'].update(states)
+            states = {name: monitor_file['states'][name] for name in job_names if name in monitor_file['states']}
 
-        states = {}
         audits = {}
-        if exit_code == 0:
-            states = self._parse_states(output)
         for job_name in job_names:
             audits[job_name] = {}
 
         return states, audits
 
+    def _parse_monitor_file(self, output):
+        """
+        Header, bytes of the complete lines read and states of the output of
+        the croupier-monitor.dat query. A last line without line terminator
+        is being written, it is read in the next call.
+        """
+        header = None
+        read = 0
+        pending = ''
+        lines = []
+        for chunk in output.chunks():
+            chunk_lines = (pending + chunk).split('\n')
+            pending = chunk_lines.pop()
+            for line in chunk_lines:
+                if header is None:
+                    header = line.split()
+                else:
+                    read += len(line.encode('utf-8')) + 1
+                    lines.append(line)
+        if header is not None and len(header) != 2:
+            header = None
+        return header, read, self._parse_states(lines)
+
     def _parse_states(self, raw_states):
-        """ Parse two colums exit codes into a dict """
-        jobs = raw_states.splitlines()
+        """ Parse two colums exit codes into a dict, as they arrive """
         parsed = {}
-        if jobs and (len(jobs) > 1 or jobs[0] != ''):
-            for job in jobs:
-                first, second = job.strip().split(',')
+        for job in infrastructure_interface.iter_lines(raw_states):
+            job = job.strip()
+            if job:
+                first, second = job.split(',')
                 parsed[first] = self._parse_exit_codes(second)
 
         return parsed
@@ -26,19 +26,32 @@ slurm.py: Holds the slurm functions
 from builtins import str
 import datetime, pytz
 import time
+from collections import OrderedDict
 
 from croupier_plugin.infrastructure_interfaces.infrastructure_interface import (
     InfrastructureInterface,
-    get_prevailing_state)
-from croupier_plugin.ssh import SshClient
-
-
-def _parse_audit_metrics(metrics_string):
+    JOB_IDS_CHUNK_SIZE,
+    TERMINAL_STATES,
+    chunks,
+    get_finished_job,
+    get_prevailing_state,
+    iter_lines,
+    set_finished_job)
+from croupier_plugin.ssh import SshConnectionPool
+
+# sacct fields of the audit metrics, in the order _parse_audit_metrics reads them
+AUDIT_FIELDS = "JobID,JobName,User,Partition,ExitCode,Submit,Start,End,TimeLimit,CPUTimeRaw,NCPUS"
+
+
+def _parse_audit_metrics(metrics):
+    """ Audit metrics of a job, from its AUDIT_FIELDS given as a list or as
+    a sacct -p line """
     audits = {}
     start_time = None
     completion_time = None
     queued_time = None
-    metrics = metrics_string.split('|')
+    if isinstance(metrics, str):
+        metrics = metrics.split('|')
     if metrics[6] is not None and metrics[6] != 'Unknown':
         start_time = datetime.datetime.strptime(metrics[6], '%Y-%m-%dT%H:%M:%S')
     if metrics[7] is not None and metrics[7] != 'Unknown':
@@ -82,36 +95,37 @@ def convert_to_seconds(cput):
 
 
 def _parse_states(raw_states, logger):
-    """ Parse two colums sacct entries into a dict """
-    jobs = raw_states.splitlines()
-    parsed = {}
-    if jobs and (len(jobs) > 1 or jobs[0] != ''):
-        for job in jobs:
-            first, second = job.strip().split('|')
-            if first in parsed:
-                parsed[first] = get_prevailing_state(parsed[first], second)
-            else:
-                parsed[first] = second
-
-    return parsed
-
-
-def get_job_metrics(job_name, ssh_client, workdir, monitor_start_time_str, logger):
-    # Get job execution audits for monitoring metrics
+    """ Parse two colums sacct entries into a dict, as they arrive """
+    return _parse_sacct(raw_states, logger)[0]
+
+
+def _parse_sacct(raw_states, logger):
+    """
+    Parse sacct -P entries of JobName (or JobID), State and (optionally)
+    the AUDIT_FIELDS, as they arrive, into a dict of states and a dict of
+    audits. Audits are only parsed for the jobs in a terminal state, from
+    the entry whose state prevails.
+    """
+    states = {}
     audits = {}
-    audit_metrics = "JobID,JobName,User,Partition,ExitCode,Submit,Start,End,TimeLimit,CPUTimeRaw,NCPUS"
-    audit_command = "sacct --name {job_name} -o {metrics} -p --noheader -X -S {start_time}" \
-        .format(job_name=job_name, metrics=audit_metrics, start_time=monitor_start_time_str)
-
-    output, exit_code = ssh_client.execute_shell_command(
-        audit_command,
-        workdir=workdir,
-        wait_result=True)
-    if exit_code == 0:
-        audits = _parse_audit_metrics(output)
-    else:
-        logger.error("Failed to get job metrics")
-    return audits
+    for job in iter_lines(raw_states):
+        job = job.strip()
+        if not job:
+            continue
+        fields = job.split('|')
+        name, state = fields[0], fields[1]
+        if name in states:
+            state = get_prevailing_state(states[name], state)
+            if state == states[name]:
+                continue
+        states[name] = state
+        if len(fields) > 2 and state.split()[0] in TERMINAL_STATES:
+            try:
+                audits[name] = _parse_audit_metrics(fields[2:])
+            except (ValueError, IndexError) as err:
+                logger.warning("Could not parse the audit metrics of job " + name + ": " + str(err))
+
+    return states, audits
 
 
 def execute_ssh_command(command, workdir, ssh_client, logger):
@@ -122,6 +136,17 @@ def execute_ssh_command(command, workdir, ssh_client, logger):
     return True
 
 
+def _parse_squeue(raw_states):
+    """ Parse job id and state squeue entries into a dict, as they arrive """
+    parsed = {}
+    for job in iter_lines(raw_states):
+        job = job.strip()
+        if job:
+            job_id, state = job.split('|')
+            parsed[job_id] = state
+    return parsed
+
+
 def start_time_tostr(start_time, timezone):
     start_time = start_time.astimezone(pytz.timezone(timezone))
     return start_time.strftime("%m/%d/%y-%H:%M:%S")
@@ -133,6 +158,11 @@ class Slurm(InfrastructureInterface):
     def _get_jobid(self, output):
         return output.split(' ')[-1].strip()
 
+    def get_array_task_ids(self, job_id, size):
+        # sbatch --parsable returns e.g. 123 or 123;cluster, its tasks are 123_0...
+        job_id, separator, cluster = job_id.partition(';')
+        return [job_id + '_' + str(index) + separator + cluster for index in range(size)]
+
     def _parse_job_settings(
             self,
             job_id,
@@ -232,6 +262,11 @@ class Slurm(InfrastructureInterface):
                     _settings += '%' + \
                                  str(job_settings['scale_max_in_parallel'])
 
+            if job_settings.get('dependencies'):
+                # held until all the jobs given end successfully
+                _settings += ' --dependency=afterok:' + \
+                             ':'.join(str(dependency) for dependency in job_settings['dependencies'])
+
             _settings += ' ' + job_settings['script']
             if 'arguments' in job_settings:
                 for arg in job_settings['arguments']:
@@ -279,34 +314,87 @@ class Slurm(InfrastructureInterface):
     #     return job_settings
 
     # Monitor
-    def get_states(self, credentials, job_names):
-
-        monitor_start_time_str = start_time_tostr(self.monitor_start_time, self.timezone)
-
-        call = "sacct -n -o JobName,State -X -P --name=" + ','.join(job_names) + " -S " + monitor_start_time_str
-
-        client = SshClient(credentials)
-
-        output, exit_code = client.execute_shell_command(call, workdir=self.workdir, wait_result=True)
+    def get_states(self, credentials, job_names, job_ids=None):
+        """
+        Jobs with a known id are looked up in squeue while queued, and in
+        sacct (by id) once they leave the queue. Finished jobs are cached and
+        not queried again. Jobs without id are queried by name in sacct.
+        """
+        host = credentials['host']
         states = {}
-        if exit_code == 0:
-            states = _parse_states(output, self.logger)
-        else:
-            self.logger.error("Failed to get job states: " + output)
-
-        # Get job execution audits for monitoring metrics
         audits = {}
+        names_without_id = []
+        live_ids = OrderedDict()  # job id -> job name
         for name in job_names:
-            if name in states:
-                if states[name] != 'PENDING':
-                    audits[name] = get_job_metrics(name, client, self.workdir, monitor_start_time_str, self.logger)
+            if job_ids and job_ids.get(name):
+                job_id = str(job_ids[name]).split(';')[0]  # sbatch --parsable may add the cluster
+                finished = get_finished_job(host, job_id)
+                if finished is not None:
+                    states[name], audits[name] = finished
+                else:
+                    live_ids[job_id] = name
             else:
+                names_without_id.append(name)
+
+        with SshConnectionPool().connection(credentials) as client:
+            if names_without_id:
+                monitor_start_time_str = start_time_tostr(self.monitor_start_time, self.timezone)
+                call = "sacct -n -o JobName,State," + AUDIT_FIELDS + " -X -P --name=" + \
+                       ','.join(names_without_id) + " -S " + monitor_start_time_str
+                names_states, names_audits = self._query_sacct(client, call)
+                states.update(names_states)
+                audits.update(names_audits)
+
+            left_queue = []
+            for ids in chunks(list(live_ids), JOB_IDS_CHUNK_SIZE):
+                queued = self._query_squeue(client, ids)
+                for job_id in ids:
+                    state = queued.get(job_id)
+                    if state is None or state.split()[0] in TERMINAL_STATES:
+                        left_queue.append(job_id)  # audits are only in sacct
+                    else:
+                        states[live_ids[job_id]] = state
+
+            for ids in chunks(left_queue, JOB_IDS_CHUNK_SIZE):
+                # by id, as the tasks of an array share the name
+                call = "sacct -n -o JobID,State," + AUDIT_FIELDS + " -X -P -j " + ','.join(ids)
+                ids_states, ids_audits = self._query_sacct(client, call)
+                for job_id in ids:
+                    name = live_ids[job_id]
+                    if job_id not in ids_states:
+                        continue
+                    states[name] = ids_states[job_id]
+                    if job_id in ids_audits:
+                        audits[name] = ids_audits[job_id]
+                    if states[name].split()[0] in TERMINAL_STATES:
+                        set_finished_job(host, job_id, states[name], audits.get(name, {}))
+
+        for name in job_names:
+            if name not in states:
                 self.logger.warning("Could not parse the state of job: " + name + "Parsed dict:" + str(states))
 
-        client.close_connection()
+        return states, audits
 
+    def _query_sacct(self, client, call):
+        """ states and audits of a sacct call, see _parse_sacct """
+        with client.stream_shell_command(call, workdir=self.workdir, timeout=self.STATE_QUERY_TIMEOUT) as output:
+            states, audits = _parse_sacct(output, self.logger)
+        if output.exit_code != 0:
+            self.logger.error("Failed to get job states: " + output.stderr)
+            return {}, {}
         return states, audits
 
+    def _query_squeue(self, client, job_ids):
+        """ states of the queued jobs by id, a line per array task """
+        call = "squeue -h -r -o '%i|%T' -j " + ','.join(job_ids)
+        with client.stream_shell_command(call, workdir=self.workdir, timeout=self.STATE_QUERY_TIMEOUT) as output:
+            states = _parse_squeue(output)
+        if output.exit_code != 0:
+            # e.g. none of the jobs is in the queue anymore
+            self.logger.debug("squeue failed, looking the jobs up in sacct: " + output.stderr)
+            return {}
+        return states
+
     def delete_reservation(self, client, reservation_id, deletion_path):
         call = 'sudo {0} {1}'.format(deletion_path, reservation_id)
         output, exit_code = client.execute_shell_command(
@@ -32,12 +32,20 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import str
 from builtins import map
-from croupier_plugin.ssh import SshClient
-from .infrastructure_interface import InfrastructureInterface
+from croupier_plugin.ssh import SshConnectionPool
+from .infrastructure_interface import (
+    InfrastructureInterface,
+    JOB_IDS_CHUNK_SIZE,
+    TERMINAL_STATES,
+    chunks,
+    get_finished_job,
+    iter_lines,
+    set_finished_job)
 from croupier_plugin.utilities import shlex_quote
 import re
 import datetime
 import time
+from collections import OrderedDict
 
 def getHours(cput):
     return int(cput[:cput.index(':')])
@@ -181,6 +189,11 @@ class Torque(InfrastructureInterface):
                     _settings['data'] += '%{}'.format(
                         job_settings['scale_max_in_parallel'])
 
+            if job_settings.get('dependencies'):
+                # held until all the jobs given end successfully
+                _settings['data'] += ' -W depend=afterok:{}'.format(
+                    ':'.join(str(dependency) for dependency in job_settings['dependencies']))
+
             _settings['data'] += ' ' + job_settings['script']
             if _check_job_settings_key('arguments'):
                 args = ''
@@ -228,12 +241,13 @@ class Torque(InfrastructureInterface):
 
     # Monitor
 
-    def get_states(self, credentials, job_names):
+    def get_states(self, credentials, job_names, job_ids=None):
         return self._get_states_detailed(
             credentials,
-            job_names) if job_names else {}
+            job_names,
+            job_ids) if job_names else ({}, {})
 
-    def _get_states_detailed(self, credentials, job_names):
+    def _get_states_detailed(self, credentials, job_names, job_ids=None):
         """
         Get job states by job ids
 
@@ -245,43 +259,63 @@ class Torque(InfrastructureInterface):
 
         It allows to a precise mapping of Torque states to
         Slurm states by taking into account `exit_code`.
-        Unlike `get_states_tabular` it parses output on host
-        and uses several SSH commands.
+        Unlike `get_states_tabular` it parses output on host.
+
+        Jobs are queried by the id `qsub` returned, all of them in a
+        single `qstat -f` call. Only jobs without id (e.g. submitted
+        before ids were kept) are looked up by name with `qselect`.
+        Finished jobs are cached and not queried again.
         """
-        # identify job ids
-        call = "echo {} | xargs -n 1 qselect -N".format(
-            shlex_quote(' '.join(map(shlex_quote, job_names))))
-
-        client = SshClient(credentials)
-
-        output, exit_code = client.execute_shell_command(
-            call,
-            workdir=self.workdir,
-            wait_result=True)
-        job_ids = Torque._parse_qselect(output)
-        if not job_ids:
-            return {}
-
-        # get detailed information about jobs
-        call = "qstat -f {}".format(' '.join(map(str, job_ids)))
-
-        output, exit_code = client.execute_shell_command(
-            call,
-            workdir=self.workdir,
-            wait_result=True)
-        client.close_connection()
-        try:
-            job_states, audits = Torque._parse_qstat_detailed(output)
-        except SyntaxError as e:
-            self.logger.warning(
-                "cannot parse state response for job ids=[{}]".format(
-                    ','.join(map(str, job_ids))))
-            self.logger.warning(
-                "{err}\n`qstat -f` output to parse:\n\\[\n{text}\n\\]".format(
-                    err=str(e), text=output))
-            # TODO: think whether error ignoring is better
-            #       for the correct lifecycle
-            raise e
+        host = credentials['host']
+        job_states = {}
+        audits = {}
+        names_by_id = OrderedDict()
+        names_without_id = []
+        for name in job_names:
+            if job_ids and job_ids.get(name):
+                job_id = str(job_ids[name])
+                finished = get_finished_job(host, job_id)
+                if finished is not None:
+                    job_states[name], audits[name] = finished
+                else:
+                    names_by_id[job_id] = name
+            else:
+                names_without_id.append(name)
+
+        with SshConnectionPool().connection(credentials) as client:
+            if names_without_id:
+                # identify job ids
+                call = "echo {} | xargs -n 1 qselect -N".format(
+                    shlex_quote(' '.join(map(shlex_quote, names_without_id))))
+                with client.stream_shell_command(call, workdir=self.workdir,
+                                                 timeout=self.STATE_QUERY_TIMEOUT) as output:
+                    for job_id in Torque._parse_qselect(output):
+                        names_by_id.setdefault(str(job_id), None)
+
+            # get detailed information about jobs, parsed as it arrives
+            for ids in chunks(list(names_by_id), JOB_IDS_CHUNK_SIZE):
+                call = "qstat -f {}".format(' '.join(ids))
+                with client.stream_shell_command(call, workdir=self.workdir,
+                                                 timeout=self.STATE_QUERY_TIMEOUT) as output:
+                    try:
+                        ids_states, ids_audits = Torque._parse_qstat_detailed(output)
+                    except SyntaxError as e:
+                        self.logger.warning(
+                            "cannot parse state response for job ids=[{}]".format(','.join(ids)))
+                        self.logger.warning(
+                            "{err} in `qstat -f` output".format(err=str(e)))
+                        # TODO: think whether error ignoring is better
+                        #       for the correct lifecycle
+                        raise e
+                if output.exit_code != 0:
+                    # e.g. some of the jobs were purged from the server
+                    self.logger.debug("qstat failed for some jobs: " + output.stderr)
+                job_states.update((name, state) for name, state in ids_states.items() if name in job_names)
+                audits.update((name, audit) for name, audit in ids_audits.items() if name in job_names)
+                for job_id in ids:
+                    name = names_by_id[job_id]
+                    if name in job_states and job_states[name] in TERMINAL_STATES:
+                        set_finished_job(host, job_id, job_states[name], audits.get(name, {}))
 
         return job_states, audits
 
@@ -289,17 +323,13 @@ class Torque(InfrastructureInterface):
     def _parse_qselect(qselect_output):
         """ Parse `qselect` output and returns
         list of job ids without host names """
-        jobs = qselect_output.splitlines()
-        if not jobs or (len(jobs) == 1 and jobs[0] == ''):
-            return []
-        return [int(job.split('.')[0]) for job in jobs]
+        return [int(job.split('.')[0]) for job in iter_lines(qselect_output) if job.strip()]
 
     @staticmethod
     def _parse_qstat_detailed(qstat_output):
-        from io import StringIO
         jobs = {}
         audits = {}
-        for job in Torque._tokenize_qstat_detailed(StringIO(qstat_output)):
+        for job in Torque._tokenize_qstat_detailed(iter_lines(qstat_output)):
             name = job.get('Job_Name', '')
             state_code = job.get('job_state', None)
             audit = {}
@@ -347,7 +377,7 @@ class Torque(InfrastructureInterface):
 
         # tokenizes stream output and
         job_attr_tokens = {}
-        for line_no, line in enumerate(fp.readlines()):
+        for line_no, line in enumerate(fp):
             line = line.rstrip('\n\r')  # strip trailing newline character
             if len(line) > 1:  # skip empty lines
                 # find match for the new attribute
@@ -415,7 +445,7 @@ class Torque(InfrastructureInterface):
     }
 
     @staticmethod
-    def _get_states_tabular(ssh_client, job_names):
+    def _get_states_tabular(ssh_client, job_names, job_ids=None):
         """
         Get job states by job names
 
@@ -426,13 +456,17 @@ class Torque(InfrastructureInterface):
         scheduling to a crawl.
 
         It invokes `tail/awk` to make simple parsing on the remote HPC.
+        Jobs are selected by id when job_ids (job id by name) is given.
         """
-        # TODO:(emepetres) set start day of consulting
-        # @caution This code fails to manage the situation
-        #          if several jobs have the same name
-        call = "qstat -i `echo {} | xargs -n 1 qselect -N` " \
-               "| tail -n+6 | awk '{{ print $4 \"|\" $10 }}'".format(
-            shlex_quote(' '.join(map(shlex_quote, job_names))))
+        if job_ids:
+            selection = ' '.join(str(job_ids[name]) for name in job_names if job_ids.get(name))
+        else:
+            # TODO:(emepetres) set start day of consulting
+            # @caution This code fails to manage the situation
+            #          if several jobs have the same name
+            selection = "`echo {} | xargs -n 1 qselect -N`".format(
+                shlex_quote(' '.join(map(shlex_quote, job_names))))
+        call = "qstat -i {} | tail -n+6 | awk '{{ print $4 \"|\" $10 }}'".format(selection)
         output, exit_code = ssh_client.send_command(call, wait_result=True)
 
         return Torque._parse_qstat_tabular(output) if exit_code == 0 else {}
@@ -445,11 +479,9 @@ class Torque(InfrastructureInterface):
             name, state_code = list(map(str.strip, record.split('|')))
             return name, Torque._job_states[state_code]
 
-        jobs = qstat_output.splitlines()
-        parsed = {}
+        jobs = [job for job in iter_lines(qstat_output) if job]
         # @TODO: think of catch-and-log parsing exceptions
-        if jobs and (len(jobs) > 1 or jobs[0] != ''):
-            parsed = dict(list(map(parse_qstat_record, jobs)))
+        parsed = dict(list(map(parse_qstat_record, jobs)))
 
         return parsed
 
@@ -27,74 +27,127 @@ job_requester.py: Holds the functions that requests jobs information
 
 from builtins import object
 import time
+from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
 
-import requests
-
-from croupier_plugin.infrastructure_interfaces.infrastructure_interface import (
-    InfrastructureInterface,
-    state_int_to_str)
+from croupier_plugin import metrics
+from croupier_plugin.infrastructure_interfaces.infrastructure_interface import InfrastructureInterface
+from croupier_plugin.prometheus_monitor import PrometheusMonitor
 
 
 class JobRequester(object):
     """ Safely gets the jobs status when requested """
     class __JobRequester(object):
+        # Hosts queried at the same time
+        MAX_WORKERS = 16
+
+        # weight of the last query in the latency average of a host
+        LATENCY_WEIGHT = 0.3
+
         _last_time = {}
+        _latency = {}
         _lock = Lock()
+        _executor = None
+        _prometheus = PrometheusMonitor()
 
         def request(self, monitor_jobs, monitor_start_time, logger):
-            """ Retrieves the status of every job"""
-            states = {}
-            audits = {}
-
-            for host, settings in monitor_jobs.items():
-                # Only get info when it is safe
-                if host in self._last_time:
-                    seconds_to_wait = settings['period'] - \
-                        (time.time() - self._last_time[host])
-                    if seconds_to_wait > 0:
+            """ Retrieves the status of every job.
+            Hosts are queried concurrently, so the request takes as long as
+            the slowest host.
+            Returns the states and audits of the jobs of every host that
+            could be queried, and a dict with every host queried and the
+            exception it raised (None if it succeeded), so one failing host
+            does not affect the rest """
+            # Only get info when it is safe
+            hosts = []
+            with self._lock:
+                now = time.time()
+                for host, settings in monitor_jobs.items():
+                    if host in self._last_time and settings['period'] - (now - self._last_time[host]) > 0:
                         continue
+                    self._last_time[host] = now
+                    hosts.append(host)
+
+            # the hosts monitored through the same Prometheus are queried together
+            prometheus_hosts = {}
+            futures = []
+            for host in hosts:
+                settings = monitor_jobs[host]
+                if settings['type'] == "PROMETHEUS":
+                    prometheus_hosts.setdefault(settings['config']['url'], {})[host] = settings['names']
+                else:
+                    futures.append(([host], self._get_executor().submit(
+                        self.request_host, host, settings, monitor_start_time, logger)))
+            for url, url_hosts in prometheus_hosts.items():
+                futures.append((list(url_hosts), self._get_executor().submit(
+                    self._request_prometheus, url, url_hosts)))
 
-                self._last_time[host] = time.time()
-
-                if settings['type'] == "PROMETHEUS":  # external
-                    states, audits = self._get_prometheus(
-                        host,
-                        settings['config'],
-                        settings['names'])
-                else:  # internal
-                    workdir = settings['workdir']
-                    timezone = settings['timezone']
-                    interface_type = settings['type']
-                    wm = InfrastructureInterface.factory(interface_type, logger, workdir, monitor_start_time, timezone)
-                    if wm:
-                        states, audits = wm.get_states(settings['config'], settings['names'])
-                    else:
-                        states, audits = self._no_states(host, interface_type, settings['names'], logger)
-            return states, audits
-
-        def _get_prometheus(self, host, config, names):
             states = {}
-            url = config['url']
-            if len(names) == 1:
-                query = (url + '/api/v1/query?query=job_status'
-                         '%7Bjob%3D%22' + host +
-                         '%22%2Cname%3D%22')
-            else:
-                query = (url + '/api/v1/query?query=job_status'
-                         '%7Bjob%3D%22' + host +
-                         '%22%2Cname%3D~%22')
-            query += '|'.join(names) + '%22%7D'
-
-            payload = requests.get(query)
-
-            response = payload.json()
-
-            for item in response["data"]["result"]:
-                states[item["metric"]["name"]] = state_int_to_str(
-                    item["value"][1])
-
-            return states
+            audits = {}
+            errors = {}
+            for future_hosts, future in futures:
+                try:
+                    host_states, host_audits = future.result()
+                except Exception as exp:
+                    errors.update((host, exp) for host in future_hosts)
+                    continue
+                errors.update((host, None) for host in future_hosts)
+                states.update(host_states)
+                audits.update(host_audits)
+            return states, audits, errors
+
+        def get_latency(self, host):
+            """ Average seconds the state queries to the host take, None if unknown """
+            return self._latency.get(host)
+
+        def request_host(self, host, settings, monitor_start_time, logger):
+            """ Retrieves the states and audits of the jobs of a host, now """
+            start = time.time()
+            try:
+                return self._request_host(host, settings, monitor_start_time, logger)
+            finally:
+                self._update_latency([host], time.time() - start)
+
+        def _get_executor(self):
+            with self._lock:
+                if self._executor is None:
+                    type(self)._executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
+                return self._executor
+
+        def _request_prometheus(self, url, hosts):
+            """ Retrieves the states and audits of the jobs of several hosts
+            from the Prometheus that scrapes them, now """
+            start = time.time()
+            try:
+                return self._prometheus.get_states(url, hosts)
+            finally:
+                self._update_latency(hosts, time.time() - start)
+
+        def _update_latency(self, hosts, latency):
+            with self._lock:
+                for host in hosts:
+                    if host in self._latency:
+                        self._latency[host] = self.LATENCY_WEIGHT * latency + \
+                            (1 - self.LATENCY_WEIGHT) * self._latency[host]
+                    else:
+                        self._latency[host] = latency
+
+        def _request_host(self, host, settings, monitor_start_time, logger):
+            if settings['type'] == "PROMETHEUS":  # external
+                return self._prometheus.get_states(settings['config']['url'], {host: settings['names']})
+            else:  # internal
+                workdir = settings['workdir']
+                timezone = settings['timezone']
+                interface_type = settings['type']
+                wm = InfrastructureInterface.factory(interface_type, logger, workdir, monitor_start_time, timezone)
+                if wm:
+                    with metrics.command_class('state_query'):
+                        if settings.get('packs'):  # run in a batch job with others
+                            return wm.get_packed_states(settings['config'], settings['names'],
+                                                        settings.get('ids'), settings['packs'])
+                        return wm.get_states(settings['config'], settings['names'], job_ids=settings.get('ids'))
+                else:
+                    return self._no_states(host, interface_type, settings['names'], logger)
 
         def _no_states(self, host, mtype, names, logger):
             logger.error("Monitor of type " +
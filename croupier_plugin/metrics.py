@@ -0,0 +1,307 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+metrics.py: SSH and remote command latency metrics, per host and command
+class, with a Prometheus text format export.
+
+Values are recorded in fixed-bucket histograms and counters sharded per
+thread: every thread only writes to its own shard, so recording takes no
+lock. Snapshots add the shards up.
+"""
+import atexit
+import bisect
+import configparser
+import functools
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# Seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+CONNECT_SECONDS = 'croupier_ssh_connect_seconds'
+COMMAND_SECONDS = 'croupier_ssh_command_seconds'
+TRANSFER_SECONDS = 'croupier_sftp_transfer_seconds'
+BYTES_RECEIVED = 'croupier_ssh_received_bytes_total'
+BYTES_SENT = 'croupier_ssh_sent_bytes_total'
+RETRIES = 'croupier_ssh_retries_total'
+
+_HELP = {
+    CONNECT_SECONDS: 'SSH connection setup time by phase (tcp, kex, auth, total)',
+    COMMAND_SECONDS: 'Remote command round-trip time',
+    TRANSFER_SECONDS: 'SFTP file transfer time',
+    BYTES_RECEIVED: 'Bytes received from remote commands and transfers',
+    BYTES_SENT: 'Bytes sent by remote commands and transfers',
+    RETRIES: 'SSH connection, command and session retries',
+}
+
+COMMAND_CLASSES = ('submit', 'state_query', 'cleanup', 'transfer', 'other')
+
+_context = threading.local()
+
+
+@contextmanager
+def command_class(name):
+    """ Classifies the remote commands run by this thread inside the block """
+    previous = getattr(_context, 'command_class', None)
+    _context.command_class = name
+    try:
+        yield
+    finally:
+        _context.command_class = previous
+
+
+def classified(name):
+    """ Decorator that classifies the remote commands run by the function """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with command_class(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_command_class():
+    return getattr(_context, 'command_class', None) or 'other'
+
+
+class _Sharded(object):
+    """ Values kept in one list per thread, added up on read """
+
+    def __init__(self, size):
+        self._size = size
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = [0] * self._size
+            self._local.shard = shard
+            with self._shards_lock:  # once per thread
+                self._shards.append(shard)
+        return shard
+
+    def _sum(self):
+        with self._shards_lock:
+            shards = list(self._shards)
+        total = [0] * self._size
+        for shard in shards:
+            for index, value in enumerate(shard):
+                total[index] += value
+        return total
+
+
+class Histogram(_Sharded):
+    """ Fixed-bucket histogram """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        # one slot per bucket, one for +Inf and one for the sum
+        super(Histogram, self).__init__(len(buckets) + 2)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value):
+        shard = self._shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def snapshot(self):
+        """ dict with the count, sum, cumulative buckets and p50/p99 """
+        values = self._sum()
+        cumulative = []
+        count = 0
+        for upper, value in zip(self.buckets + (float('inf'),), values[:-1]):
+            count += value
+            cumulative.append((upper, count))
+        return {
+            'count': count,
+            'sum': values[-1],
+            'buckets': cumulative,
+            'p50': _quantile(cumulative, 0.5),
+            'p99': _quantile(cumulative, 0.99),
+        }
+
+
+class Counter(_Sharded):
+
+    def __init__(self):
+        super(Counter, self).__init__(1)
+
+    def increment(self, amount=1):
+        self._shard()[0] += amount
+
+    def snapshot(self):
+        return {'value': self._sum()[0]}
+
+
+def _quantile(cumulative, q):
+    """ Upper bound of the bucket holding the q quantile, None if empty """
+    count = cumulative[-1][1]
+    if not count:
+        return None
+    rank = q * count
+    previous = None
+    for upper, value in cumulative:
+        if value >= rank:
+            return upper if upper != float('inf') else previous
+        previous = upper
+    return previous
+
+
+class MetricsRegistry(object):
+    """ Metrics by (name, labels) """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name, labels, factory):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:  # only when the series is new
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = factory()
+        return metric
+
+    def observe(self, name, value, **labels):
+        self._get(name, labels, Histogram).observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        self._get(name, labels, Counter).increment(amount)
+
+    def snapshot(self):
+        """ dict {(name, ((label, value), ...)): metric snapshot} """
+        with self._lock:
+            metrics = list(self._metrics.items())
+        return {key: metric.snapshot() for key, metric in metrics}
+
+    def clear(self):
+        with self._lock:
+            self._metrics = {}
+
+    def prometheus_text(self):
+        """ Metrics in the Prometheus text exposition format """
+        lines = []
+        written = set()
+        for (name, labels), values in sorted(self.snapshot().items()):
+            if name not in written:
+                written.add(name)
+                lines.append('# HELP {0} {1}'.format(name, _HELP.get(name, name)))
+                lines.append('# TYPE {0} {1}'.format(name, 'histogram' if 'buckets' in values else 'counter'))
+            if 'buckets' in values:
+                for upper, count in values['buckets']:
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name, _labels(labels + (('le', _number(upper)),)), count))
+                lines.append('{0}_sum{1} {2}'.format(name, _labels(labels), _number(values['sum'])))
+                lines.append('{0}_count{1} {2}'.format(name, _labels(labels), values['count']))
+            else:
+                lines.append('{0}{1} {2}'.format(name, _labels(labels), _number(values['value'])))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """ Writes the metrics in Prometheus text format (atomically) """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(self.prometheus_text())
+        os.rename(tmp_path, path)
+
+    def serve(self, port, address='127.0.0.1'):
+        """ Serves the metrics on http://address:port/metrics in a thread """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer((address, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def dump_periodically(self, path, period=60):
+        """ Dumps the metrics to path every period seconds and at exit """
+        stop = threading.Event()
+
+        def loop():
+            while not stop.wait(period):
+                self.dump(path)
+
+        thread = threading.Thread(target=loop)
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.dump, path)
+        return stop
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = MetricsRegistry()
+_exporting = False
+
+
+def export_from_config(config_file=None):
+    """
+    Starts the exports configured in the [Metrics] section of Croupier.cfg:
+    prometheus_file (and prometheus_file_period) and prometheus_port.
+    Does nothing if called again.
+    """
+    global _exporting
+    if _exporting:
+        return
+    _exporting = True
+
+    config = configparser.RawConfigParser()
+    config.read(config_file or os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Croupier.cfg'))
+    if not config.has_section('Metrics'):
+        return
+    if config.has_option('Metrics', 'prometheus_file') and config.get('Metrics', 'prometheus_file'):
+        period = config.getint('Metrics', 'prometheus_file_period') \
+            if config.has_option('Metrics', 'prometheus_file_period') else 60
+        registry.dump_periodically(config.get('Metrics', 'prometheus_file'), period)
+    if config.has_option('Metrics', 'prometheus_port') and config.get('Metrics', 'prometheus_port'):
+        registry.serve(config.getint('Metrics', 'prometheus_port'))
@@ -0,0 +1,328 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+monitoring_service.py: Monitoring daemon shared by all the workflow
+executions of a machine. Executions register their jobs through a local
+socket, and the daemon runs a single state query per cluster and period for
+the jobs of all of them. Run it with
+
+    python -m croupier_plugin.monitoring_service [socket path]
+
+The executions send the credentials of the clusters through the socket, so
+it is only used if it belongs to the user, in a directory only the user can
+access ($XDG_RUNTIME_DIR/croupier or ~/.croupier by default).
+"""
+import configparser
+import hashlib
+import json
+import logging
+import os
+import socket
+import stat
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from socketserver import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+
+from croupier_plugin.job_requester import JobRequester
+from croupier_plugin.ssh import HostUnavailableError
+
+SOCKET_NAME = 'monitoring.sock'
+
+
+def default_socket_path():
+    """ Socket in the runtime directory of the user, or in ~/.croupier """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    socket_dir = os.path.join(runtime_dir, 'croupier') if runtime_dir else os.path.expanduser('~/.croupier')
+    return os.path.join(socket_dir, SOCKET_NAME)
+
+
+def _check_owned_socket(socket_path):
+    """ Raises PermissionError if the path is not a socket of this user """
+    info = os.stat(socket_path)
+    if not stat.S_ISSOCK(info.st_mode) or info.st_uid != os.getuid():
+        raise PermissionError(socket_path + " is not a socket owned by this user")
+
+
+def _check_peer(client):
+    """ Raises PermissionError if the process listening is not of this
+    user, where the peer credentials are known (Linux) """
+    if hasattr(socket, 'SO_PEERCRED'):
+        credentials = client.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', credentials)
+        if uid != os.getuid():
+            raise PermissionError("Monitoring service run by another user (uid " + str(uid) + ")")
+
+
+def _read_config(config_file=None):
+    config = configparser.RawConfigParser()
+    config.read(config_file or os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Croupier.cfg'))
+    return config
+
+
+class _ThreadingUnixStreamServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class MonitoringService(object):
+    """
+    Keeps the jobs registered by the executions, grouped by cluster (host,
+    infrastructure interface and credentials) and by the working directory
+    and timezone they are queried with, and queries every group once per
+    period. Executions get the last states known.
+
+    Jobs not registered again for LEASE seconds are forgotten, so the
+    executions that end do not need to unregister.
+    """
+    PERIOD = 15
+    LEASE = 600
+    MAX_WORKERS = 16
+
+    def __init__(self, period=PERIOD, logger=None):
+        self.period = period
+        self.logger = logger or logging.getLogger('croupier.monitoring_service')
+        self._groups = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
+        self._requester = JobRequester()
+
+    @staticmethod
+    def _group_key(host, settings):
+        # the workdir is where the monitor and pack status files are read
+        query = json.dumps([settings['config'], settings.get('workdir'), settings.get('timezone')], sort_keys=True)
+        return host + '|' + settings['type'] + '|' + hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+    def register(self, monitor_jobs, monitor_start_time, seen=None):
+        """
+        Registers (or renews) jobs and returns what is known about them
+
+        @param monitor_jobs: same as JobRequester.request
+        @param monitor_start_time: timestamp of the start of the monitor
+        @param seen: {host: query number} of the last results received
+        @return dict with the states, audits, errors and query numbers
+        """
+        seen = seen or {}
+        now = time.time()
+        response = {'states': {}, 'audits': {}, 'errors': {}, 'queries': {}}
+        with self._lock:
+            for host, settings in monitor_jobs.items():
+                key = self._group_key(host, settings)
+                group = self._groups.get(key)
+                if group is None:
+                    group = self._groups[key] = {
+                        'host': host,
+                        'settings': dict(settings, names=[]),
+                        'names': {},
+                        'start_time': monitor_start_time,
+                        'last_query': 0,
+                        'query': 0,
+                        'states': {},
+                        'audits': {},
+                        'error': None,
+                    }
+                group['start_time'] = min(group['start_time'], monitor_start_time)
+                group['settings']['ids'] = dict(group['settings'].get('ids') or {}, **(settings.get('ids') or {}))
+                group['settings']['packs'] = dict(group['settings'].get('packs') or {},
+                                                  **(settings.get('packs') or {}))
+                for name in settings['names']:
+                    group['names'][name] = now + self.LEASE
+                    if name in group['states']:
+                        response['states'][name] = group['states'][name]
+                    if name in group['audits']:
+                        response['audits'][name] = group['audits'][name]
+                response['queries'][host] = group['query']
+                if group['query'] and group['query'] != seen.get(host):
+                    response['errors'][host] = group['error']
+        return response
+
+    def poll(self):
+        """ Queries the groups whose period has passed, concurrently """
+        now = time.time()
+        due = []
+        with self._lock:
+            for key, group in list(self._groups.items()):
+                for name, expiry in list(group['names'].items()):
+                    if expiry < now:
+                        del group['names'][name]
+                        group['states'].pop(name, None)
+                        group['audits'].pop(name, None)
+                        group['settings']['ids'].pop(name, None)
+                        group['settings']['packs'].pop(name, None)
+                if not group['names']:
+                    del self._groups[key]
+                elif now - group['last_query'] >= self.period:
+                    group['last_query'] = now
+                    settings = dict(group['settings'], names=sorted(group['names']))
+                    due.append((group, self._executor.submit(
+                        self._requester.request_host, group['host'], settings,
+                        datetime.fromtimestamp(group['start_time']), self.logger)))
+
+        for group, future in due:
+            try:
+                states, audits = future.result()
+                error = None
+            except Exception as exp:
+                self.logger.warning("Error when monitoring jobs on host " + group['host'] + ": " + str(exp))
+                states, audits = {}, {}
+                error = {'type': type(exp).__name__, 'message': str(exp)}
+            with self._lock:
+                group['states'].update(states)
+                group['audits'].update(audits)
+                group['error'] = error
+                group['query'] += 1
+
+    def serve(self, socket_path=None):
+        """ Serves the executions on a unix socket, only reachable by this
+        user, in a thread. Returns the server """
+        socket_path = socket_path or default_socket_path()
+        socket_dir = os.path.dirname(socket_path)
+        if not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir, mode=0o700)
+        info = os.stat(socket_dir)
+        if info.st_uid != os.getuid() or info.st_mode & 0o077:
+            raise PermissionError(socket_dir + " must belong to this user and be only accessible by it (0700)")
+        if os.path.lexists(socket_path):
+            # only a socket left by a previous run of this user
+            _check_owned_socket(socket_path)
+            os.remove(socket_path)
+        service = self
+
+        class RequestHandler(StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline().decode('utf-8'))
+                    response = service.register(request['monitor_jobs'],
+                                                request['monitor_start_time'],
+                                                request.get('seen'))
+                except (ValueError, KeyError, TypeError) as err:
+                    response = {'error': str(err)}
+                self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+        old_umask = os.umask(0o077)
+        try:
+            server = _ThreadingUnixStreamServer(socket_path, RequestHandler)
+        finally:
+            os.umask(old_umask)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.logger.info("Monitoring service listening in " + socket_path)
+        return server
+
+    def serve_forever(self, socket_path=None):
+        """ Serves the executions and polls the clusters until interrupted """
+        socket_path = socket_path or default_socket_path()
+        server = self.serve(socket_path)
+        try:
+            while True:
+                start = time.time()
+                self.poll()
+                time.sleep(max(1 - (time.time() - start), 0))
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.remove(socket_path)
+
+
+class MonitoringServiceClient(object):
+    """
+    JobRequester replacement that gets the job states from the monitoring
+    service. Falls back to querying the clusters itself if the service is
+    not running.
+    """
+    TIMEOUT = 30
+
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or default_socket_path()
+        self._seen = {}
+
+    @staticmethod
+    def from_config(config_file=None):
+        """ Client of the service configured in the [MonitoringService]
+        section of Croupier.cfg, None if it is not enabled """
+        config = _read_config(config_file)
+        if not config.has_section('MonitoringService') or \
+                not config.has_option('MonitoringService', 'enabled') or \
+                not config.getboolean('MonitoringService', 'enabled'):
+            return None
+        socket_path = config.get('MonitoringService', 'socket') \
+            if config.has_option('MonitoringService', 'socket') else None
+        return MonitoringServiceClient(socket_path)
+
+    def request(self, monitor_jobs, monitor_start_time, logger):
+        """ See JobRequester.request """
+        request = {
+            'monitor_jobs': monitor_jobs,
+            'monitor_start_time': time.mktime(monitor_start_time.timetuple()),
+            'seen': self._seen,
+        }
+        try:
+            response = self._send(request)
+        except (socket.error, ValueError) as err:
+            logger.warning("Monitoring service not available (" + str(err) + "), querying the jobs directly")
+            return JobRequester().request(monitor_jobs, monitor_start_time, logger)
+
+        errors = {}
+        for host, error in response['errors'].items():
+            if error is None:
+                errors[host] = None
+            elif error['type'] == HostUnavailableError.__name__:
+                errors[host] = HostUnavailableError(error['message'])
+            else:
+                errors[host] = Exception(error['message'])
+        self._seen.update(response['queries'])
+        return response['states'], response['audits'], errors
+
+    def get_latency(self, host):
+        """ The service paces the queries, asking it is cheap """
+        return None
+
+    def _send(self, request):
+        # the request has the credentials of the clusters
+        _check_owned_socket(self.socket_path)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(self.TIMEOUT)
+        try:
+            client.connect(self.socket_path)
+            _check_peer(client)
+            client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            response = json.loads(client.makefile('rb').readline().decode('utf-8'))
+        finally:
+            client.close()
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO)
+    config = _read_config()
+    socket_path = argv[1] if len(argv) > 1 else \
+        config.get('MonitoringService', 'socket') if config.has_option('MonitoringService', 'socket') \
+        else None
+    period = config.getint('MonitoringService', 'period') if config.has_option('MonitoringService', 'period') \
+        else MonitoringService.PERIOD
+    MonitoringService(period).serve_forever(socket_path)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,135 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+poll_scheduler.py: Decides when every job is polled next
+"""
+import heapq
+import time
+
+# States in which a job waits for resources
+WAITING_STATES = ('WAITING', 'PENDING', 'CONFIGURING', 'SUSPENDED', 'STOPPED', 'PREEMPTED')
+# States in which a job is about to finish
+FINISHING_STATES = ('COMPLETING',)
+
+
+def max_time_to_seconds(max_time):
+    """
+    Seconds of a job time limit given as minutes, MM:SS, HH:MM:SS, D-HH,
+    D-HH:MM or D-HH:MM:SS. None if it can not be parsed.
+    """
+    try:
+        max_time = str(max_time).strip()
+        days = 0
+        if '-' in max_time:
+            days, max_time = max_time.split('-', 1)
+            parts = [int(part) for part in max_time.split(':')] + [0] * (2 - max_time.count(':'))
+            hours, minutes, seconds = parts
+        else:
+            parts = [int(part) for part in max_time.split(':')]
+            if len(parts) == 1:
+                hours, minutes, seconds = 0, parts[0], 0
+            elif len(parts) == 2:
+                hours, minutes, seconds = 0, parts[0], parts[1]
+            else:
+                hours, minutes, seconds = parts
+        return ((int(days) * 24 + hours) * 60 + minutes) * 60 + seconds
+    except ValueError:
+        return None
+
+
+class PollScheduler(object):
+    """
+    Priority queue of the next poll deadline of every job
+
+    The interval until the next poll of a job depends on its state: waiting
+    jobs are polled less and less often while they stay waiting, running
+    jobs every period, more often when they get close to their time limit,
+    and finishing jobs right away. Intervals are never shorter than a few
+    times the time the scheduler takes to answer.
+    """
+    MIN_INTERVAL = 1
+    MAX_INTERVAL = 300
+    # the interval of a waiting job is multiplied by WAITING_BACKOFF on
+    # every poll it keeps waiting
+    WAITING_BACKOFF = 1.5
+    MAX_WAITING_INTERVAL = 120
+    FINISHING_INTERVAL = 2
+    # minimum interval in times the query latency of the host
+    LATENCY_FACTOR = 4
+
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        self._waiting_polls = {}
+
+    def schedule(self, name, deadline):
+        """ Sets the next poll of a job, replacing the previous one """
+        self._deadlines[name] = deadline
+        heapq.heappush(self._heap, (deadline, name))
+
+    def is_scheduled(self, name):
+        return name in self._deadlines
+
+    def remove(self, name):
+        self._deadlines.pop(name, None)
+        self._waiting_polls.pop(name, None)
+
+    def pop_due(self, now=None):
+        """ Names of the jobs whose poll deadline has passed, unscheduled """
+        now = time.time() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, name = heapq.heappop(self._heap)
+            if self._deadlines.get(name) == deadline:  # not rescheduled
+                del self._deadlines[name]
+                due.append(name)
+        return due
+
+    def next_deadline(self):
+        """ Earliest poll deadline, None if there is no job scheduled """
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def next_interval(self, name, state, period, latency=None, remaining_time=None):
+        """
+        Seconds until the next poll of a job
+
+        @param state: last known state of the job
+        @param period: monitor period of the job, interval of running jobs
+        @param latency: seconds the last query to the job host took
+        @param remaining_time: seconds until the job reaches its time limit
+        """
+        if state in WAITING_STATES:
+            polls = self._waiting_polls.get(name, 0)
+            self._waiting_polls[name] = polls + 1
+            interval = min(period * self.WAITING_BACKOFF ** polls, max(period, self.MAX_WAITING_INTERVAL))
+        else:
+            self._waiting_polls.pop(name, None)
+            if state in FINISHING_STATES:
+                interval = self.FINISHING_INTERVAL
+            else:
+                interval = period
+                if remaining_time is not None:
+                    # the job will end at its time limit at the latest
+                    interval = min(interval, max(remaining_time / 2.0, self.MIN_INTERVAL))
+
+        if latency:
+            interval = max(interval, latency * self.LATENCY_FACTOR)
+        return min(max(interval, self.MIN_INTERVAL), self.MAX_INTERVAL)
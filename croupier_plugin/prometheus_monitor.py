@@ -0,0 +1,117 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+prometheus_monitor.py: Gets the job states and audits from the Prometheus
+server the HPC Exporter is scraped by, instead of querying the clusters
+"""
+import re
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from croupier_plugin.infrastructure_interfaces.infrastructure_interface import (
+    TERMINAL_STATES,
+    state_int_to_str)
+
+# metric with the state of every job (labels job: host, name: job name)
+STATUS_METRIC = 'job_status'
+# prefix of the rest of job metrics of the HPC Exporter, kept as audits
+AUDIT_METRICS_PREFIX = 'job_'
+
+
+def _regex_matcher(values):
+    """ PromQL string with a regex that matches exactly any of the values """
+    regex = '|'.join(re.escape(value) for value in values)
+    return '"' + regex.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class PrometheusMonitor(object):
+    """
+    Queries Prometheus with a pooled keep-alive session. The jobs of all the
+    hosts scraped by the same server are queried together: one query for the
+    states, and one more for the audit metrics of the jobs that ended.
+    """
+    # (connect, read) timeouts of every query
+    TIMEOUT = (5, 60)
+    POOL_SIZE = 16
+
+    def __init__(self):
+        self._session = None
+        self._lock = Lock()
+
+    def _get_session(self):
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.POOL_SIZE, pool_maxsize=self.POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    def get_states(self, url, hosts):
+        """
+        States and audits of the jobs of several hosts
+
+        @type url: string
+        @param url: Prometheus server address
+        @type hosts: dictionary
+        @param hosts: job names by host
+        @rtype tuple
+        @return (states, audits) of the jobs found
+        """
+        # the selector matches any host with any name, the series of a
+        # name on a host other than its own are dropped
+        name_hosts = {}
+        for host, host_names in hosts.items():
+            for name in host_names:
+                name_hosts.setdefault(name, set()).add(host)
+        selector = 'job=~' + _regex_matcher(sorted(hosts)) + ',name=~' + _regex_matcher(sorted(name_hosts))
+
+        states = {}
+        for item in self._query(url, STATUS_METRIC + '{' + selector + '}'):
+            metric = item['metric']
+            if metric.get('job') in name_hosts.get(metric['name'], ()):
+                states[metric['name']] = state_int_to_str(int(float(item['value'][1])))
+
+        audits = {}
+        ended = sorted(name for name, state in states.items() if state in TERMINAL_STATES)
+        if ended:
+            selector = '__name__=~"' + AUDIT_METRICS_PREFIX + '.+",__name__!="' + STATUS_METRIC + '",' + \
+                       'job=~' + _regex_matcher(sorted(hosts)) + ',name=~' + _regex_matcher(ended)
+            for item in self._query(url, '{' + selector + '}'):
+                metric = item['metric']
+                if metric.get('job') not in name_hosts[metric['name']]:
+                    continue
+                audit = audits.setdefault(metric['name'], {})
+                audit[metric['__name__'][len(AUDIT_METRICS_PREFIX):]] = item['value'][1]
+        return states, audits
+
+    def _query(self, url, query):
+        """ Result of an instant query, form-encoded so the selectors of
+        thousands of jobs do not hit URL length limits """
+        response = self._get_session().post(url.rstrip('/') + '/api/v1/query',
+                                            data={'query': query},
+                                            timeout=self.TIMEOUT)
+        response.raise_for_status()
+        document = response.json()
+        if document.get('status') != 'success':
+            raise RuntimeError("Prometheus query failed: " + str(document.get('error')))
+        return document['data']['result']
@@ -43,7 +43,8 @@ from cloudify import ctx
 from cloudify.decorators import operation
 from cloudify.exceptions import NonRecoverableError
 
-from croupier_plugin.ssh import SshClient
+from croupier_plugin import metrics
+from croupier_plugin.ssh import SshConnectionPool
 from croupier_plugin.infrastructure_interfaces.infrastructure_interface import (InfrastructureInterface)
 # from croupier_plugin.data_mover.datamover_proxy import (DataMoverProxy)
 import croupier_plugin.vault.vault as vault
@@ -58,6 +59,7 @@ import croupier_plugin.data_management.data_management as dm
 standard_library.install_aliases()
 
 accounting_client = AccountingClient()
+ssh_pool = SshConnectionPool()
 
 
 @operation()
@@ -295,26 +297,25 @@ def configure_execution(
         if 'credentials' in ctx.instance.runtime_properties:
             credentials = ctx.instance.runtime_properties['credentials']
         try:
-            client = SshClient(credentials)
+            with ssh_pool.connection(credentials) as client:
+                # TODO: use command according to wm
+                _, exit_code = client.execute_shell_command('uname', wait_result=True)
+
+                if exit_code != 0:
+                    raise NonRecoverableError("Failed executing on the infrastructure: exit code " + str(exit_code))
+
+                ctx.instance.runtime_properties['login'] = exit_code == 0
+
+                prefix = workdir_prefix if workdir_prefix else ctx.blueprint.name
+
+                workdir = wm.create_new_workdir(client, base_dir, prefix)
+        except NonRecoverableError:
+            raise
         except Exception as exp:
             ctx.logger.error('Error Connecting to infrastructure interface {0} with error {1}'
                              .format(ctx.instance.id, str(exp)))
             raise NonRecoverableError(
                 "Failed trying to connect to infrastructure interface: " + str(exp))
-
-        # TODO: use command according to wm
-        _, exit_code = client.execute_shell_command('uname', wait_result=True)
-
-        if exit_code != 0:
-            client.close_connection()
-            raise NonRecoverableError("Failed executing on the infrastructure: exit code " + str(exit_code))
-
-        ctx.instance.runtime_properties['login'] = exit_code == 0
-
-        prefix = workdir_prefix if workdir_prefix else ctx.blueprint.name
-
-        workdir = wm.create_new_workdir(client, base_dir, prefix)
-        client.close_connection()
         if workdir is None:
             raise NonRecoverableError("failed to create the working directory, base dir: " + base_dir)
         ctx.instance.runtime_properties['workdir'] = workdir
@@ -356,11 +357,10 @@ def cleanup_execution(
 
         if 'credentials' in ctx.instance.runtime_properties:
             credentials = ctx.instance.runtime_properties['credentials']
-        client = SshClient(credentials)
-        client.execute_shell_command(
-            'rm -r ' + workdir,
-            wait_result=True)
-        client.close_connection()
+        with metrics.command_class('cleanup'), ssh_pool.connection(credentials) as client:
+            client.execute_shell_command(
+                'rm -r ' + workdir,
+                wait_result=True)
 
         ctx.logger.info('..all clean.')
     else:
@@ -620,27 +620,32 @@ def deploy_job(script, inputs, credentials, interface_type, workdir, name, logge
 
     # Execute the script and manage the output
     success = False
-    client = SshClient(credentials)
     script_content = script if script[0] == '#' else ctx.get_resource(script)
-    if wm.create_shell_script(client, name, script_content):
-        call = "./" + name
-        for dinput in inputs:
-            str_input = str(dinput)
-            if ('\n' in str_input or ' ' in str_input) and str_input[0] != '"':
-                call += ' "' + str_input + '"'
-            else:
-                call += ' ' + str_input
-        _, exit_code = client.execute_shell_command(call, workdir=workdir, wait_result=True)
-        if exit_code != 0:
-            logger.warning("failed to deploy job: call '" + call + "', exit code " + str(exit_code))
+    call = "./" + name
+    for dinput in inputs:
+        str_input = str(dinput)
+        if ('\n' in str_input or ' ' in str_input) and str_input[0] != '"':
+            call += ' "' + str_input + '"'
         else:
-            success = True
-
-        if not skip_cleanup:
-            if not client.execute_shell_command("rm " + name, workdir=workdir):
-                logger.warning("failed removing bootstrap script")
+            call += ' ' + str_input
+
+    # upload the script, then run and (optionally) remove it in a single round trip
+    calls = [call]
+    if not skip_cleanup:
+        calls.append("rm " + name)
+    with ssh_pool.connection(credentials) as client:
+        if not wm.upload_scripts(client, [(name, script_content)]):
+            return success
+        results = client.execute_batch(calls, workdir=workdir)
+
+    _, exit_code = results[0]
+    if exit_code != 0:
+        logger.warning("failed to deploy job: call '" + call + "', exit code " + str(exit_code))
+    else:
+        success = True
 
-    client.close_connection()
+    if not skip_cleanup and results[1][1] != 0:
+        logger.warning("failed removing bootstrap script")
 
     return success
 
@@ -657,6 +662,23 @@ def send_job(job_options, **kwargs):  # pylint: disable=W0613
     if 'reservation' in ctx.instance.runtime_properties:
         job_options['reservation'] = ctx.instance.runtime_properties['reservation']
 
+    # the job notifies its end to the workflow, see CallbackListener
+    if 'callback' in kwargs and kwargs['callback']:
+        job_options['callback'] = kwargs['callback']
+
+    # ids of the jobs to wait for in the infrastructure queue, see run_jobs
+    if 'dependencies' in kwargs and kwargs['dependencies']:
+        job_options['dependencies'] = kwargs['dependencies']
+
+    # the job runs other jobs with it, see InfrastructureInterface._build_pack_scripts
+    if 'packed_jobs' in kwargs and kwargs['packed_jobs']:
+        job_options['packed_jobs'] = kwargs['packed_jobs']
+
+    # the job is sent as an array with a task per instance of the node
+    array_size = int(kwargs['array_size']) if 'array_size' in kwargs and kwargs['array_size'] else 0
+    if array_size > 1:
+        job_options['scale'] = array_size
+
     if not simulate:
         # Process data flow for inputs in this job
         dm.processDataTransfer(ctx.instance, ctx.logger, 'input')
@@ -664,11 +686,9 @@ def send_job(job_options, **kwargs):  # pylint: disable=W0613
         # Prepare HPC interface to send job
         workdir = ctx.instance.runtime_properties['workdir']
         interface_type = ctx.instance.runtime_properties['infrastructure_interface']
-        client = SshClient(ctx.instance.runtime_properties['credentials'])
 
         wm = InfrastructureInterface.factory(interface_type, ctx.logger, workdir)
         if not wm:
-            client.close_connection()
             raise NonRecoverableError("Infrastructure Interface '" + interface_type + "' not supported.")
         context_vars = {
             'CFY_EXECUTION_ID': ctx.execution_id,
@@ -677,14 +697,15 @@ def send_job(job_options, **kwargs):  # pylint: disable=W0613
         ctx.logger.info('Submitting the job {0}'.format(ctx.instance.id))
 
         try:
-            jobid = wm.submit_job(client, name, job_options, is_singularity, ctx, context_vars)
+            with ssh_pool.connection(ctx.instance.runtime_properties['credentials']) as client:
+                jobid = wm.submit_job(client, name, job_options, is_singularity, ctx, context_vars)
         except Exception as ex:
             ctx.logger.error('Job {0} could not be submitted because error {1}'.format(ctx.instance.id, str(ex)))
             raise ex
-        client.close_connection()
     else:
         ctx.logger.warning('Instance ' + ctx.instance.id + ' simulated')
         jobid = "Simulated"
+        wm = None
 
     if jobid:
         ctx.logger.info('Job ' + name + ' (' + ctx.instance.id + ') sent. Jobid: ' + jobid)
@@ -705,6 +726,14 @@ def send_job(job_options, **kwargs):  # pylint: disable=W0613
                     ctx.instance.runtime_properties['credentials']['host'])
     ctx.instance.update()
 
+    # the workflow monitors the job by its id, every array task by its own
+    if array_size > 1:
+        task_ids = wm.get_array_task_ids(jobid, array_size) if wm else [jobid] * array_size
+        if not task_ids:
+            raise NonRecoverableError("Infrastructure Interface '" + interface_type + "' does not support arrays.")
+        return task_ids
+    return jobid
+
 
 @operation
 def delete_reservation(**kwargs):
@@ -715,11 +744,9 @@ def delete_reservation(**kwargs):
         return
     reservation_id = ctx.instance.runtime_properties['reservation']
     interface_type = ctx.instance.runtime_properties['infrastructure_interface']
-    client = SshClient(ctx.instance.runtime_properties['credentials'])
     deletion_path = ctx.instance.runtime_properties['reservation_deletion_path']
     wm = InfrastructureInterface.factory(interface_type, ctx.logger, '')
     if not wm:
-        client.close_connection()
         raise NonRecoverableError(
             "Infrastructure Interface '" +
             interface_type +
@@ -728,15 +755,14 @@ def delete_reservation(**kwargs):
     ctx.logger.info('Submitting the job ...')
 
     try:
-        ok = wm.delete_reservation(
-            client,
-            reservation_id,
-            deletion_path)
+        with ssh_pool.connection(ctx.instance.runtime_properties['credentials']) as client:
+            ok = wm.delete_reservation(
+                client,
+                reservation_id,
+                deletion_path)
     except Exception as ex:
         ctx.logger.error('Reservation could not be deleted because error: ' + str(ex))
-        client.close_connection()
         return
-    client.close_connection()
 
     if ok:
         ctx.logger.info('Reservation with ID {0} deleted successfully'.format(reservation_id))
@@ -765,15 +791,12 @@ def cleanup_job(job_options, skip, **kwargs):  # pylint: disable=W0613
                 type_hierarchy
             workdir = ctx.instance.runtime_properties['workdir']
             interface_type = ctx.instance.runtime_properties['infrastructure_interface']
-            client = SshClient(ctx.instance.runtime_properties['credentials'])
 
             wm = InfrastructureInterface.factory(interface_type, ctx.logger, workdir)
             if not wm:
-                client.close_connection()
                 raise NonRecoverableError("Infrastructure Interface '" + interface_type + "' not supported.")
-            is_clean = wm.clean_job_aux_files(client, name, is_singularity)
-
-            client.close_connection()
+            with ssh_pool.connection(ctx.instance.runtime_properties['credentials']) as client:
+                is_clean = wm.clean_job_aux_files(client, name, is_singularity)
         else:
             ctx.logger.warning('Instance ' + ctx.instance.id + ' simulated')
             is_clean = True
@@ -804,15 +827,12 @@ def stop_job(job_options, **kwargs):  # pylint: disable=W0613
         if not simulate:
             workdir = ctx.instance.runtime_properties['workdir']
             interface_type = ctx.instance.runtime_properties['infrastructure_interface']
-            client = SshClient(ctx.instance.runtime_properties['credentials'])
 
             wm = InfrastructureInterface.factory(interface_type, ctx.logger, workdir)
             if not wm:
-                client.close_connection()
                 raise NonRecoverableError("Infrastructure Interface '" + interface_type + "' not supported.")
-            is_stopped = wm.stop_job(client, name, job_options, is_singularity)
-
-            client.close_connection()
+            with ssh_pool.connection(ctx.instance.runtime_properties['credentials']) as client:
+                is_stopped = wm.stop_job(client, name, job_options, is_singularity)
         else:
             ctx.logger.warning('Instance ' + ctx.instance.id + ' simulated')
             is_stopped = True
@@ -847,12 +867,14 @@ def publish(**kwargs):
             dm.processDataTransfer(ctx.instance, ctx.logger, 'output')
 
             workdir = ctx.instance.runtime_properties['workdir']
-            client = SshClient(ctx.instance.runtime_properties['credentials'])
 
             hpc_interface = ctx.instance.relationships[0].target.instance
-            audit["cput"] = \
-                convert_cput(audit["cput"], job_id=name, workdir=workdir, ssh_client=client, logger=ctx.logger) \
-                    if audit is not None and "cput" in audit and audit["cput"] else 0
+            if audit is not None and "cput" in audit and audit["cput"]:
+                with ssh_pool.connection(ctx.instance.runtime_properties['credentials']) as client:
+                    audit["cput"] = \
+                        convert_cput(audit["cput"], job_id=name, workdir=workdir, ssh_client=client, logger=ctx.logger)
+            else:
+                audit["cput"] = 0
             # Report metrics to Accounting component
             if accounting_client.report_to_accounting:
                 username = None
@@ -867,8 +889,6 @@ def publish(**kwargs):
                     ctx.logger.error(
                         'Consumed resources by workflow {workflow_id} could not be reported to Accounting: '
                         'Croupier instance not registered in Accounting'.format(workflow_id=ctx.workflow_id))
-
-            client.close_connection()
         else:
             ctx.logger.warning('Instance ' + ctx.instance.id + ' simulated')
 
@@ -913,11 +933,6 @@ def ecmwf_vertical_interpolation(query, keycloak_credentials, credentials, cloud
     if query["date"]:
         arguments["date"] = query["date"]
         arguments["time"] = query["time"]
-    try:
-        client = SshClient(credentials)
-    except Exception as e:
-        ctx.logger.error("There was an error trying to connect to ECMWF's VM: {0}".format(str(e)))
-        raise
     command = "cd cloudify && source /opt/anaconda3/etc/profile.d/conda.sh && conda activate && " \
               "nohup python3 interpolator.py"
 
@@ -928,8 +943,12 @@ def ecmwf_vertical_interpolation(query, keycloak_credentials, credentials, cloud
     out_file = "/dev/null"
     command += " > " + out_file + " 2>&1 & disown"
 
-    client.execute_shell_command(command)
-    client.close_connection()
+    try:
+        with ssh_pool.connection(credentials) as client:
+            client.execute_shell_command(command)
+    except Exception as e:
+        ctx.logger.error("There was an error trying to connect to ECMWF's VM: {0}".format(str(e)))
+        raise
 
     # Waits for confirmation that retrieval of data is finished and ready to upload to CKAN
     ctx.logger.info('Waiting for response from ECMWF')
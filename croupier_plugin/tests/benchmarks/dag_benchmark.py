@@ -0,0 +1,179 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+dag_benchmark.py: Measures the run_jobs loop on a synthetic graph of job
+nodes in layers, every node depending on two of the previous layer, with
+operations and job queries that end right away. Run it with
+
+    python -m croupier_plugin.tests.benchmarks.dag_benchmark [nodes] [instances per node]
+"""
+
+from __future__ import print_function
+
+import logging
+import sys
+import time
+
+from croupier_plugin import workflows
+from croupier_plugin.workflows import Launcher, Monitor, build_graph, execute_graph
+
+LAYER_SIZE = 100
+
+
+class _Task(object):
+
+    def get_state(self):
+        return 'succeeded'
+
+
+class _Result(object):
+    """ Result of an operation that already ended """
+    task = _Task()
+
+    def get(self):
+        return None
+
+    def on_result(self, f, *a):
+        f(None, *a)
+
+
+class _Instance(object):
+
+    def __init__(self, instance_id):
+        self.id = instance_id
+        self.runtime_properties = {
+            'timezone': 'Europe/Madrid',
+            'credentials': {'host': 'hpc' + str(hash(instance_id) % 4)},
+            'workdir': '/home/croupier',
+            'infrastructure_interface': 'SLURM',
+            'monitoring_options': {},
+            'job_prefix': 'cfy_',
+        }
+        self._node_instance = self
+
+    def send_event(self, event):
+        pass
+
+    def execute_operation(self, operation, kwargs=None):
+        return _Result()
+
+
+class _Relationship(object):
+
+    def __init__(self, target_node):
+        self.target_node = target_node
+
+
+class _Node(object):
+
+    type = 'croupier.nodes.Job'
+    type_hierarchy = ['cloudify.nodes.Root', 'croupier.nodes.Job']
+    properties = {'job_options': {}}
+
+    def __init__(self, node_id, instances, parents):
+        self.id = node_id
+        self.instances = [_Instance(node_id + '_' + str(index)) for index in range(instances)]
+        self.parents = parents
+
+    @property
+    def relationships(self):
+        return iter([_Relationship(parent) for parent in self.parents])
+
+
+class _Requester(object):
+    """ Every job queried is in the given state """
+
+    def __init__(self, state):
+        self.state = state
+        self.queried = 0
+
+    def request(self, monitor_jobs, monitor_start_time, logger):
+        states = {}
+        for settings in monitor_jobs.values():
+            for name in settings['names']:
+                states[name] = self.state
+        self.queried += len(states)
+        return states, {}, {}
+
+    def get_latency(self, host):
+        return None
+
+
+def _graph(nodes, instances):
+    graph = []
+    for index in range(nodes):
+        layer_start = (index // LAYER_SIZE - 1) * LAYER_SIZE
+        parents = [graph[layer_start + index % LAYER_SIZE], graph[layer_start + (index + 1) % LAYER_SIZE]] \
+            if layer_start >= 0 else []
+        graph.append(_Node('node' + str(index), instances, parents))
+    return graph
+
+
+def main(nodes=2000, instances=5):
+    logger = logging.getLogger('dag_benchmark')
+    workflows.MAX_LOOP_SLEEP = 0
+
+    start = time.time()
+    root_nodes, job_instances_map = build_graph(_graph(nodes, instances))
+    print("{0:<30} {1:8.1f} ms ({2} nodes, {3} instances)".format(
+        "build graph", (time.time() - start) * 1000, nodes, len(job_instances_map)))
+
+    # every job completes on its first poll
+    requester = _Requester('COMPLETED')
+    launcher = Launcher()
+    monitor = Monitor(job_instances_map, logger, jobs_requester=requester, launcher=launcher)
+    loops = [0]
+    update_status = monitor.update_status
+
+    def counted_update_status():
+        loops[0] += 1
+        update_status()
+    monitor.update_status = counted_update_status
+
+    start = time.time()
+    assert execute_graph(root_nodes, monitor, launcher)
+    elapsed = time.time() - start
+    assert requester.queried == len(job_instances_map)
+    print("{0:<30} {1:8.1f} ms ({2} loops, {3:.1f} us per instance)".format(
+        "run graph", elapsed * 1000, loops[0], elapsed / len(job_instances_map) * 1e6))
+
+    # all the jobs running, none of them due
+    root_nodes, job_instances_map = build_graph(_graph(nodes, instances))
+    launcher = Launcher(max_parallel=len(job_instances_map))
+    monitor = Monitor(job_instances_map, logger, jobs_requester=_Requester('RUNNING'), launcher=launcher)
+    for node in root_nodes:
+        monitor.add_node(node)
+    for job_instance in job_instances_map.values():
+        launcher.add(job_instance)
+    launcher.update()
+    launcher.update()
+    monitor.update_status()
+    repeat = 1000
+    start = time.time()
+    for _ in range(repeat):
+        launcher.update()
+        monitor.update_status()
+        monitor.pop_finished_nodes()
+    elapsed = (time.time() - start) / repeat
+    print("{0:<30} {1:8.1f} us ({2} instances running)".format(
+        "idle loop", elapsed * 1e6, len(monitor._executing)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,82 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+key_benchmark.py: Measures the private key and known_hosts loading done on
+every SSH connection setup, parsing them every time (old) and cached. Run it
+with
+
+    python -m croupier_plugin.tests.benchmarks.key_benchmark [connections]
+"""
+
+from __future__ import print_function
+
+import io
+import os
+import sys
+import tempfile
+import time
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+from paramiko import ECDSAKey, RSAKey, SSHClient
+
+from croupier_plugin import ssh
+
+PASSWORD = 'secret'
+KNOWN_HOSTS = 500
+
+
+def _openssh_key(key):
+    """ Key in OpenSSH format, encrypted with the bcrypt KDF """
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH,
+                             serialization.BestAvailableEncryption(PASSWORD.encode('ascii'))).decode('ascii')
+
+
+def _measure(name, function, connections):
+    start = time.time()
+    for _ in range(connections):
+        function()
+    print("{0:<40} {1:8.2f} ms/connection".format(name, (time.time() - start) * 1000 / connections))
+
+
+def main(connections=20):
+    rsa_key = _openssh_key(rsa.generate_private_key(65537, 2048))
+    ed25519_key = _openssh_key(ed25519.Ed25519PrivateKey.generate())
+
+    host_key = ECDSAKey.generate()
+    with tempfile.NamedTemporaryFile('w', suffix='known_hosts', delete=False) as known_hosts:
+        for index in range(KNOWN_HOSTS):
+            known_hosts.write('hpc{0}.example.com {1} {2}\n'.format(index, host_key.get_name(),
+                                                                 host_key.get_base64()))
+    try:
+        print("Loading credentials for {0} connections".format(connections))
+        _measure("RSA key, parsed every time (old)",
+                 lambda: RSAKey.from_private_key(io.StringIO(rsa_key), password=PASSWORD), connections)
+        _measure("RSA key, cached", lambda: ssh._load_private_key(rsa_key, PASSWORD), connections)
+        _measure("Ed25519 key, cached", lambda: ssh._load_private_key(ed25519_key, PASSWORD), connections)
+        _measure("known_hosts ({0} hosts), parsed (old)".format(KNOWN_HOSTS),
+                 lambda: SSHClient().load_host_keys(known_hosts.name), connections)
+        _measure("known_hosts ({0} hosts), cached".format(KNOWN_HOSTS),
+                 lambda: ssh._load_host_keys(SSHClient(), known_hosts.name), connections)
+    finally:
+        os.remove(known_hosts.name)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,107 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+qstat_benchmark.py: Measures the parsing of synthetic `qstat -x -f` outputs
+of PBS Pro, in text and in JSON (-F json). Run it with
+
+    python -m croupier_plugin.tests.benchmarks.qstat_benchmark [jobs]
+"""
+
+from __future__ import print_function
+
+import json
+import sys
+import time
+
+from croupier_plugin.infrastructure_interfaces.pbspro import Pbspro
+
+# realistic attributes that the parser does not use, qstat prints ~50 per job
+VARIABLE_LIST = "PBS_O_HOME=/home/croupier,PBS_O_LANG=en_US.UTF-8,PBS_O_LOGNAME=croupier," \
+                "PBS_O_PATH=/usr/local/bin:/usr/bin:/bin,PBS_O_SHELL=/bin/bash,PBS_O_WORKDIR=/home/croupier"
+
+
+def _job(index):
+    """ Attributes of a job, half of them finished """
+    finished = index % 2 == 0
+    job = {
+        "Job_Name": "job{0}".format(index),
+        "Job_Owner": "croupier@login",
+        "job_state": "F" if finished else "R",
+        "queue": "workq",
+        "server": "server",
+        "ctime": "Tue Sep 22 13:20:00 2020",
+        "qtime": "Tue Sep 22 13:20:00 2020",
+        "stime": "Tue Sep 22 13:25:00 2020",
+        "mtime": "Tue Sep 22 13:29:49 2020",
+        "exec_host": "node{0}/0*4".format(index % 64),
+        "Resource_List": {"mpiprocs": 4, "ncpus": 4, "nodect": 1, "walltime": "00:10:00",
+                          "select": "1:ncpus=4:mpiprocs=4"},
+        "resources_used": {"cpupercent": 98, "cput": "00:04:00", "mem": "1024kb", "ncpus": 4,
+                           "vmem": "2048kb", "walltime": "00:04:49"},
+        "Submit_arguments": "-l walltime=00:10:00 job{0}.script".format(index),
+        "Variable_List": VARIABLE_LIST,
+    }
+    if finished:
+        job["Exit_status"] = 0
+    return job
+
+
+def _text_output(jobs):
+    lines = []
+    for job_id, job in jobs.items():
+        lines.append("Job Id: " + job_id)
+        for key, value in job.items():
+            if isinstance(value, dict):
+                for resource, resource_value in value.items():
+                    lines.append("    {0}.{1} = {2}".format(key, resource, resource_value))
+            else:
+                value = str(value)
+                lines.append("    {0} = {1}".format(key, value[:70]))
+                # long values are wrapped in tab indented lines
+                for start in range(70, len(value), 70):
+                    lines.append("\t" + value[start:start + 70])
+        lines.append("")
+    return '\n'.join(lines) + '\n'
+
+
+def _measure(name, function, output, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        states, _ = function(output)
+    elapsed = (time.time() - start) / repeat
+    print("{0:<30} {1:8.1f} ms ({2} jobs, {3:.1f} MB)".format(name, elapsed * 1000, len(states),
+                                                           len(output) / 1e6))
+    return elapsed
+
+
+def main(jobs=10000, repeat=3):
+    jobs = {"{0}.server".format(index): _job(index) for index in range(jobs)}
+    text = _text_output(jobs)
+    document = json.dumps({"timestamp": 1600781389, "pbs_version": "19.1.3", "pbs_server": "server",
+                           "Jobs": jobs}, indent=4)
+    assert Pbspro._parse_qstat_detailed(text) == Pbspro._parse_qstat_json(document)
+
+    print("Parsing `qstat -x -f` output")
+    text_time = _measure("text", Pbspro._parse_qstat_detailed, text, repeat)
+    json_time = _measure("JSON (-F json)", Pbspro._parse_qstat_json, document, repeat)
+    print("speedup x{0:.1f}".format(text_time / json_time))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,114 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+sshd.py: Local sshd stand-in for the SSH benchmarks, built on paramiko.
+It accepts any password and serves direct-tcpip channels.
+"""
+
+import select
+import socket
+import threading
+
+import paramiko
+
+USER = 'croupier'
+PASSWORD = 'croupier'
+
+
+class _Server(paramiko.ServerInterface):
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        try:
+            target = socket.create_connection(destination)
+        except socket.error:
+            return paramiko.OPEN_FAILED_CONNECT_FAILED
+        thread = threading.Thread(target=_pump, args=(self.transport, chanid, target))
+        thread.daemon = True
+        thread.start()
+        return paramiko.OPEN_SUCCEEDED
+
+
+def _pump(transport, chanid, target, buffer_size=256 * 1024):
+    channel = transport.accept(10)
+    if channel is None:
+        target.close()
+        return
+    while True:
+        ready, _, _ = select.select([target, channel], [], [])
+        if target in ready:
+            data = target.recv(buffer_size)
+            if not data:
+                break
+            channel.sendall(data)
+        if channel in ready:
+            data = channel.recv(buffer_size)
+            if not data:
+                break
+            target.sendall(data)
+    channel.close()
+    target.close()
+
+
+class SshdStandIn(object):
+    """ sshd listening on a local port, to be used as a jump host """
+
+    def __init__(self):
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(16)
+        self.port = self._socket.getsockname()[1]
+        self._transports = []
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def credentials(self):
+        return {'host': '127.0.0.1', 'port': self.port, 'user': USER, 'password': PASSWORD}
+
+    def _serve(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+            except socket.error:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=_Server(transport))
+            self._transports.append(transport)
+
+    def close(self):
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
@@ -0,0 +1,146 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+tunnel_benchmark.py: Measures the throughput of the SSH forwardings
+against a local sshd stand-in. Run it with
+
+    python -m croupier_plugin.tests.benchmarks.tunnel_benchmark [MiB]
+"""
+
+from __future__ import print_function
+
+import select
+import socket
+import sys
+import threading
+import time
+
+from croupier_plugin import ssh
+from croupier_plugin.tests.benchmarks.sshd import SshdStandIn
+
+
+class LegacyHandler(ssh.Handler):
+    """ Forwarding loop as it was before, 1024 bytes at a time """
+
+    def handle(self):
+        chan = self.ssh_transport.open_channel(
+            "direct-tcpip", (self.chain_host, self.chain_port), self.request.getpeername())
+        while True:
+            r, w, x = select.select([self.request, chan], [], [])
+            if self.request in r:
+                data = self.request.recv(1024)
+                if len(data) == 0:
+                    break
+                chan.send(data)
+            if chan in r:
+                data = chan.recv(1024)
+                if len(data) == 0:
+                    break
+                self.request.send(data)
+        chan.close()
+        self.request.close()
+
+
+def _start_source(size):
+    """ TCP server (the forwarding target) that sends size bytes """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(4)
+    block = b'x' * (1024 * 1024)
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.error:
+                return
+            sent = 0
+            while sent < size:
+                conn.sendall(block[:min(len(block), size - sent)])
+                sent += len(block)
+            conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _receive(sock):
+    received = 0
+    while True:
+        data = sock.recv(256 * 1024)
+        if not data:
+            return received
+        received += len(data)
+
+
+def _measure(name, connect, size):
+    start = time.time()
+    sock = connect()
+    received = _receive(sock)
+    elapsed = time.time() - start
+    sock.close()
+    assert received == size, "{0}: received {1} of {2} bytes".format(name, received, size)
+    print("{0:<32} {1:8.1f} MiB/s".format(name, size / elapsed / 1024 / 1024))
+
+
+def main(megabytes=64):
+    size = megabytes * 1024 * 1024
+    sshd = SshdStandIn()
+    source = _start_source(size)
+    credentials = {'host': '127.0.0.1', 'port': source.getsockname()[1], 'tunnel': sshd.credentials()}
+
+    tunnel = ssh.SshForward.acquire(credentials)
+    try:
+        print("Forwarding {0} MiB through a local sshd stand-in".format(megabytes))
+
+        class SubHandler(LegacyHandler):
+            chain_host = credentials['host']
+            chain_port = credentials['port']
+            ssh_transport = tunnel._client.get_transport()
+
+        legacy = ssh.ForwardServer(("127.0.0.1", 0), SubHandler)
+        threading.Thread(target=legacy.serve_forever).start()
+        _measure("local port, 1 KiB loop (old)",
+                 lambda: socket.create_connection(legacy.server_address), size)
+        legacy.shutdown()
+        legacy.server_close()
+
+        _measure("local port, memoryview loop",
+                 lambda: socket.create_connection(("127.0.0.1", tunnel.port())), size)
+        _measure("direct-tcpip channel", tunnel.open_channel, size)
+
+        start = time.time()
+        ssh.SshClient(sshd.credentials()).close_connection()
+        print("{0:<32} {1:8.2f} ms/connection".format("new jump connection", (time.time() - start) * 1000))
+        connections = 10
+        start = time.time()
+        for _ in range(connections):
+            ssh.SshForward.acquire(credentials).release()
+        print("{0:<32} {1:8.2f} ms/connection".format("shared tunnel acquire",
+                                                       (time.time() - start) * 1000 / connections))
+    finally:
+        tunnel.release()
+        source.close()
+        sshd.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 64)
@@ -0,0 +1,87 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+callback_listener_tests.py: Holds the job completion callback unit tests
+"""
+
+import json
+import logging
+import shutil
+import subprocess
+import time
+import unittest
+
+import requests
+
+from croupier_plugin.callback_listener import CallbackListener
+from croupier_plugin.infrastructure_interfaces.infrastructure_interface import InfrastructureInterface
+
+
+class TestCallbackListener(unittest.TestCase):
+    """ Holds the callback listener tests """
+
+    def setUp(self):
+        self.listener = CallbackListener('http://127.0.0.1:{port}', address='127.0.0.1')
+        self.addCleanup(self.listener.close)
+
+    def _post(self, name, document):
+        return requests.post(self.listener.url + '/jobs/' + name, data=json.dumps(document), timeout=5)
+
+    def test_notification(self):
+        """ Notified jobs are handed out once """
+        response = self._post('job1', {'name': 'job1', 'token': self.listener.token, 'exit_code': 0,
+                                       'job_id': '123', 'completion_time': 100})
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.listener.pop_notifications(),
+                         {'job1': ('COMPLETED', {'exit_status': '0', 'job_id': '123', 'completion_time': 100})})
+        self.assertEqual(self.listener.pop_notifications(), {})
+
+    def test_wrong_token(self):
+        """ Notifications without the token are rejected """
+        response = self._post('job1', {'name': 'job1', 'token': 'guess', 'exit_code': 0})
+        self.assertEqual(response.status_code, 403)
+        response = self._post('job2', {'name': 'job1', 'token': self.listener.token, 'exit_code': 0})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.listener.pop_notifications(), {})
+
+    def test_wait_returns_on_notification(self):
+        """ The monitor sleep ends when a job notifies its end """
+        self._post('job1', {'name': 'job1', 'token': self.listener.token, 'exit_code': 1})
+        start = time.time()
+        self.listener.wait(5)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(self.listener.pop_notifications()['job1'][0], 'FAILED')
+
+    @unittest.skipUnless(shutil.which('curl'), "curl not available")
+    def test_script_epilogue(self):
+        """ The batch script epilogue reports the exit code of the job """
+        wm = InfrastructureInterface('SLURM', logging.getLogger('TestCallbackListener'), 'workdir')
+        script = wm._build_callback_epilogue('job1', self.listener.callback()) + 'echo running\nexit 3\n'
+        subprocess.run(['bash', '-c', script], env={'SLURM_JOB_ID': '42', 'PATH': '/usr/bin:/bin'},
+                       stdout=subprocess.DEVNULL, timeout=30)
+
+        state, audit = self.listener.pop_notifications()['job1']
+        self.assertEqual(state, 'FAILED')
+        self.assertEqual(audit['exit_status'], '3')
+        self.assertEqual(audit['job_id'], '42')
+        self.assertLessEqual(audit['start_time'], audit['completion_time'])
+
+
+if __name__ == '__main__':
+    unittest.main()
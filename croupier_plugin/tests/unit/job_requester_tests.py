@@ -0,0 +1,100 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+job_requester_tests.py: Holds the job requester unit tests
+"""
+
+import logging
+import threading
+import unittest
+
+import mock
+
+from croupier_plugin.job_requester import JobRequester
+
+HOSTS = ['hpc{0}.example.com'.format(index) for index in range(5)]
+
+
+def _monitor_jobs(period=0):
+    return {host: {'type': 'SLURM', 'period': period, 'names': ['job_' + host]} for host in HOSTS}
+
+
+class TestJobRequester(unittest.TestCase):
+    """ Holds the job requester tests """
+
+    def setUp(self):
+        self.requester = JobRequester()
+        self.requester._last_time.clear()
+        self.addCleanup(self.requester._last_time.clear)
+
+    def test_hosts_queried_concurrently(self):
+        """ Every host is queried at the same time and the results merged """
+        barrier = threading.Barrier(len(HOSTS), timeout=5)
+
+        def request_host(host, settings, monitor_start_time, logger):
+            barrier.wait()  # only passes if every host is being queried
+            return {settings['names'][0]: 'RUNNING'}, {settings['names'][0]: {'host': host}}
+
+        with mock.patch.object(self.requester.instance, '_request_host', side_effect=request_host):
+            states, audits, errors = self.requester.request(_monitor_jobs(), None, logging.getLogger())
+        self.assertEqual(states, {'job_' + host: 'RUNNING' for host in HOSTS})
+        self.assertEqual(audits, {'job_' + host: {'host': host} for host in HOSTS})
+        self.assertEqual(errors, {host: None for host in HOSTS})
+
+    def test_failing_host(self):
+        """ A failing host does not hide the states of the rest """
+        error = IOError('unreachable')
+
+        def request_host(host, settings, monitor_start_time, logger):
+            if host == HOSTS[0]:
+                raise error
+            return {settings['names'][0]: 'RUNNING'}, {}
+
+        with mock.patch.object(self.requester.instance, '_request_host', side_effect=request_host):
+            states, _, errors = self.requester.request(_monitor_jobs(), None, logging.getLogger())
+        self.assertEqual(len(states), len(HOSTS) - 1)
+        self.assertIs(errors[HOSTS[0]], error)
+
+    def test_period(self):
+        """ Hosts are not queried again before their period """
+        with mock.patch.object(self.requester.instance, '_request_host', return_value=({}, {})) as request_host:
+            self.requester.request(_monitor_jobs(period=60), None, logging.getLogger())
+            _, _, errors = self.requester.request(_monitor_jobs(period=60), None, logging.getLogger())
+        self.assertEqual(request_host.call_count, len(HOSTS))
+        self.assertEqual(errors, {})
+
+    def test_prometheus_hosts_together(self):
+        """ The hosts monitored through the same Prometheus are queried at once """
+        monitor_jobs = _monitor_jobs()
+        for host in HOSTS[:3]:
+            monitor_jobs[host].update(type='PROMETHEUS', config={'url': 'http://prometheus:9090'})
+
+        with mock.patch.object(self.requester.instance, '_request_host', return_value=({}, {})) as request_host, \
+                mock.patch.object(self.requester.instance, '_prometheus') as prometheus:
+            prometheus.get_states.return_value = ({'job_' + HOSTS[0]: 'RUNNING'}, {})
+            states, _, errors = self.requester.request(monitor_jobs, None, logging.getLogger())
+        prometheus.get_states.assert_called_once_with(
+            'http://prometheus:9090', {host: ['job_' + host] for host in HOSTS[:3]})
+        self.assertEqual(request_host.call_count, len(HOSTS) - 3)
+        self.assertEqual(states, {'job_' + HOSTS[0]: 'RUNNING'})
+        self.assertEqual(errors, {host: None for host in HOSTS})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+metrics_tests.py: Holds the SSH metrics unit tests
+"""
+
+import threading
+import unittest
+
+from croupier_plugin import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    """ Holds the histograms, counters and export tests """
+
+    def test_histogram_snapshot(self):
+        """ Values land in their buckets and quantiles use bucket bounds """
+        histogram = metrics.Histogram(buckets=(1, 2, 5))
+        for value in (0.5, 1, 1.5, 3, 10):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 5)
+        self.assertEqual(snapshot['sum'], 16)
+        self.assertEqual(snapshot['buckets'], [(1, 2), (2, 3), (5, 4), (float('inf'), 5)])
+        self.assertEqual(snapshot['p50'], 2)
+        self.assertEqual(snapshot['p99'], 5)
+
+    def test_shards_are_added_up(self):
+        """ Values recorded by several threads are all counted """
+        counter = metrics.Counter()
+
+        def increment():
+            for _ in range(1000):
+                counter.increment()
+        threads = [threading.Thread(target=increment) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.snapshot()['value'], 8000)
+
+    def test_prometheus_text(self):
+        """ Series are exported with their labels """
+        registry = metrics.MetricsRegistry()
+        registry.observe(metrics.COMMAND_SECONDS, 0.2, host='hpc', command_class='submit')
+        registry.increment(metrics.RETRIES, host='hpc', operation='connect')
+        text = registry.prometheus_text()
+        self.assertIn('# TYPE croupier_ssh_command_seconds histogram', text)
+        self.assertIn('croupier_ssh_command_seconds_bucket{command_class="submit",host="hpc",le="0.25"} 1',
+                      text)
+        self.assertIn('croupier_ssh_command_seconds_bucket{command_class="submit",host="hpc",le="+Inf"} 1',
+                      text)
+        self.assertIn('croupier_ssh_retries_total{host="hpc",operation="connect"} 1', text)
+
+    def test_command_class(self):
+        """ Commands are classified within the block only """
+        self.assertEqual(metrics.current_command_class(), 'other')
+        with metrics.command_class('submit'):
+            self.assertEqual(metrics.current_command_class(), 'submit')
+        self.assertEqual(metrics.current_command_class(), 'other')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+monitoring_service_tests.py: Holds the shared monitoring service unit tests
+"""
+
+import logging
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+import mock
+
+from croupier_plugin.monitoring_service import MonitoringService, MonitoringServiceClient, default_socket_path
+from croupier_plugin.ssh import HostUnavailableError
+
+CREDENTIALS = {'host': 'hpc.example.com', 'user': 'croupier', 'password': 'secret'}
+
+
+def _monitor_jobs(*names):
+    return {'hpc.example.com': {'config': CREDENTIALS, 'type': 'SLURM', 'workdir': 'workdir',
+                                'names': list(names), 'ids': {}, 'period': 1, 'timezone': 'UTC'}}
+
+
+def _request_host(host, settings, monitor_start_time, logger):
+    return {name: 'RUNNING' for name in settings['names']}, {}
+
+
+class TestMonitoringService(unittest.TestCase):
+    """ Holds the monitoring service tests """
+
+    def setUp(self):
+        self.service = MonitoringService(period=0)
+        patcher = mock.patch.object(self.service, '_requester')
+        self.requester = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.requester.request_host.side_effect = _request_host
+
+    def test_one_query_per_cluster(self):
+        """ The jobs of every execution are queried together """
+        self.service.register(_monitor_jobs('job1'), 0)
+        self.service.register(_monitor_jobs('job2', 'job3'), 0)
+        self.service.poll()
+
+        self.assertEqual(self.requester.request_host.call_count, 1)
+        settings = self.requester.request_host.call_args[0][1]
+        self.assertEqual(settings['names'], ['job1', 'job2', 'job3'])
+
+        response = self.service.register(_monitor_jobs('job2'), 0)
+        self.assertEqual(response['states'], {'job2': 'RUNNING'})
+
+    def test_different_credentials(self):
+        """ Jobs of other users are queried with their own credentials """
+        self.service.register(_monitor_jobs('job1'), 0)
+        other_user = _monitor_jobs('job2')
+        other_user['hpc.example.com']['config'] = dict(CREDENTIALS, user='other')
+        self.service.register(other_user, 0)
+        self.service.poll()
+
+        self.assertEqual(self.requester.request_host.call_count, 2)
+
+    def test_different_workdir(self):
+        """ Jobs of executions in other working directories are queried there """
+        self.service.register(_monitor_jobs('job1'), 0)
+        other_workdir = _monitor_jobs('job2')
+        other_workdir['hpc.example.com']['workdir'] = 'other_workdir'
+        self.service.register(other_workdir, 0)
+        self.service.poll()
+
+        self.assertEqual(self.requester.request_host.call_count, 2)
+        self.assertEqual(sorted((call[0][1]['workdir'], call[0][1]['names'])
+                                for call in self.requester.request_host.call_args_list),
+                         [('other_workdir', ['job2']), ('workdir', ['job1'])])
+
+    def test_errors_reported_once_per_query(self):
+        """ The error of a query is only reported to an execution once """
+        self.requester.request_host.side_effect = HostUnavailableError('down')
+        self.service.register(_monitor_jobs('job1'), 0)
+        self.service.poll()
+
+        response = self.service.register(_monitor_jobs('job1'), 0)
+        self.assertEqual(response['errors']['hpc.example.com']['type'], 'HostUnavailableError')
+        response = self.service.register(_monitor_jobs('job1'), 0, seen=response['queries'])
+        self.assertEqual(response['errors'], {})
+
+    def test_lease(self):
+        """ Jobs not registered again are forgotten """
+        self.service.register(_monitor_jobs('job1'), 0)
+        with mock.patch('croupier_plugin.monitoring_service.time.time',
+                        return_value=datetime.now().timestamp() + MonitoringService.LEASE + 1):
+            self.service.poll()
+        self.requester.request_host.assert_not_called()
+        self.assertEqual(self.service._groups, {})
+
+    def test_client(self):
+        """ Executions get the states through the unix socket """
+        socket_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(socket_dir.cleanup)
+        socket_path = os.path.join(socket_dir.name, 'monitoring.sock')
+        server = self.service.serve(socket_path)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.assertEqual(os.stat(socket_path).st_mode & 0o777, 0o700)
+
+        client = MonitoringServiceClient(socket_path)
+        logger = logging.getLogger('TestMonitoringService')
+        states, _, errors = client.request(_monitor_jobs('job1'), datetime.now(), logger)
+        self.assertEqual((states, errors), ({}, {}))
+
+        self.service.poll()
+        states, _, errors = client.request(_monitor_jobs('job1'), datetime.now(), logger)
+        self.assertEqual(states, {'job1': 'RUNNING'})
+        self.assertEqual(errors, {'hpc.example.com': None})
+
+    def test_client_fallback(self):
+        """ Without service the executions query the clusters themselves """
+        client = MonitoringServiceClient('/nonexistent/monitoring.sock')
+        with mock.patch('croupier_plugin.monitoring_service.JobRequester') as requester:
+            requester.return_value.request.return_value = ({'job1': 'PENDING'}, {}, {})
+            states, _, _ = client.request(_monitor_jobs('job1'), datetime.now(), logging.getLogger())
+        self.assertEqual(states, {'job1': 'PENDING'})
+
+    def test_socket_of_other_user(self):
+        """ The credentials are not sent to a socket of another user """
+        socket_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(socket_dir.cleanup)
+        socket_path = os.path.join(socket_dir.name, 'monitoring.sock')
+        server = self.service.serve(socket_path)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        client = MonitoringServiceClient(socket_path)
+        with mock.patch('croupier_plugin.monitoring_service.os.getuid', return_value=os.getuid() + 1), \
+                mock.patch('croupier_plugin.monitoring_service.JobRequester') as requester, \
+                mock.patch.object(self.service, 'register') as register:
+            requester.return_value.request.return_value = ({}, {}, {})
+            client.request(_monitor_jobs('job1'), datetime.now(), logging.getLogger())
+        register.assert_not_called()
+        requester.return_value.request.assert_called_once()
+
+    def test_socket_path(self):
+        """ The socket is in a directory of the user, which is never shared """
+        with mock.patch.dict(os.environ, {'XDG_RUNTIME_DIR': '/run/user/1000'}):
+            self.assertEqual(default_socket_path(), '/run/user/1000/croupier/monitoring.sock')
+
+        socket_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(socket_dir.cleanup)
+        os.chmod(socket_dir.name, 0o777)
+        self.assertRaises(PermissionError, self.service.serve, os.path.join(socket_dir.name, 'monitoring.sock'))
+
+        os.chmod(socket_dir.name, 0o700)
+        not_a_socket = os.path.join(socket_dir.name, 'monitoring.sock')
+        open(not_a_socket, 'w').close()
+        self.assertRaises(PermissionError, self.service.serve, not_a_socket)
+        self.assertTrue(os.path.exists(not_a_socket))
+
+        new_dir = os.path.join(socket_dir.name, 'croupier')
+        server = self.service.serve(os.path.join(new_dir, 'monitoring.sock'))
+        server.shutdown()
+        server.server_close()
+        self.assertEqual(os.stat(new_dir).st_mode & 0o777, 0o700)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+pbspro_tests.py: Holds the PBS Pro unit tests
+"""
+
+import json
+import logging
+import unittest
+
+import mock
+
+from croupier_plugin.infrastructure_interfaces import infrastructure_interface, pbspro
+from croupier_plugin.ssh import CommandStream
+
+QSTAT_TEXT = """Job Id: 1.server
+    Job_Name = job1
+    job_state = R
+
+Job Id: 2.server
+    Job_Name = job2
+    Job_Owner = croupier@login
+    job_state = F
+    queue = workq
+    qtime = Tue Sep 22 13:20:00 2020
+    stime = Tue Sep 22 13:25:00 2020
+    mtime = Tue Sep 22 13:29:49 2020
+    resources_used.cpupercent = 98
+    resources_used.cput = 00:04:00
+    resources_used.mem = 1024kb
+    resources_used.ncpus = 4
+    resources_used.vmem = 2048kb
+    resources_used.walltime = 00:04:49
+    Resource_List.mpiprocs = 4
+    Exit_status = 0
+    Submit_arguments = -l walltime=00:10:00 job2.script
+"""
+
+QSTAT_JSON = json.dumps({
+    "timestamp": 1600781389,
+    "pbs_version": "19.1.3",
+    "pbs_server": "server",
+    "Jobs": {
+        "1.server": {"Job_Name": "job1", "job_state": "R"},
+        "2.server": {
+            "Job_Name": "job2",
+            "Job_Owner": "croupier@login",
+            "job_state": "F",
+            "queue": "workq",
+            "qtime": "Tue Sep 22 13:20:00 2020",
+            "stime": "Tue Sep 22 13:25:00 2020",
+            "mtime": "Tue Sep 22 13:29:49 2020",
+            "resources_used": {"cpupercent": 98, "cput": "00:04:00", "mem": "1024kb", "ncpus": 4,
+                               "vmem": "2048kb", "walltime": "00:04:49"},
+            "Resource_List": {"mpiprocs": 4},
+            "Exit_status": 0,
+            "Submit_arguments": "-l walltime=00:10:00 job2.script"}}}, indent=4)
+
+
+class FakePbsClient(object):
+    """ Answers qstat calls with the outputs of a PBS Pro version """
+
+    def __init__(self, version, json_output=QSTAT_JSON, text_output=QSTAT_TEXT):
+        self.version = version
+        self.json_output = json_output
+        self.text_output = text_output
+        self.calls = []
+
+    def execute_shell_command(self, cmd, workdir=None, env=None, wait_result=False):
+        self.calls.append(cmd.split('; ')[-1])
+        return "pbs_version = " + self.version + "\n", 0
+
+    def stream_shell_command(self, cmd, workdir=None, env=None, timeout=None):
+        self.calls.append(cmd.split('; ')[-1])
+        if '-F json' in cmd:
+            return CommandStream.from_output(self.json_output, 0)
+        return CommandStream.from_output(self.text_output, 0)
+
+
+class TestPbsproJson(unittest.TestCase):
+    """ Holds the qstat output parsing tests """
+
+    CREDENTIALS = {'host': 'hpc.example.com', 'user': 'croupier'}
+    JOB_IDS = {'job1': '1.server', 'job2': '2.server'}
+
+    def setUp(self):
+        infrastructure_interface._finished_jobs.clear()
+        self.addCleanup(infrastructure_interface._finished_jobs.clear)
+        pbspro._json_support.clear()
+        self.addCleanup(pbspro._json_support.clear)
+        self.wm = pbspro.Pbspro('PBSPRO', logging.getLogger('TestPbspro'), 'workdir')
+
+    def _get_states(self, client):
+        with mock.patch('croupier_plugin.infrastructure_interfaces.pbspro.SshConnectionPool') as pool:
+            pool.return_value.connection.return_value.__enter__.return_value = client
+            return self.wm.get_states(self.CREDENTIALS, sorted(self.JOB_IDS), job_ids=self.JOB_IDS)
+
+    def test_same_result(self):
+        """ JSON and text outputs are parsed the same """
+        self.assertEqual(pbspro.Pbspro._parse_qstat_json(QSTAT_JSON),
+                         pbspro.Pbspro._parse_qstat_detailed(QSTAT_TEXT))
+        states, audits = pbspro.Pbspro._parse_qstat_json(QSTAT_JSON)
+        self.assertDictEqual(states, {'job1': 'RUNNING', 'job2': 'COMPLETED'})
+        self.assertEqual(audits['job2']['walltime'], 289)
+
+    def test_json_jobs_streamed(self):
+        """ Jobs are decoded as their lines arrive, in any layout """
+        lines = QSTAT_JSON.splitlines()
+        read = []
+
+        def stream():
+            for line in lines:
+                read.append(line)
+                yield line
+        jobs = pbspro._iter_qstat_json_jobs(stream())
+        self.assertEqual(next(jobs), ('1.server', {'Job_Name': 'job1', 'job_state': 'R'}))
+        self.assertLess(len(read), len(lines) // 2)
+        self.assertEqual([job_id for job_id, _ in jobs], ['2.server'])
+
+        chunks = [QSTAT_JSON[index:index + 7] for index in range(0, len(QSTAT_JSON), 7)]
+        self.assertEqual([job_id for job_id, _ in pbspro._iter_qstat_json_jobs(chunks)], ['1.server', '2.server'])
+        self.assertEqual(pbspro.Pbspro._parse_qstat_json(json.dumps(json.loads(QSTAT_JSON))),
+                         pbspro.Pbspro._parse_qstat_json(QSTAT_JSON))
+        self.assertEqual(pbspro.Pbspro._parse_qstat_json('{"timestamp": 1600781389, "pbs_version": "19.1.3"}'),
+                         ({}, {}))
+        self.assertEqual(pbspro.Pbspro._parse_qstat_json(''), ({}, {}))
+        self.assertRaises(ValueError, pbspro.Pbspro._parse_qstat_json, QSTAT_JSON[:-20])
+        self.assertRaises(ValueError, pbspro.Pbspro._parse_qstat_json, '{"timestamp": ')
+
+    def test_version(self):
+        """ Version of `qstat --version` outputs """
+        self.assertEqual(pbspro._parse_pbs_version("pbs_version = 19.1.3\n"), (19, 1, 3))
+        self.assertEqual(pbspro._parse_pbs_version("qstat: unrecognized option\n"), ())
+
+    def test_json_output(self):
+        """ PBS Pro 19+ is asked for JSON, its version only once """
+        client = FakePbsClient('19.1.3')
+        states, _ = self._get_states(client)
+        self.assertDictEqual(states, {'job1': 'RUNNING', 'job2': 'COMPLETED'})
+        self.assertEqual(client.calls, ["qstat --version", "qstat -x -f -F json 1.server 2.server"])
+
+        client.calls = []
+        self._get_states(client)
+        self.assertEqual(client.calls, ["qstat -x -f -F json 1.server"])
+
+    def test_old_version(self):
+        """ Older versions are asked for text """
+        client = FakePbsClient('18.1.4')
+        states, _ = self._get_states(client)
+        self.assertDictEqual(states, {'job1': 'RUNNING', 'job2': 'COMPLETED'})
+        self.assertEqual(client.calls, ["qstat --version", "qstat -x -f 1.server 2.server"])
+
+    def test_invalid_json(self):
+        """ Text output is used when the JSON one is broken """
+        client = FakePbsClient('19.1.3', json_output='{"Jobs": {"1.server": {"Job_Name": "job1\n')
+        states, _ = self._get_states(client)
+        self.assertDictEqual(states, {'job1': 'RUNNING', 'job2': 'COMPLETED'})
+        self.assertEqual(client.calls, ["qstat --version", "qstat -x -f -F json 1.server 2.server",
+                                        "qstat -x -f 1.server 2.server"])
+        self.assertFalse(pbspro._json_support['hpc.example.com'])
+
+
+class TestPbsproDependencies(unittest.TestCase):
+    """ Holds the chained submission tests """
+
+    def test_dependencies(self):
+        """ The job is held until the jobs given end successfully """
+        wm = pbspro.Pbspro('PBSPRO', logging.getLogger('TestPbspro'), 'workdir')
+        response = wm._build_job_submission_call('test', {'script': 'cmd', 'dependencies': ['1.server', '2.server']},
+                                                 None, None)
+        self.assertTrue(response['call'].endswith(" -W depend=afterok:1.server:2.server cmd; "))
+
+
+class TestPbsproArrays(unittest.TestCase):
+    """ Holds the job array tests """
+
+    def setUp(self):
+        infrastructure_interface._finished_jobs.clear()
+        self.addCleanup(infrastructure_interface._finished_jobs.clear)
+        pbspro._json_support.clear()
+        self.addCleanup(pbspro._json_support.clear)
+        self.wm = pbspro.Pbspro('PBSPRO', logging.getLogger('TestPbspro'), 'workdir')
+
+    def test_subjobs(self):
+        """ Every subjob of an array is monitored on its own """
+        job_ids = dict(zip(['job0', 'job1'], self.wm.get_array_task_ids('5[].server', 2)))
+        self.assertEqual(job_ids, {'job0': '5[0].server', 'job1': '5[1].server'})
+        client = FakePbsClient('18.1.4', text_output="Job Id: 5[0].server\n    Job_Name = job0\n    job_state = R\n\n"
+                                                     "Job Id: 5[1].server\n    Job_Name = job0\n    job_state = Q\n")
+        with mock.patch('croupier_plugin.infrastructure_interfaces.pbspro.SshConnectionPool') as pool:
+            pool.return_value.connection.return_value.__enter__.return_value = client
+            states, _ = self.wm.get_states({'host': 'hpc.example.com'}, sorted(job_ids), job_ids=job_ids)
+        self.assertDictEqual(states, {'job0': 'RUNNING', 'job1': 'PENDING'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+poll_scheduler_tests.py: Holds the poll scheduler unit tests
+"""
+
+import unittest
+
+from croupier_plugin.poll_scheduler import PollScheduler, max_time_to_seconds
+
+
+class TestPollScheduler(unittest.TestCase):
+    """ Holds the poll scheduler tests """
+
+    def setUp(self):
+        self.scheduler = PollScheduler()
+
+    def test_deadlines(self):
+        """ Jobs are due in deadline order, rescheduling replaces the deadline """
+        self.scheduler.schedule('job1', 10)
+        self.scheduler.schedule('job2', 5)
+        self.scheduler.schedule('job3', 20)
+        self.scheduler.schedule('job1', 30)
+
+        self.assertEqual(self.scheduler.next_deadline(), 5)
+        self.assertEqual(self.scheduler.pop_due(15), ['job2'])
+        self.assertEqual(self.scheduler.next_deadline(), 20)
+        self.assertEqual(self.scheduler.pop_due(30), ['job3', 'job1'])
+        self.assertIsNone(self.scheduler.next_deadline())
+
+    def test_removed_job(self):
+        """ Removed jobs are never due """
+        self.scheduler.schedule('job1', 10)
+        self.scheduler.remove('job1')
+        self.assertFalse(self.scheduler.is_scheduled('job1'))
+        self.assertEqual(self.scheduler.pop_due(20), [])
+
+    def test_waiting_jobs_back_off(self):
+        """ Waiting jobs are polled less often the longer they wait """
+        intervals = [self.scheduler.next_interval('job1', 'PENDING', 10) for _ in range(10)]
+        self.assertEqual(intervals[0], 10)
+        self.assertEqual(intervals, sorted(intervals))
+        self.assertEqual(intervals[-1], PollScheduler.MAX_WAITING_INTERVAL)
+        # and back to the period once running
+        self.assertEqual(self.scheduler.next_interval('job1', 'RUNNING', 10), 10)
+        self.assertEqual(self.scheduler.next_interval('job1', 'PENDING', 10), 10)
+
+    def test_running_jobs_near_time_limit(self):
+        """ Running jobs are polled more often close to their time limit """
+        self.assertEqual(self.scheduler.next_interval('job1', 'RUNNING', 60, remaining_time=3600), 60)
+        self.assertEqual(self.scheduler.next_interval('job1', 'RUNNING', 60, remaining_time=20), 10)
+        self.assertEqual(self.scheduler.next_interval('job1', 'RUNNING', 60, remaining_time=-5),
+                         PollScheduler.MIN_INTERVAL)
+        self.assertEqual(self.scheduler.next_interval('job1', 'COMPLETING', 60), PollScheduler.FINISHING_INTERVAL)
+
+    def test_latency(self):
+        """ Slow schedulers are not polled faster than they answer """
+        self.assertEqual(self.scheduler.next_interval('job1', 'RUNNING', 10, latency=5),
+                         5 * PollScheduler.LATENCY_FACTOR)
+
+    def test_max_time(self):
+        """ Slurm and Torque time limits """
+        self.assertEqual(max_time_to_seconds('30'), 1800)
+        self.assertEqual(max_time_to_seconds('05:30'), 330)
+        self.assertEqual(max_time_to_seconds('01:00:00'), 3600)
+        self.assertEqual(max_time_to_seconds('1-02'), 93600)
+        self.assertEqual(max_time_to_seconds('1-00:30'), 88200)
+        self.assertEqual(max_time_to_seconds('1-00:00:10'), 86410)
+        self.assertIsNone(max_time_to_seconds('UNLIMITED'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+prometheus_monitor_tests.py: Holds the Prometheus monitor unit tests
+"""
+
+import re
+import unittest
+
+import mock
+
+from croupier_plugin.prometheus_monitor import PrometheusMonitor, _regex_matcher
+
+
+def _result(metric, value):
+    return {'metric': metric, 'value': [1600781389.0, value]}
+
+
+class TestPrometheusMonitor(unittest.TestCase):
+    """ Holds the Prometheus monitor tests """
+
+    def setUp(self):
+        self.monitor = PrometheusMonitor()
+        self.session = mock.Mock()
+        self.monitor._session = self.session
+        self.responses = []
+
+        def post(url, data=None, timeout=None):
+            response = mock.Mock()
+            response.json.return_value = {'status': 'success', 'data': {'result': self.responses.pop(0)}}
+            return response
+        self.session.post.side_effect = post
+
+    def test_states_and_audits(self):
+        """ One query for the states of every host, one for the audits of the ended jobs """
+        self.responses = [
+            [_result({'__name__': 'job_status', 'job': 'hpc1', 'name': 'job1'}, '10'),
+             _result({'__name__': 'job_status', 'job': 'hpc2', 'name': 'job2'}, '2')],
+            [_result({'__name__': 'job_walltime_used', 'job': 'hpc2', 'name': 'job2'}, '120'),
+             _result({'__name__': 'job_exit_code', 'job': 'hpc2', 'name': 'job2'}, '0')]]
+
+        states, audits = self.monitor.get_states('http://prometheus:9090/', {'hpc1': ['job1'], 'hpc2': ['job2']})
+        self.assertDictEqual(states, {'job1': 'RUNNING', 'job2': 'COMPLETED'})
+        self.assertDictEqual(audits, {'job2': {'walltime_used': '120', 'exit_code': '0'}})
+
+        (status_call, audit_call) = self.session.post.call_args_list
+        self.assertEqual(status_call[0][0], 'http://prometheus:9090/api/v1/query')
+        self.assertEqual(status_call[1]['data']['query'], 'job_status{job=~"hpc1|hpc2",name=~"job1|job2"}')
+        self.assertIn('name=~"job2"', audit_call[1]['data']['query'])
+        self.assertEqual(status_call[1]['timeout'], PrometheusMonitor.TIMEOUT)
+
+    def test_other_host_series(self):
+        """ Series of a job name on another host are not taken as the job's """
+        self.responses = [
+            [_result({'__name__': 'job_status', 'job': 'hpc2', 'name': 'job1'}, '2'),
+             _result({'__name__': 'job_status', 'job': 'hpc1', 'name': 'job1'}, '10'),
+             _result({'__name__': 'job_status', 'job': 'hpc2', 'name': 'job2'}, '2')],
+            [_result({'__name__': 'job_exit_code', 'job': 'hpc1', 'name': 'job2'}, '1'),
+             _result({'__name__': 'job_exit_code', 'job': 'hpc2', 'name': 'job2'}, '0')]]
+
+        states, audits = self.monitor.get_states('http://prometheus:9090', {'hpc1': ['job1'], 'hpc2': ['job2']})
+        self.assertDictEqual(states, {'job1': 'RUNNING', 'job2': 'COMPLETED'})
+        self.assertDictEqual(audits, {'job2': {'exit_code': '0'}})
+
+    def test_no_ended_jobs(self):
+        """ Audits are not asked for while the jobs run """
+        self.responses = [[_result({'__name__': 'job_status', 'job': 'hpc1', 'name': 'job1'}, '7')]]
+
+        states, audits = self.monitor.get_states('http://prometheus:9090', {'hpc1': ['job1']})
+        self.assertDictEqual(states, {'job1': 'PENDING'})
+        self.assertDictEqual(audits, {})
+        self.assertEqual(self.session.post.call_count, 1)
+
+    def test_regex_matcher(self):
+        """ Names are matched literally and quoted for PromQL """
+        matcher = _regex_matcher(['hpc.example.com', 'job"1'])
+        regex = matcher[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+        self.assertTrue(re.fullmatch(regex, 'hpc.example.com'))
+        self.assertTrue(re.fullmatch(regex, 'job"1'))
+        self.assertFalse(re.fullmatch(regex, 'hpcXexample.com'))
+
+    def test_failed_query(self):
+        """ Prometheus errors are raised """
+        self.session.post.side_effect = None
+        self.session.post.return_value.json.return_value = {'status': 'error', 'error': 'parse error'}
+        self.assertRaises(RuntimeError, self.monitor.get_states, 'http://prometheus:9090', {'hpc1': ['job1']})
+
+
+if __name__ == '__main__':
+    unittest.main()
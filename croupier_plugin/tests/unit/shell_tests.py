@@ -0,0 +1,112 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+shell_tests.py: Holds the Shell interface unit tests
+"""
+
+import logging
+import os
+import subprocess
+import tempfile
+import unittest
+
+import mock
+
+from croupier_plugin.infrastructure_interfaces import shell
+from croupier_plugin.ssh import CommandStream
+
+
+class LocalShellClient(object):
+    """ Runs the commands in a local shell """
+
+    def __init__(self):
+        self.outputs = []
+
+    def stream_shell_command(self, cmd, workdir=None, env=None, timeout=None):
+        process = subprocess.run(['bash', '-c', cmd], cwd=workdir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.outputs.append(process.stdout.decode('utf-8'))
+        return CommandStream.from_output(process.stdout.decode('utf-8'), process.returncode)
+
+
+class TestShellMonitor(unittest.TestCase):
+    """ Holds the croupier-monitor.dat tailing tests """
+
+    CREDENTIALS = {'host': 'localhost', 'user': 'croupier'}
+
+    def setUp(self):
+        shell._monitor_files.clear()
+        self.addCleanup(shell._monitor_files.clear)
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.monitor_file = os.path.join(workdir.name, 'croupier-monitor.dat')
+        self.wm = shell.Shell('SHELL', logging.getLogger('TestShell'), workdir.name)
+        self.client = LocalShellClient()
+
+    def _append(self, text):
+        with open(self.monitor_file, 'a') as monitor_file:
+            monitor_file.write(text)
+
+    def _get_states(self, job_names):
+        with mock.patch('croupier_plugin.infrastructure_interfaces.shell.SshConnectionPool') as pool:
+            pool.return_value.connection.return_value.__enter__.return_value = self.client
+            states, _ = self.wm.get_states(self.CREDENTIALS, job_names)
+        return states
+
+    def test_no_file(self):
+        """ No job has ended yet """
+        self.assertDictEqual(self._get_states(['job1']), {})
+
+    def test_new_lines_only(self):
+        """ Only the lines appended since the last call are fetched """
+        self._append("job1,0\njob2,1\n")
+        self.assertDictEqual(self._get_states(['job1', 'job2', 'job3']), {'job1': 'COMPLETED', 'job2': 'FAILED'})
+
+        self._append("job3,0\njob4,")  # job4 is being written
+        self.assertDictEqual(self._get_states(['job1', 'job2', 'job3', 'job4']),
+                             {'job1': 'COMPLETED', 'job2': 'FAILED', 'job3': 'COMPLETED'})
+        self.assertTrue(self.client.outputs[-1].endswith("\njob3,0\njob4,"))
+        self.assertNotIn("job1", self.client.outputs[-1])
+
+        self._append("130\n")
+        self.assertDictEqual(self._get_states(['job4']), {'job4': 'CANCELLED'})
+        self.assertTrue(self.client.outputs[-1].endswith("\njob4,130\n"))
+
+    def test_truncation(self):
+        """ A truncated file is read from the beginning, keeping the states known """
+        self._append("job1,0\njob2,1\n")
+        self._get_states(['job1', 'job2'])
+
+        with open(self.monitor_file, 'w') as monitor_file:
+            monitor_file.write("job3,0\n")
+        self.assertDictEqual(self._get_states(['job1', 'job2', 'job3']),
+                             {'job1': 'COMPLETED', 'job2': 'FAILED', 'job3': 'COMPLETED'})
+
+    def test_rotation(self):
+        """ A replaced file is read from the beginning """
+        self._append("job1,0\njob2,1\n")
+        self._get_states(['job1', 'job2'])
+
+        os.rename(self.monitor_file, self.monitor_file + '.1')
+        self._append("job3,127\njob4,0\njob5,0\n")  # longer than the offset read
+        self.assertDictEqual(self._get_states(['job3', 'job4', 'job5']),
+                             {'job3': 'BOOT_FAIL', 'job4': 'COMPLETED', 'job5': 'COMPLETED'})
+
+
+if __name__ == '__main__':
+    unittest.main()
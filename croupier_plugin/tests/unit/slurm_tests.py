@@ -28,8 +28,12 @@ from builtins import range
 import logging
 import unittest
 
+import mock
+
 from croupier_plugin.infrastructure_interfaces.infrastructure_interface import (
     InfrastructureInterface)
+from croupier_plugin.infrastructure_interfaces import infrastructure_interface, slurm
+from croupier_plugin.ssh import CommandStream
 
 
 class TestSlurm(unittest.TestCase):
@@ -162,5 +166,181 @@ class TestSlurm(unittest.TestCase):
         self.assertDictEqual(parsed, {})
 
 
+class TestSlurmSacct(unittest.TestCase):
+    """ Holds the sacct parsing tests """
+
+    SACCT = ("job1|RUNNING|100|job1|user|batch|0:0|2021-01-01T10:00:00|2021-01-01T10:01:00|Unknown|01:00:00|60|2\n"
+             "job2|COMPLETED|101|job2|user|batch|0:0|2021-01-01T10:00:00|2021-01-01T10:01:00|"
+             "2021-01-01T10:02:00|01:00:00|120|4\n"
+             "job3|COMPLETED|102|job3|user|batch|0:0|2021-01-01T10:00:00|2021-01-01T10:01:00|"
+             "2021-01-01T10:02:00|01:00:00|120|4\n"
+             "job3|CANCELLED by 500|103|job3|user|batch|0:15|2021-01-01T11:00:00|Unknown|Unknown|01:00:00|0|4\n")
+
+    def test_states_and_audits(self):
+        """ States of every job, audits of the finished ones """
+        states, audits = slurm._parse_sacct(self.SACCT.splitlines(True), logging.getLogger('TestSlurm'))
+
+        self.assertDictEqual(states, {'job1': 'RUNNING', 'job2': 'COMPLETED', 'job3': 'CANCELLED'})
+        self.assertEqual(sorted(audits), ['job2', 'job3'])
+        self.assertEqual(audits['job2']['job_id'], '101')
+        self.assertEqual(audits['job2']['cput'], 120)
+        self.assertEqual(audits['job2']['walltime'], 3600)
+        # audit of the entry whose state prevails
+        self.assertEqual(audits['job3']['job_id'], '103')
+        self.assertEqual(audits['job3']['exit_status'], '0')
+
+    def test_two_columns(self):
+        """ JobName and State only entries, no audits """
+        states, audits = slurm._parse_sacct("job1|RUNNING\njob2|PENDING\n", None)
+
+        self.assertDictEqual(states, {'job1': 'RUNNING', 'job2': 'PENDING'})
+        self.assertDictEqual(audits, {})
+
+
+class FakeSlurmClient(object):
+    """ Answers squeue and sacct calls from a table of jobs """
+
+    def __init__(self, queue, accounting):
+        self.queue = queue
+        self.accounting = accounting
+        self.calls = []
+
+    def stream_shell_command(self, cmd, workdir=None, env=None, timeout=None):
+        self.calls.append(cmd)
+        ids = cmd.split(' -j ')[1].split(',')
+        if cmd.startswith('squeue'):
+            lines = [job_id + '|' + self.queue[job_id] for job_id in ids if job_id in self.queue]
+            return CommandStream.from_output(''.join(line + '\n' for line in lines), 0 if lines else 1)
+        lines = [self.accounting[job_id] for job_id in ids if job_id in self.accounting]
+        return CommandStream.from_output(''.join(line + '\n' for line in lines), 0)
+
+
+class TestSlurmJobIds(unittest.TestCase):
+    """ Holds the monitoring by job id tests """
+
+    CREDENTIALS = {'host': 'hpc.example.com', 'user': 'croupier'}
+
+    def setUp(self):
+        infrastructure_interface._finished_jobs.clear()
+        self.addCleanup(infrastructure_interface._finished_jobs.clear)
+        self.wm = slurm.Slurm('SLURM', logging.getLogger('TestSlurm'), 'workdir')
+
+    def _get_states(self, client, job_ids):
+        with mock.patch('croupier_plugin.infrastructure_interfaces.slurm.SshConnectionPool') as pool:
+            pool.return_value.connection.return_value.__enter__.return_value = client
+            return self.wm.get_states(self.CREDENTIALS, sorted(job_ids), job_ids=job_ids)
+
+    def test_queued_and_finished_jobs(self):
+        """ Queued jobs come from squeue, the rest from sacct, and finished ones are cached """
+        client = FakeSlurmClient(
+            queue={'1': 'RUNNING', '2': 'COMPLETED'},
+            accounting={
+                '2': "2|COMPLETED|2|job2|user|batch|0:0|2021-01-01T10:00:00|2021-01-01T10:01:00|"
+                     "2021-01-01T10:02:00|01:00:00|120|4",
+                '3': "3|FAILED|3|job3|user|batch|1:0|2021-01-01T10:00:00|2021-01-01T10:01:00|"
+                     "2021-01-01T10:02:00|01:00:00|60|4"})
+        job_ids = {'job1': '1', 'job2': '2', 'job3': '3;cluster'}
+
+        states, audits = self._get_states(client, job_ids)
+        self.assertDictEqual(states, {'job1': 'RUNNING', 'job2': 'COMPLETED', 'job3': 'FAILED'})
+        self.assertEqual(sorted(audits), ['job2', 'job3'])
+        self.assertEqual(client.calls, ["squeue -h -r -o '%i|%T' -j 1,2,3",
+                                        "sacct -n -o JobID,State," + slurm.AUDIT_FIELDS + " -X -P -j 2,3"])
+
+        client.calls = []
+        states, audits = self._get_states(client, job_ids)
+        self.assertDictEqual(states, {'job1': 'RUNNING', 'job2': 'COMPLETED', 'job3': 'FAILED'})
+        self.assertEqual(sorted(audits), ['job2', 'job3'])
+        self.assertEqual(client.calls, ["squeue -h -r -o '%i|%T' -j 1"])
+
+    def test_chunks(self):
+        """ Long job id lists are split in several calls """
+        job_ids = {'job' + str(index): str(index) for index in range(infrastructure_interface.JOB_IDS_CHUNK_SIZE + 1)}
+        client = FakeSlurmClient(queue={job_id: 'PENDING' for job_id in job_ids.values()}, accounting={})
+
+        states, _ = self._get_states(client, job_ids)
+        self.assertEqual(len(states), len(job_ids))
+        self.assertEqual(len(client.calls), 2)
+
+
+class TestSlurmChainsAndArrays(unittest.TestCase):
+    """ Holds the chained submission and job array tests """
+
+    def setUp(self):
+        self.wm = slurm.Slurm('SLURM', logging.getLogger('TestSlurm'), 'workdir')
+
+    def test_dependencies(self):
+        """ The job is held until the jobs given end successfully """
+        response = self.wm._build_job_submission_call('test', {'script': 'cmd', 'dependencies': ['12', '13']},
+                                                      None, None)
+        self.assertEqual(response['call'],
+                         "sbatch --parsable -J 'test' -e test.err -o test.out --dependency=afterok:12:13 cmd; ")
+
+        response = self.wm._build_job_submission_call('test', {'script': 'cmd', 'dependencies': []}, None, None)
+        self.assertNotIn('--dependency', response['call'])
+
+    def test_array_task_ids(self):
+        """ Array tasks are monitored by their own id """
+        self.assertEqual(self.wm.get_array_task_ids('12', 2), ['12_0', '12_1'])
+        self.assertEqual(self.wm.get_array_task_ids('12;cluster', 2), ['12_0;cluster', '12_1;cluster'])
+
+
+class FakePackClient(FakeSlurmClient):
+    """ Answers the status files of the packs as well """
+
+    def __init__(self, queue, accounting, status):
+        super(FakePackClient, self).__init__(queue, accounting)
+        self.status = status
+
+    def stream_shell_command(self, cmd, workdir=None, env=None, timeout=None):
+        if cmd.startswith('cat '):
+            self.calls.append(cmd)
+            return CommandStream.from_output(self.status, 0)
+        return super(FakePackClient, self).stream_shell_command(cmd, workdir, env, timeout)
+
+
+class TestSlurmPacks(unittest.TestCase):
+    """ Holds the tests of the jobs packed in a batch job """
+
+    CREDENTIALS = {'host': 'hpc.example.com', 'user': 'croupier'}
+
+    def setUp(self):
+        infrastructure_interface._finished_jobs.clear()
+        self.addCleanup(infrastructure_interface._finished_jobs.clear)
+        self.wm = slurm.Slurm('SLURM', logging.getLogger('TestSlurm'), 'workdir')
+
+    def test_pack_scripts(self):
+        """ The batch script runs the job scripts one after another, in their total time """
+        scripts = self.wm._build_pack_scripts('job1_pack', {
+            'partition': 'short',
+            'packed_jobs': [{'name': 'job1', 'job_options': {'commands': ['hostname'], 'max_time': '00:01:00'}},
+                            {'name': 'job2', 'job_options': {'commands': ['date'], 'max_time': '00:05:00'}}]},
+            None)
+        self.assertEqual([name for name, _ in scripts], ['job1_pack.script', 'job1.script', 'job2.script'])
+        script = scripts[0][1]
+        self.assertIn('#SBATCH -t 00:06:00\n', script)
+        self.assertIn('#SBATCH -p short\n', script)
+        self.assertIn('echo "$1 $?" >> job1_pack.status\n', script)
+        self.assertTrue(script.endswith('croupier_run job1\ncroupier_run job2\n'))
+        self.assertIn('hostname\n', scripts[1][1])
+
+    def test_packed_states(self):
+        """ Packed jobs run with their batch job, and end with their exit code """
+        client = FakePackClient(queue={'7': 'RUNNING'}, accounting={}, status="job1 0\njob2 3\n")
+        packs = {'job1': 'job1_pack', 'job2': 'job1_pack', 'job3': 'job1_pack'}
+        job_ids = {'job1': '7', 'job2': '7', 'job3': '7', 'job4': '8'}
+        with mock.patch('croupier_plugin.infrastructure_interfaces.slurm.SshConnectionPool') as pool, \
+                mock.patch('croupier_plugin.infrastructure_interfaces.infrastructure_interface.SshConnectionPool') \
+                as packs_pool:
+            pool.return_value.connection.return_value.__enter__.return_value = client
+            packs_pool.return_value.connection.return_value.__enter__.return_value = client
+            states, audits = self.wm.get_packed_states(self.CREDENTIALS, ['job1', 'job2', 'job3', 'job4'], job_ids,
+                                                       packs)
+        self.assertDictEqual(states, {'job1': 'COMPLETED', 'job2': 'FAILED', 'job3': 'RUNNING'})
+        self.assertEqual(audits['job2']['exit_status'], '3')
+        self.assertEqual(client.calls, ["squeue -h -r -o '%i|%T' -j 8,7", "sacct -n -o JobID,State," +
+                                        slurm.AUDIT_FIELDS + " -X -P -j 8", "cat job1_pack.status 2> /dev/null"])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,618 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+ssh_tests.py: Holds the SSH layer unit tests
+"""
+
+import asyncio
+import io
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+from paramiko import ECDSAKey, Ed25519Key, RSAKey
+
+from croupier_plugin import ssh
+from croupier_plugin.ssh import AsyncSshClient, CircuitBreaker, CommandStream, HostUnavailableError, ShellSession, \
+    SshClient, SshConnectionPool, SshForward
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def send_ignore(self):
+        pass
+
+
+class FakeSshClient(object):
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_transport(self):
+        return self.transport
+
+    def close_connection(self):
+        self.closed = True
+
+    def execute_shell_command(self, cmd, workdir=None, env=None, wait_result=False):
+        return self.credentials['host'] + ': ' + cmd, 0
+
+
+CREDENTIALS = {'host': 'hpc.example.com', 'user': 'croupier', 'password': 'secret'}
+
+
+class TestSshConnectionPool(unittest.TestCase):
+    """ Holds the SSH connection pool tests """
+
+    def setUp(self):
+        patcher = mock.patch('croupier_plugin.ssh.SshClient', FakeSshClient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = SshConnectionPool()
+        self.addCleanup(self.pool.close_all)
+
+    def test_reuses_idle_connection(self):
+        """ A returned connection is handed out again """
+        first = self.pool.checkout(CREDENTIALS)
+        self.pool.checkin(first)
+        second = self.pool.checkout(CREDENTIALS)
+        self.assertIs(first, second)
+        self.pool.checkin(second)
+
+    def test_concurrent_checkouts_get_different_connections(self):
+        """ A checked out connection is never shared """
+        first = self.pool.checkout(CREDENTIALS)
+        second = self.pool.checkout(CREDENTIALS)
+        self.assertIsNot(first, second)
+        self.pool.checkin(first)
+        self.pool.checkin(second)
+
+    def test_broken_connection_is_discarded(self):
+        """ Dead transports are closed instead of reused """
+        first = self.pool.checkout(CREDENTIALS)
+        self.pool.checkin(first)
+        first.transport.active = False
+        second = self.pool.checkout(CREDENTIALS)
+        self.assertIsNot(first, second)
+        self.assertTrue(first.closed)
+        self.pool.checkin(second)
+
+    def test_idle_connections_are_evicted(self):
+        """ Connections idle for too long are closed """
+        ssh_client = self.pool.checkout(CREDENTIALS)
+        with mock.patch('croupier_plugin.ssh.time.time', return_value=0):
+            self.pool.checkin(ssh_client)
+        self.pool._evict_idle()
+        self.assertTrue(ssh_client.closed)
+
+    def test_connection_key(self):
+        """ Different users, tunnels or secrets do not share connections """
+        key = SshConnectionPool.connection_key(CREDENTIALS)
+        self.assertEqual(key, SshConnectionPool.connection_key(dict(CREDENTIALS)))
+        self.assertNotEqual(key, SshConnectionPool.connection_key(dict(CREDENTIALS, user='other')))
+        self.assertNotEqual(key, SshConnectionPool.connection_key(dict(CREDENTIALS, password='rotated')))
+        self.assertNotEqual(key, SshConnectionPool.connection_key(dict(CREDENTIALS, tunnel=dict(CREDENTIALS))))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """ Holds the per host circuit breaker tests """
+
+    def setUp(self):
+        patcher = mock.patch('croupier_plugin.ssh.random.uniform', lambda low, high: high)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker('hpc.example.com')
+
+    def test_opens_after_consecutive_failures(self):
+        """ Calls fail fast once the failure threshold is reached """
+        self.breaker.record_failure()
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(HostUnavailableError, self.breaker.before_call)
+
+    def test_half_open_probe(self):
+        """ A single probe is let through after the backoff """
+        for _ in range(CircuitBreaker.FAILURE_THRESHOLD):
+            self.breaker.record_failure()
+        with mock.patch('croupier_plugin.ssh.time.time', return_value=self.breaker.retry_at):
+            self.breaker.before_call()
+            self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+            self.assertRaises(HostUnavailableError, self.breaker.before_call)
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.before_call()
+
+    def test_backoff_grows(self):
+        """ A failed probe opens the circuit again for longer """
+        with mock.patch('croupier_plugin.ssh.time.time', return_value=0):
+            for _ in range(CircuitBreaker.FAILURE_THRESHOLD):
+                self.breaker.record_failure()
+            first_backoff = self.breaker.retry_at
+            self.breaker.state = CircuitBreaker.HALF_OPEN
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.retry_at, 2 * first_backoff)
+
+    def test_pool_fails_fast(self):
+        """ The pool does not connect to a host whose circuit is open """
+        host = 'down.example.com'
+        self.addCleanup(CircuitBreaker._breakers.pop, host, None)
+        with mock.patch('croupier_plugin.ssh.SshClient', side_effect=socket.timeout('timed out')) as ssh_client:
+            pool = SshConnectionPool()
+            for _ in range(CircuitBreaker.FAILURE_THRESHOLD):
+                self.assertRaises(socket.timeout, pool.checkout, dict(CREDENTIALS, host=host))
+            self.assertRaises(HostUnavailableError, pool.checkout, dict(CREDENTIALS, host=host))
+        self.assertEqual(ssh_client.call_count, CircuitBreaker.FAILURE_THRESHOLD)
+
+    def test_command_timeouts_open_the_circuit(self):
+        """ A host that accepts connections but whose commands time out is opened """
+        host = 'hangs.example.com'
+        self.addCleanup(CircuitBreaker._breakers.pop, host, None)
+        with mock.patch('croupier_plugin.ssh.SshClient') as ssh_client:
+            pool = SshConnectionPool()
+            for _ in range(CircuitBreaker.FAILURE_THRESHOLD):
+                with self.assertRaises(socket.timeout):
+                    with pool.connection(dict(CREDENTIALS, host=host)):
+                        raise socket.timeout("Command cancelled after 300 seconds")
+            self.assertEqual(CircuitBreaker.for_host(host).state, CircuitBreaker.OPEN)
+            self.assertRaises(HostUnavailableError, pool.checkout, dict(CREDENTIALS, host=host))
+        self.assertEqual(ssh_client.call_count, CircuitBreaker.FAILURE_THRESHOLD)
+
+    def _open_circuit(self, host):
+        breaker = CircuitBreaker.for_host(host)
+        self.addCleanup(CircuitBreaker._breakers.pop, host, None)
+        for _ in range(CircuitBreaker.FAILURE_THRESHOLD):
+            breaker.record_failure()
+        breaker.retry_at = 0
+        return breaker
+
+    def test_bare_checkout_probe(self):
+        """ A probe checked out and in by hand closes the circuit """
+        host = 'probed.example.com'
+        breaker = self._open_circuit(host)
+        with mock.patch('croupier_plugin.ssh.SshClient'):
+            pool = SshConnectionPool()
+            ssh_client = pool.checkout(dict(CREDENTIALS, host=host))
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+            pool.checkin(ssh_client)
+            self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+            pool.checkin(pool.checkout(dict(CREDENTIALS, host=host)), discard=True)
+
+    def test_probe_raising_other_errors(self):
+        """ A probe whose body fails for other reasons than the host closes the circuit """
+        host = 'probed.example.com'
+        breaker = self._open_circuit(host)
+        with mock.patch('croupier_plugin.ssh.SshClient'):
+            with self.assertRaises(ValueError):
+                with SshConnectionPool().connection(dict(CREDENTIALS, host=host)):
+                    raise ValueError("unexpected output")
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.before_call()
+
+    def test_lost_probe(self):
+        """ Another probe is let through once the first one is given up """
+        self.breaker.state = CircuitBreaker.OPEN
+        with mock.patch('croupier_plugin.ssh.time.time', return_value=0):
+            self.breaker.before_call()
+            self.assertRaises(HostUnavailableError, self.breaker.before_call)
+        with mock.patch('croupier_plugin.ssh.time.time', return_value=CircuitBreaker.PROBE_TIMEOUT):
+            self.breaker.before_call()
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+
+class TestAsyncSshClient(unittest.TestCase):
+    """ Holds the asyncio SSH client tests """
+
+    def setUp(self):
+        patcher = mock.patch('croupier_plugin.ssh.SshClient', FakeSshClient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(SshConnectionPool().close_all)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(asyncio.set_event_loop, None)
+
+    def test_concurrent_commands(self):
+        """ Commands to several hosts run at the same time """
+        hosts = ['hpc{0}.example.com'.format(index) for index in range(4)]
+        barrier = threading.Barrier(len(hosts), timeout=5)
+
+        def execute_shell_command(ssh_client, cmd, workdir=None, env=None, wait_result=False):
+            barrier.wait()  # only passes if every command is running
+            return ssh_client.credentials['host'] + ': ' + cmd, 0
+
+        with mock.patch.object(FakeSshClient, 'execute_shell_command', execute_shell_command):
+            results = self.loop.run_until_complete(asyncio.gather(*[
+                AsyncSshClient(dict(CREDENTIALS, host=host)).execute_shell_command(
+                    'hostname', wait_result=True) for host in hosts]))
+        self.assertEqual(results, [(host + ': hostname', 0) for host in hosts])
+
+    def test_connection_returned_to_pool(self):
+        """ The pooled connection is reused by the next call """
+        ssh_client = AsyncSshClient(CREDENTIALS)
+        self.loop.run_until_complete(ssh_client.execute_shell_command('true'))
+        first = SshConnectionPool().checkout(CREDENTIALS)
+        SshConnectionPool().checkin(first)
+        self.loop.run_until_complete(ssh_client.run(lambda client: self.assertIs(client, first)))
+
+
+def _private_key_text(key, password=None):
+    key_file = io.StringIO()
+    key.write_private_key(key_file, password=password)
+    return key_file.getvalue()
+
+
+class TestKeyCache(unittest.TestCase):
+    """ Holds the private key and known_hosts cache tests """
+
+    def setUp(self):
+        self.addCleanup(ssh._private_keys.clear)
+
+    def test_key_types(self):
+        """ RSA, ECDSA and OpenSSH Ed25519 keys are loaded """
+        ed25519_text = ed25519.Ed25519PrivateKey.generate().private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH,
+            serialization.BestAvailableEncryption(b'secret')).decode('ascii')
+        for key_text, key_class in ((_private_key_text(RSAKey.generate(1024), 'secret'), RSAKey),
+                                    (_private_key_text(ECDSAKey.generate(), 'secret'), ECDSAKey),
+                                    (ed25519_text, Ed25519Key)):
+            self.assertIsInstance(ssh._load_private_key(key_text, 'secret'), key_class)
+
+    def test_keys_are_cached(self):
+        """ The same key and password are only parsed once """
+        key_text = _private_key_text(ECDSAKey.generate(), 'secret')
+        with mock.patch.object(ECDSAKey, 'from_private_key', wraps=ECDSAKey.from_private_key) as parse:
+            first = ssh._load_private_key(key_text, 'secret')
+            self.assertIs(ssh._load_private_key(key_text.encode('utf-8'), 'secret'), first)
+            self.assertEqual(parse.call_count, 1)
+            self.assertRaises(Exception, ssh._load_private_key, key_text, 'wrong')
+            self.assertEqual(parse.call_count, 2)
+
+    def test_unsupported_key(self):
+        """ Unknown key formats raise an SSHException """
+        self.assertRaises(ssh.SSHException, ssh._load_private_key, 'not a key')
+
+    def test_known_hosts_reloaded_on_change(self):
+        """ known_hosts is parsed again only when it changes """
+        host_key = ECDSAKey.generate()
+        with tempfile.NamedTemporaryFile('w', suffix='known_hosts', delete=False) as known_hosts:
+            known_hosts.write('hpc.example.com {0} {1}\n'.format(host_key.get_name(), host_key.get_base64()))
+        self.addCleanup(os.remove, known_hosts.name)
+        self.addCleanup(ssh._known_hosts.pop, known_hosts.name, None)
+
+        first = ssh.SSHClient()
+        ssh._load_host_keys(first, known_hosts.name)
+        with mock.patch('croupier_plugin.ssh.HostKeys') as host_keys:
+            ssh._load_host_keys(ssh.SSHClient(), known_hosts.name)
+            host_keys.assert_not_called()
+        self.assertIn('hpc.example.com', first.get_host_keys())
+
+        with open(known_hosts.name, 'a') as known_hosts_file:
+            known_hosts_file.write('login.example.com {0} {1}\n'.format(host_key.get_name(), host_key.get_base64()))
+        second = ssh.SSHClient()
+        ssh._load_host_keys(second, known_hosts.name)
+        self.assertIn('login.example.com', second.get_host_keys())
+        self.assertNotIn('login.example.com', first.get_host_keys())
+
+
+class TestSshForward(unittest.TestCase):
+    """ Holds the shared tunnels tests """
+
+    def setUp(self):
+        patcher = mock.patch('croupier_plugin.ssh.SshClient', FakeSshClient)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.credentials = dict(CREDENTIALS, host='compute.example.com', tunnel=CREDENTIALS)
+
+    def test_tunnel_is_shared(self):
+        """ Connections to the same target share the jump connection """
+        first = SshForward.acquire(self.credentials)
+        second = SshForward.acquire(dict(self.credentials))
+        other = SshForward.acquire(dict(self.credentials, host='other.example.com'))
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+        other.release()
+
+        first.release()
+        self.assertFalse(first._client.closed)
+        second.release()
+        self.assertTrue(first._client.closed)
+
+    def test_dead_tunnel_is_replaced(self):
+        """ A broken jump connection is not handed out again """
+        first = SshForward.acquire(self.credentials)
+        first._client.transport.active = False
+        second = SshForward.acquire(self.credentials)
+        self.assertIsNot(first, second)
+        first.release()
+        self.assertTrue(first._client.closed)
+        self.assertFalse(second._client.closed)
+        second.release()
+
+
+class TestSshBatch(unittest.TestCase):
+    """ Holds the batched execution tests """
+
+    @staticmethod
+    def _run_batch(commands, stop_on_error=False):
+        """ Runs the batch against a local shell instead of a remote one """
+        def execute_shell_command(call, workdir=None, env=None, wait_result=False):
+            process = subprocess.run(['bash', '-c', call], stdout=subprocess.PIPE)
+            return process.stdout.decode('utf-8'), process.returncode
+
+        ssh_client = SshClient.__new__(SshClient)
+        ssh_client.execute_shell_command = execute_shell_command
+        return ssh_client.execute_batch(commands, stop_on_error=stop_on_error)
+
+    def test_batch_results(self):
+        """ Every command gets its own output and exit code """
+        results = self._run_batch(['echo first', 'echo second >&2; exit 3', 'true'])
+        self.assertEqual(results, [('first\n', 0), ('second\n', 3), ('', 0)])
+
+    def test_batch_stop_on_error(self):
+        """ Commands after a failure are not executed """
+        results = self._run_batch(['echo first', 'false', 'echo third'], stop_on_error=True)
+        self.assertEqual(results, [('first\n', 0), ('', 1), (None, None)])
+
+
+class LocalSftp(object):
+    """ SFTP session on a local directory, used as the home directory """
+
+    def __init__(self, home, posix_rename=True):
+        self.home = home
+        if not posix_rename:
+            self.posix_rename = self._unsupported
+
+    def normalize(self, path):
+        return self.home
+
+    def putfo(self, fl, remotepath, file_size=0, callback=None, confirm=True):
+        with open(remotepath, 'wb') as remote_file:
+            remote_file.write(fl.read())
+
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+
+    def posix_rename(self, oldpath, newpath):
+        os.replace(oldpath, newpath)
+
+    def rename(self, oldpath, newpath):
+        if os.path.exists(newpath):
+            raise IOError("Failure")
+        os.rename(oldpath, newpath)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _unsupported(oldpath, newpath):
+        raise IOError("Operation unsupported")
+
+
+class TestSshUpload(unittest.TestCase):
+    """ Holds the SFTP upload tests """
+
+    def setUp(self):
+        home = tempfile.TemporaryDirectory()
+        self.addCleanup(home.cleanup)
+        self.home = home.name
+        os.mkdir(os.path.join(self.home, 'workdir'))
+        with open(os.path.join(self.home, 'workdir', 'job.script'), 'w') as script:
+            script.write('old content\n')
+
+    def _upload(self, files, posix_rename=True):
+        ssh_client = SshClient.__new__(SshClient)
+        ssh_client._host = 'hpc.example.com'
+        ssh_client._sftp = LocalSftp(self.home, posix_rename)
+        ssh_client._remote_paths = {}
+        ssh_client.upload_files(files, workdir='$HOME/workdir')
+
+    def _assert_uploaded(self):
+        workdir = os.path.join(self.home, 'workdir')
+        self.assertEqual(sorted(os.listdir(workdir)), ['job.script', 'run.sh'])
+        with open(os.path.join(workdir, 'job.script')) as script:
+            self.assertEqual(script.read(), '#!/bin/bash\necho "$HOME `date`"\n')
+        self.assertEqual(os.stat(os.path.join(workdir, 'run.sh')).st_mode & 0o777, 0o755)
+
+    def test_upload_replaces_scripts(self):
+        """ Scripts are written verbatim, replacing the existing ones """
+        self._upload([('job.script', '#!/bin/bash\necho "$HOME `date`"\n'), ('run.sh', b'#!/bin/sh\n')])
+        self._assert_uploaded()
+
+    def test_upload_without_posix_rename(self):
+        """ Servers without atomic rename still get the files replaced """
+        self._upload([('job.script', '#!/bin/bash\necho "$HOME `date`"\n'), ('run.sh', b'#!/bin/sh\n')],
+                     posix_rename=False)
+        self._assert_uploaded()
+
+
+class ScriptedChannel(object):
+    """ Channel that replays a fixed output """
+
+    def __init__(self, stdout=(), stderr=(), exit_status=0, finished=True):
+        self.stdout = list(stdout)
+        self.stderr = list(stderr)
+        self.exit_status = exit_status
+        self.finished = finished
+        self.closed = False
+
+    def recv_ready(self):
+        return bool(self.stdout)
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv(self, size):
+        return self.stdout.pop(0)
+
+    def recv_stderr(self, size):
+        return self.stderr.pop(0)
+
+    def exit_status_ready(self):
+        return self.closed or (self.finished and not self.stdout and not self.stderr)
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def close(self):
+        self.closed = True
+
+
+class TestCommandStream(unittest.TestCase):
+    """ Holds the streamed output tests """
+
+    def test_lines_across_chunks(self):
+        """ Lines and multi-byte characters split between chunks """
+        euro = u'\u20ac'.encode('utf-8')
+        channel = ScriptedChannel(stdout=[b'first li', b'ne\nsec' + euro[:1], euro[1:] + b'ond\nlast'],
+                                  stderr=[b'warning\n'], exit_status=2)
+        with CommandStream(channel) as stream:
+            self.assertEqual(list(stream), ['first line', u'sec\u20acond', 'last'])
+            self.assertEqual(stream.stderr, 'warning\n')
+            self.assertEqual(stream.exit_code, 2)
+        self.assertTrue(channel.closed)
+
+    def test_stderr_spills_to_file(self):
+        """ stderr beyond the spool size is kept in a file """
+        channel = ScriptedChannel(stderr=[b'x' * 100, b'y' * 100])
+        stream = CommandStream(channel, spool_size=150)
+        self.assertEqual(list(stream.chunks()), [])
+        self.assertTrue(stream._stderr._rolled)
+        self.assertEqual(stream.stderr, 'x' * 100 + 'y' * 100)
+
+    def test_timeout_cancels_command(self):
+        """ The channel is closed when the command runs for too long """
+        channel = ScriptedChannel(stdout=[b'partial\n'], finished=False)
+        with mock.patch('croupier_plugin.ssh.select.select'):
+            stream = CommandStream(channel, timeout=0.01, poll_interval=0.01)
+            lines = stream.lines()
+            self.assertEqual(next(lines), 'partial')
+            with mock.patch('croupier_plugin.ssh.time.time', return_value=stream._deadline):
+                self.assertRaises(socket.timeout, next, lines)
+        self.assertTrue(channel.closed)
+
+    def test_from_output(self):
+        """ Output read at once is streamed as well """
+        stream = CommandStream.from_output('a\nb\n', 0)
+        self.assertEqual(list(stream), ['a', 'b'])
+        self.assertEqual(stream.exit_code, 0)
+
+    def test_command_not_waited_for(self):
+        """ The output of a command sent without waiting is drained, then its channel closed """
+        channel = ScriptedChannel(stdout=[b'x' * 32768, b'y' * 32768], stderr=[b'warning\n'])
+        ssh_client = SshClient.__new__(SshClient)
+        ssh_client._client = mock.Mock()
+        ssh_client._persistent_shell = False
+        ssh_client._exec_command = mock.Mock(return_value=channel)
+        self.assertTrue(ssh_client.send_command('sleep 1 &'))
+        deadline = time.time() + 5
+        while not channel.closed and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(channel.closed)
+        self.assertEqual((channel.stdout, channel.stderr), ([], []))
+
+
+class LocalChannel(object):
+    """ Channel that runs the exec request in a local process """
+
+    def __init__(self):
+        self.process = None
+        self.closed = False
+
+    def set_combine_stderr(self, combine):
+        pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def exec_command(self, command):
+        self.process = subprocess.Popen(command.split(), stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def exit_status_ready(self):
+        return self.process.poll() is not None
+
+    def sendall(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def recv(self, size):
+        return self.process.stdout.read1(size)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.process.kill()
+            self.process.wait()
+            self.process.stdin.close()
+            self.process.stdout.close()
+
+
+class LocalTransport(object):
+    def open_session(self):
+        return LocalChannel()
+
+
+class TestShellSession(unittest.TestCase):
+    """ Holds the persistent login shell tests """
+
+    def setUp(self):
+        self.session = ShellSession(LocalTransport(), shell='bash --noprofile')
+        self.addCleanup(self.session.close)
+
+    def test_run_commands(self):
+        """ Output and exit code of consecutive commands in the same shell """
+        self.assertEqual(self.session.run('echo out; echo err >&2'), ('out\nerr\n', 0))
+        self.assertEqual(self.session.run('printf partial; exit 4'), ('partial', 4))
+        self.assertEqual(self.session.run("echo 'multi\nline'"), ('multi\nline\n', 0))
+
+    def test_commands_do_not_leak(self):
+        """ cd and export only affect their own command """
+        self.session.run('cd /tmp && export CROUPIER_TEST=1')
+        output, _ = self.session.run('pwd; echo "${CROUPIER_TEST:-unset}"')
+        self.assertNotEqual(output.split()[0], '/tmp')
+        self.assertEqual(output.split()[1], 'unset')
+
+    def test_recovers_from_dead_shell(self):
+        """ A new shell is started when the previous one died """
+        self.session.run('true')
+        self.session._channel.close()
+        self.assertEqual(self.session.run('echo again'), ('again\n', 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
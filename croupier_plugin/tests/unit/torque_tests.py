@@ -30,9 +30,13 @@ from builtins import object
 import unittest
 
 import logging
+import mock
 from croupier_plugin.utilities import shlex_quote
+from croupier_plugin.infrastructure_interfaces import infrastructure_interface
 from croupier_plugin.infrastructure_interfaces.infrastructure_interface import (
     InfrastructureInterface)
+from croupier_plugin.infrastructure_interfaces.torque import Torque
+from croupier_plugin.ssh import CommandStream
 
 
 class TestTorque(unittest.TestCase):
@@ -240,5 +244,94 @@ class TestTorque(unittest.TestCase):
         self.assertEqual(len(names), len(set(names)))
 
 
+RUNNING_JOB = """Job Id: 1.server
+    Job_Name = job1
+    job_state = R
+"""
+
+COMPLETED_JOB = """Job Id: 2.server
+    Job_Name = job2
+    Job_Owner = croupier@server
+    job_state = C
+    queue = batch
+    qtime = Tue Sep 22 13:20:00 2020
+    start_time = Tue Sep 22 13:25:00 2020
+    comp_time = Tue Sep 22 13:29:49 2020
+    resources_used.cput = 00:04:00
+    resources_used.mem = 1024kb
+    resources_used.vmem = 2048kb
+    resources_used.walltime = 00:04:49
+    submit_args = -l walltime=00:10:00 job2.script
+    exit_status = 0
+"""
+
+
+class FakeTorqueClient(object):
+    """ Answers qselect and qstat calls from a table of jobs """
+
+    def __init__(self, jobs, names):
+        self.jobs = jobs
+        self.names = names
+        self.calls = []
+
+    def stream_shell_command(self, cmd, workdir=None, env=None, timeout=None):
+        self.calls.append(cmd)
+        if 'qselect' in cmd:
+            return CommandStream.from_output(''.join(self.names[name] + '\n' for name in self.names
+                                                     if name in cmd), 0)
+        # qstat takes ids with or without the server name
+        jobs = {job_id.split('.')[0]: job for job_id, job in self.jobs.items()}
+        ids = [job_id.split('.')[0] for job_id in cmd.split('qstat -f ')[1].split()]
+        return CommandStream.from_output(''.join(jobs[job_id] for job_id in ids if job_id in jobs),
+                                         0 if all(job_id in jobs for job_id in ids) else 153)
+
+
+class TestTorqueJobIds(unittest.TestCase):
+    """ Holds the monitoring by job id tests """
+
+    CREDENTIALS = {'host': 'hpc.example.com', 'user': 'croupier'}
+
+    def setUp(self):
+        infrastructure_interface._finished_jobs.clear()
+        self.addCleanup(infrastructure_interface._finished_jobs.clear)
+        self.wm = Torque('TORQUE', logging.getLogger('TestTorque'), 'workdir')
+
+    def _get_states(self, client, job_names, job_ids):
+        with mock.patch('croupier_plugin.infrastructure_interfaces.torque.SshConnectionPool') as pool:
+            pool.return_value.connection.return_value.__enter__.return_value = client
+            return self.wm.get_states(self.CREDENTIALS, job_names, job_ids=job_ids)
+
+    def test_single_qstat(self):
+        """ Jobs with id are queried in a single qstat, finished ones are cached """
+        client = FakeTorqueClient({'1.server': RUNNING_JOB, '2.server': COMPLETED_JOB}, {})
+        job_ids = {'job1': '1.server', 'job2': '2.server'}
+
+        states, audits = self._get_states(client, ['job1', 'job2'], job_ids)
+        self.assertDictEqual(states, {'job1': 'RUNNING', 'job2': 'COMPLETED'})
+        self.assertEqual(audits['job2']['job_id'], '2.server')
+        self.assertEqual(client.calls, ['qstat -f 1.server 2.server'])
+
+        client.calls = []
+        states, audits = self._get_states(client, ['job1', 'job2'], job_ids)
+        self.assertDictEqual(states, {'job1': 'RUNNING', 'job2': 'COMPLETED'})
+        self.assertEqual(audits['job2']['job_id'], '2.server')
+        self.assertEqual(client.calls, ['qstat -f 1.server'])
+
+    def test_jobs_without_id(self):
+        """ Only jobs without id are looked up with qselect """
+        client = FakeTorqueClient({'1.server': RUNNING_JOB, '2.server': COMPLETED_JOB}, {'job2': '2.server'})
+
+        states, _ = self._get_states(client, ['job1', 'job2'], {'job1': '1.server'})
+        self.assertDictEqual(states, {'job1': 'RUNNING', 'job2': 'COMPLETED'})
+        self.assertEqual(client.calls, ["echo job2 | xargs -n 1 qselect -N", 'qstat -f 1.server 2'])
+
+    def test_purged_job(self):
+        """ Jobs unknown to the server do not hide the state of the rest """
+        client = FakeTorqueClient({'1.server': RUNNING_JOB}, {})
+
+        states, _ = self._get_states(client, ['job1', 'job3'], {'job1': '1.server', 'job3': '3.server'})
+        self.assertDictEqual(states, {'job1': 'RUNNING'})
+
+
 if __name__ == '__main__':
     unittest.main()
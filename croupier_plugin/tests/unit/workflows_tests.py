@@ -0,0 +1,469 @@
+"""
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+workflows_tests.py: Holds the workflow unit tests
+"""
+
+import logging
+import threading
+import time
+import unittest
+
+import mock
+
+from croupier_plugin.ssh import CircuitBreaker, HostUnavailableError
+from croupier_plugin.workflows import Launcher, Monitor, build_graph, pack_instances
+
+
+class FakeResult(object):
+    """ Task result set later, by another thread """
+
+    def __init__(self):
+        self._callbacks = []
+        self.done = False
+
+    def on_result(self, f, *a):
+        self._callbacks.append((f, a))
+
+    def set(self, value):
+        if not self.done:
+            self.done = True
+            for f, a in self._callbacks:
+                f(value, *a)
+
+
+class FakeJobInstance(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.result = None
+        self.state = 'WAITING'
+        self.queued = False
+        self.group_members = []
+
+    def launch(self, callback=None):
+        self.result = FakeResult()
+        return self.result
+
+    def launched(self, result):
+        self.state = 'PENDING'
+        self.queued = True
+
+
+class FakeTask(object):
+
+    def get_state(self):
+        return 'succeeded'
+
+
+class FakeOperationResult(object):
+    """ Result of an operation already executed """
+    task = FakeTask()
+
+    def get(self):
+        return None
+
+    def on_result(self, f, *a):
+        pass
+
+
+class FakeQueueResult(FakeOperationResult):
+    """ Result of a job queued """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def get(self):
+        return self.job_id
+
+
+class FakeFailedQueueResult(FakeOperationResult):
+    """ Result of a job that could not be queued """
+
+    def get(self):
+        raise RuntimeError('sbatch: error: invalid partition')
+
+
+class FakeRequester(object):
+    """ Job requester that does not get any state """
+
+    def __init__(self, errors):
+        self.errors = errors
+
+    def request(self, monitor_jobs, monitor_start_time, logger):
+        return {}, {}, dict(self.errors)
+
+    def get_latency(self, host):
+        return None
+
+
+class FakeCfyInstance(object):
+
+    def __init__(self, instance_id):
+        self.id = instance_id
+        self.runtime_properties = {
+            'timezone': 'Europe/Madrid',
+            'credentials': {'host': 'hpc'},
+            'workdir': '/home/croupier',
+            'infrastructure_interface': 'SLURM',
+            'monitoring_options': {},
+            'job_prefix': 'cfy_',
+        }
+        self._node_instance = self
+        self.operations = []
+
+    def send_event(self, event):
+        pass
+
+    def execute_operation(self, operation, kwargs=None):
+        self.operations.append((operation, kwargs))
+        return FakeOperationResult()
+
+
+class FakeRelationship(object):
+
+    def __init__(self, target_node):
+        self.target_node = target_node
+
+
+class FakeCfyNode(object):
+
+    def __init__(self, node_id, instances, parents=()):
+        self.id = node_id
+        self.type = 'croupier.nodes.Job'
+        self.type_hierarchy = ['cloudify.nodes.Root', 'croupier.nodes.Job']
+        self.properties = {'job_options': {}}
+        self.instances = [FakeCfyInstance(node_id + '_' + str(index)) for index in range(instances)]
+        self._parents = parents
+
+    @property
+    def relationships(self):
+        return iter([FakeRelationship(parent) for parent in self._parents])
+
+
+class TestLauncher(unittest.TestCase):
+    """ Holds the concurrent job launching tests """
+
+    def test_max_parallel(self):
+        """ At most max_parallel instances are launched at the same time """
+        instances = [FakeJobInstance('job' + str(index)) for index in range(5)]
+        launcher = Launcher(max_parallel=2)
+        for instance in instances:
+            launcher.add(instance)
+
+        launcher.update()
+        self.assertEqual([instance.result is not None for instance in instances], [True, True, False, False, False])
+        self.assertTrue(launcher.is_launching())
+
+        instances[1].result.set('1')
+        launcher.update()
+        self.assertEqual([instance.state for instance in instances[:2]], ['WAITING', 'PENDING'])
+        self.assertIsNotNone(instances[2].result)
+        self.assertIsNone(instances[3].result)
+
+        while launcher.is_launching():
+            for instance in instances:
+                if instance.result is not None:
+                    instance.result.set('0')
+            launcher.update()
+        self.assertEqual([instance.state for instance in instances], ['PENDING'] * 5)
+        self.assertFalse(launcher.is_launching())
+
+    def test_wait(self):
+        """ Waiting returns as soon as a launch ends """
+        instance = FakeJobInstance('job')
+        launcher = Launcher()
+        launcher.add(instance)
+        launcher.update()
+
+        timer = threading.Timer(0.1, instance.result.set, ['0'])
+        timer.start()
+        self.addCleanup(timer.cancel)
+        event = threading.Event()
+        waiter = threading.Thread(target=lambda: (launcher.wait(10), event.set()))
+        waiter.start()
+        self.assertTrue(event.wait(5))
+        launcher.update()
+        self.assertEqual(instance.state, 'PENDING')
+
+
+class TestGraph(unittest.TestCase):
+    """ Holds the workflow graph state tests """
+
+    def setUp(self):
+        self.first = FakeCfyNode('first', 3)
+        self.second = FakeCfyNode('second', 2)
+        self.last = FakeCfyNode('last', 1, parents=[self.first, self.second])
+        self.root_nodes, self.job_instances_map = build_graph([self.first, self.second, self.last])
+        self.monitor = Monitor(self.job_instances_map, logging.getLogger('test'))
+        for node in self.root_nodes:
+            self.monitor.add_node(node)
+
+    def test_node_completes_with_its_instances(self):
+        """ A node completes when its last instance does, once """
+        first = self.root_nodes[0]
+        instances = first.instances
+        instances[0].set_status('COMPLETED')
+        instances[1].set_status('COMPLETED')
+        instances[1].set_status('COMPLETED')
+        self.assertEqual(first.completed_instances, 2)
+        self.assertFalse(first.completed)
+        self.assertEqual(self.monitor.pop_finished_nodes(), [])
+
+        instances[2].set_status('RUNNING')
+        instances[2].set_status('COMPLETED')
+        self.assertTrue(first.completed)
+        self.assertEqual(self.monitor.pop_finished_nodes(), [first])
+        self.assertEqual(self.monitor.pop_finished_nodes(), [])
+        self.assertEqual(first.get_children_ready(), [])
+
+        for instance in self.root_nodes[1].instances:
+            instance.set_status('COMPLETED')
+        self.assertEqual(self.monitor.pop_finished_nodes(), [self.root_nodes[1]])
+        self.assertEqual([node.name for node in self.root_nodes[1].get_children_ready()], ['last'])
+
+    def test_node_fails_with_an_instance(self):
+        """ A node fails as soon as one of its instances does """
+        first = self.root_nodes[0]
+        first.instances[0].set_status('COMPLETED')
+        first.instances[1].set_status('TIMEOUT')
+        self.assertTrue(first.failed)
+        self.assertEqual(first.failed_instances, 1)
+        self.assertEqual(self.monitor.pop_finished_nodes(), [first])
+
+        first.instances[2].set_status('COMPLETED')
+        self.assertEqual(self.monitor.pop_finished_nodes(), [])
+        self.assertEqual(first.children[0].parent_dependencies_left, 2)
+
+    def test_only_queued_instances_are_polled(self):
+        """ The monitor only keeps the instances queued and not ended """
+        instances = self.root_nodes[0].instances
+        self.monitor.watch(instances[0])
+        instances[1].set_status('COMPLETED')
+        self.monitor.watch(instances[1])
+        self.assertEqual(list(self.monitor._executing), [instances[0].name])
+
+    def test_notification_before_watch(self):
+        """ A job that notifies its end before it is watched is not polled """
+        listener = mock.Mock()
+        listener.pop_notifications.return_value = {'cfy_first_0': ('COMPLETED', {'exit_status': '0'})}
+        monitor = Monitor(self.job_instances_map, logging.getLogger('test'), listener=listener)
+        monitor.update_status()
+
+        instance = self.root_nodes[0].instances[0]
+        instance.launched(FakeQueueResult('1'))
+        monitor.watch(instance)
+        self.assertEqual(instance._status, 'COMPLETED')
+        self.assertEqual(instance.audit, {'exit_status': '0'})
+        self.assertEqual(monitor._executing, {})
+
+    def test_skipped_host_keeps_backoff(self):
+        """ Jobs of a host whose circuit is open wait for it, without backing off """
+        breaker = CircuitBreaker.for_host('hpc')
+        self.addCleanup(CircuitBreaker._breakers.pop, 'hpc', None)
+        requester = FakeRequester({'hpc': HostUnavailableError('down')})
+        monitor = Monitor(self.job_instances_map, logging.getLogger('test'), jobs_requester=requester)
+        instance = self.root_nodes[0].instances[0]
+        instance.launched(FakeQueueResult('1'))
+        monitor.watch(instance)
+        monitor.scheduler.next_interval(instance.name, 'PENDING', 1)
+        breaker.retry_at = time.time() + 60
+        monitor.scheduler.schedule(instance.name, 0)
+
+        with mock.patch('croupier_plugin.workflows.time.sleep'):
+            monitor.update_status()
+        self.assertEqual(monitor.scheduler._waiting_polls[instance.name], 1)
+        self.assertEqual(monitor.scheduler.next_deadline(), breaker.retry_at)
+
+        requester.errors = {}  # throttled
+        monitor.scheduler.schedule(instance.name, 0)
+        with mock.patch('croupier_plugin.workflows.time.sleep'):
+            monitor.update_status()
+        self.assertEqual(monitor.scheduler._waiting_polls[instance.name], 1)
+
+        requester.errors = {'hpc': None}
+        monitor.scheduler.schedule(instance.name, 0)
+        with mock.patch('croupier_plugin.workflows.time.sleep'):
+            monitor.update_status()
+        self.assertEqual(monitor.scheduler._waiting_polls[instance.name], 2)
+
+
+class TestSchedulerChained(unittest.TestCase):
+    """ Holds the chaining of jobs in the infrastructure queue tests """
+
+    def _build(self, last_host='hpc'):
+        self.first = FakeCfyNode('first', 3)
+        self.second = FakeCfyNode('second', 2)
+        self.last = FakeCfyNode('last', 1, parents=[self.first, self.second])
+        self.last.instances[0].runtime_properties['credentials'] = {'host': last_host}
+        root_nodes, job_instances_map = build_graph([self.first, self.second, self.last])
+        monitor = Monitor(job_instances_map, logging.getLogger('test'))
+        for node in root_nodes:
+            monitor.add_node(node)
+        for node in root_nodes:
+            for index, instance in enumerate(node.instances):
+                instance.launched(FakeQueueResult(node.name + str(index)))
+        return root_nodes, monitor
+
+    def test_children_chained_when_parents_queued(self):
+        """ A child is chained once all the instances of its parents are queued """
+        (first, second), monitor = self._build()
+        self.assertEqual(monitor.pop_queued_nodes(), [second])
+        last = second.get_children_chained()[0]
+        self.assertEqual(last.name, 'last')
+        self.assertEqual(last.get_dependencies(), ['first0', 'first1', 'first2', 'second0', 'second1'])
+
+        first.instances[0].set_status('COMPLETED')
+        self.assertEqual(last.get_dependencies(), ['first1', 'first2', 'second0', 'second1'])
+
+    def test_other_host_not_chained(self):
+        """ Jobs of different hosts can not depend on each other """
+        _, monitor = self._build(last_host='other')
+        self.assertEqual(monitor.pop_queued_nodes(), [])
+
+
+class TestJobArrays(unittest.TestCase):
+    """ Holds the job arrays tests """
+
+    def _launch(self, cfy_node, job_arrays=True):
+        root_nodes, job_instances_map = build_graph([cfy_node])
+        node = root_nodes[0]
+        launcher = Launcher()
+        monitor = Monitor(job_instances_map, logging.getLogger('test'), launcher=launcher)
+        monitor.add_node(node)
+        node.launch_all_instances(launcher, callback={'url': 'http://orchestrator'}, job_arrays=job_arrays)
+        launcher.update()
+        return node, launcher, monitor
+
+    def test_instances_sent_as_array(self):
+        """ The instances of a node are sent in an array, and monitored by task """
+        cfy_node = FakeCfyNode('job', 3)
+        node, launcher, monitor = self._launch(cfy_node)
+        self.assertEqual(cfy_node.instances[0].operations,
+                         [('croupier.interfaces.lifecycle.queue', {'name': 'cfy_job_0', 'array_size': 3})])
+        self.assertEqual([cfy_instance.operations for cfy_instance in cfy_node.instances[1:]], [[], []])
+
+        leader = node.instances[0]
+        launcher._on_result(None, leader, FakeQueueResult(['7_0', '7_1', '7_2']))
+        launcher.update()
+        self.assertEqual([instance.job_id for instance in node.instances], ['7_0', '7_1', '7_2'])
+        self.assertEqual([instance._status for instance in node.instances], ['PENDING'] * 3)
+        self.assertEqual(sorted(monitor._executing), ['cfy_job_0', 'cfy_job_1', 'cfy_job_2'])
+
+        node.cancel_all_instances()
+        self.assertEqual([len(cfy_instance.operations) for cfy_instance in cfy_node.instances], [3, 0, 0])
+
+    def test_queue_failed(self):
+        """ A job, or array, that could not be queued fails instead of breaking the loop """
+        cfy_node = FakeCfyNode('job', 1)
+        node, launcher, monitor = self._launch(cfy_node)
+        launcher._on_result(None, node.instances[0], FakeFailedQueueResult())
+        launcher.update()
+        self.assertEqual(node.instances[0]._status, 'FAILED')
+        self.assertIsNone(node.instances[0].job_id)
+        self.assertEqual(monitor._executing, {})
+
+        cfy_node = FakeCfyNode('job', 3)
+        node, launcher, monitor = self._launch(cfy_node)
+        launcher._on_result(None, node.instances[0], FakeFailedQueueResult())
+        launcher.update()
+        self.assertEqual([instance._status for instance in node.instances], ['FAILED'] * 3)
+        self.assertEqual(monitor._executing, {})
+
+    def test_not_array(self):
+        """ Instances of different hosts, or already scaled, are sent one by one """
+        cfy_node = FakeCfyNode('job', 2)
+        cfy_node.instances[1].runtime_properties['credentials'] = {'host': 'other'}
+        self._launch(cfy_node)
+        self.assertEqual([len(cfy_instance.operations) for cfy_instance in cfy_node.instances], [1, 1])
+
+        cfy_node = FakeCfyNode('job', 2)
+        cfy_node.properties = {'job_options': {'scale': 4}}
+        self._launch(cfy_node)
+        self.assertEqual([len(cfy_instance.operations) for cfy_instance in cfy_node.instances], [1, 1])
+
+
+class TestPacks(unittest.TestCase):
+    """ Holds the tests of the jobs packed in a batch job """
+
+    def test_instances_packed(self):
+        """ The jobs that start together in the same partition are sent in a pack """
+        first = FakeCfyNode('first', 2)
+        second = FakeCfyNode('second', 1)
+        other = FakeCfyNode('other', 1)
+        for cfy_node, partition in ((first, 'short'), (second, 'short'), (other, 'long')):
+            cfy_node.properties = {'job_options': {'commands': ['true'], 'pack': True, 'partition': partition}}
+        root_nodes, job_instances_map = build_graph([first, second, other])
+        launcher = Launcher()
+        monitor = Monitor(job_instances_map, logging.getLogger('test'), launcher=launcher)
+        pack_instances(root_nodes)
+        for node in root_nodes:
+            monitor.add_node(node)
+            node.launch_all_instances(launcher)
+        launcher.update()
+
+        self.assertEqual([len(cfy_instance.operations) for cfy_instance in first.instances + second.instances],
+                         [1, 0, 0])
+        _, kwargs = first.instances[0].operations[0]
+        self.assertEqual(kwargs['name'], 'cfy_first_0_pack')
+        self.assertEqual([job['name'] for job in kwargs['packed_jobs']], ['cfy_first_0', 'cfy_first_1', 'cfy_second_0'])
+        self.assertEqual(other.instances[0].operations,
+                         [('croupier.interfaces.lifecycle.queue', {'name': 'cfy_other_0'})])
+
+        leader = root_nodes[0].instances[0]
+        launcher._on_result(None, leader, FakeQueueResult('9'))
+        launcher.update()
+        self.assertEqual(monitor._executing['cfy_second_0'].job_id, '9')
+        self.assertEqual(root_nodes[1].instances[0].pack_name, 'cfy_first_0_pack')
+
+    def test_different_resources_not_packed(self):
+        """ Only the jobs that ask for the same resources share a batch job """
+        small = FakeCfyNode('small', 1)
+        big = FakeCfyNode('big', 1)
+        hungry = FakeCfyNode('hungry', 1)
+        small_too = FakeCfyNode('small_too', 1)
+        for cfy_node, tasks, memory in ((small, 1, '1G'), (big, 16, '1G'), (hungry, 1, '64G'), (small_too, 1, '1G')):
+            cfy_node.properties = {'job_options': {'commands': ['true'], 'pack': True, 'tasks': tasks,
+                                                   'memory': memory}}
+        root_nodes, _ = build_graph([small, big, hungry, small_too])
+        pack_instances(root_nodes)
+
+        self.assertEqual([node.instances[0].pack_name for node in root_nodes],
+                         ['cfy_small_0_pack', None, None, 'cfy_small_0_pack'])
+
+    def test_pack_queue_failed(self):
+        """ All the jobs of a pack that could not be queued fail """
+        first = FakeCfyNode('first', 2)
+        first.properties = {'job_options': {'commands': ['true'], 'pack': True}}
+        root_nodes, job_instances_map = build_graph([first])
+        launcher = Launcher()
+        monitor = Monitor(job_instances_map, logging.getLogger('test'), launcher=launcher)
+        pack_instances(root_nodes)
+        monitor.add_node(root_nodes[0])
+        root_nodes[0].launch_all_instances(launcher)
+        launcher.update()
+
+        launcher._on_result(None, root_nodes[0].instances[0], FakeFailedQueueResult())
+        launcher.update()
+        self.assertEqual([instance._status for instance in root_nodes[0].instances], ['FAILED'] * 2)
+        self.assertEqual(monitor._executing, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
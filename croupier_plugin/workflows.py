@@ -34,93 +34,171 @@ from builtins import str
 from builtins import object
 import sys
 import time
+from collections import OrderedDict, deque
 from datetime import datetime
+from queue import Empty, Queue
 
 from cloudify.decorators import workflow
 from cloudify.workflows import ctx, api, tasks
 from cloudify.plugins.workflows import install
+from croupier_plugin import metrics
+from croupier_plugin.callback_listener import CallbackListener
 from croupier_plugin.job_requester import JobRequester
+from croupier_plugin.monitoring_service import MonitoringServiceClient
+from croupier_plugin.poll_scheduler import PollScheduler, max_time_to_seconds
+from croupier_plugin.ssh import CircuitBreaker, HostUnavailableError
 import croupier_plugin.data_management.data_management as dm
 from croupier_plugin.vault.vault import revoke_token
 
-LOOP_PERIOD = 1
+# Longest sleep of the monitor loop, so cancel requests are noticed
+MAX_LOOP_SLEEP = 10
+# Job instances being sent to their infrastructure queue at the same time
+MAX_PARALLEL_LAUNCHES = 16
+
+
+# States in which a job has failed
+FAILED_STATES = ('BOOT_FAIL', 'CANCELLED', 'FAILED', 'REVOKED', 'TIMEOUT')
+# Infrastructures that can hold a job until others end successfully
+CHAINED_INTERFACES = ('SLURM', 'TORQUE', 'PBSPRO')
+# Infrastructures whose job arrays are monitored task by task
+ARRAY_INTERFACES = ('SLURM', 'PBSPRO')
+# Infrastructures that can run several jobs in a single batch job, and
+# the most jobs packed in one
+PACKED_INTERFACES = ('SLURM', 'TORQUE', 'PBSPRO')
+MAX_PACKED_JOBS = 64
+# job options a batch job is allocated with, the same in all the jobs of a pack
+PACK_RESOURCE_OPTIONS = ('partition', 'queue', 'reservation', 'account', 'qos', 'nodes', 'tasks', 'tasks_per_node',
+                         'mpiprocs', 'memory', 'select', 'node_type')
 
 
 class GraphInstance(object):
+    """ Node instance of the graph. Only keeps what the workflow needs of
+    it, as there can be thousands """
+    __slots__ = ('_status', 'name', 'instance', 'node', 'completed', 'failed', 'audit', 'simulate')
 
-    def __init__(self, parent, instance, root_nodes):
+    def __init__(self, parent, instance, root_nodes=None):
         self._status = 'NONE'
         self.name = instance.id
-        self.monitor_url = ""
         self.instance = instance
         self.node = parent
         self.completed = True
         self.failed = False
         self.audit = {}
-        self.runtime_properties = instance._node_instance.runtime_properties
-        self.root_nodes = root_nodes
-        self.simulate = self.runtime_properties["simulate"] if 'simulate' in self.runtime_properties else False
+        self.simulate = instance._node_instance.runtime_properties.get("simulate", False)
 
     def launch(self):
         pass
 
     def set_status(self, status):
-        """ Update the instance state """
+        """ Update the instance state, and its node counters if it finishes """
         if not status == self._status:
             self._status = status
             self.instance.send_event('State changed to ' + self._status)
 
+            was_completed, was_failed = self.completed, self.failed
             self.completed = self._status == 'COMPLETED'
-
-            self.failed = (self._status == 'BOOT_FAIL' or
-                           self._status == 'CANCELLED' or
-                           self._status == 'FAILED' or
-                           self._status == 'REVOKED' or
-                           self._status == 'TIMEOUT')
-
-    def update_properties(self):
-        self.runtime_properties = self.instance._node_instance.runtime_properties
+            self.failed = self._status in FAILED_STATES
+            if self.completed != was_completed or self.failed != was_failed:
+                self.node.instance_status_changed(self, was_completed, was_failed)
 
 
 class JobGraphInstance(GraphInstance):
     """ Wrap to add job functionalities to node instances """
+    __slots__ = ('timezone', 'host', 'workdir', 'monitor_type', 'monitor_config', 'monitor_period', 'reservation',
+                 'max_time', 'running_since', 'notifies', 'job_id', 'queued', 'group_leader',
+                 'group_members', 'pack_name')
 
-    def __init__(self, parent, instance, root_nodes):
+    def __init__(self, parent, instance, root_nodes=None):
 
         super().__init__(parent, instance, root_nodes)
-        self.instance = instance
         self._status = 'WAITING'
         self.completed = False
-        self.timezone = self.runtime_properties["timezone"]
-        self.host = self.runtime_properties["credentials"]["host"]
-        self.workdir = self.runtime_properties["workdir"]
-        self.monitor_type = self.runtime_properties["infrastructure_interface"]
-        self.monitor_config = self.runtime_properties["credentials"]
-
-        monitoring_options = self.runtime_properties["monitoring_options"]
+        runtime_properties = instance._node_instance.runtime_properties
+        self.timezone = runtime_properties["timezone"]
+        self.host = runtime_properties["credentials"]["host"]
+        self.workdir = runtime_properties["workdir"]
+        self.monitor_type = runtime_properties["infrastructure_interface"]
+        self.monitor_config = runtime_properties["credentials"]
+
+        monitoring_options = runtime_properties["monitoring_options"]
         self.monitor_period = int(monitoring_options["monitor_period"]) if "monitor_period" in monitoring_options \
             else 10
         self.reservation = self.node.cfy_node.properties["job_options"]["reservation"] \
             if "reservation" in self.node.cfy_node.properties["job_options"] else ""
-        self.name = self.runtime_properties["job_prefix"] + self.instance.id
-
-    def launch(self):
-        """ Sends the job's instance to the infrastructure queue """
+        self.max_time = max_time_to_seconds(self.node.cfy_node.properties["job_options"]["max_time"]) \
+            if "max_time" in self.node.cfy_node.properties["job_options"] else None
+        self.running_since = None
+        # True if the job notifies its end, see CallbackListener
+        self.notifies = False
+        self.name = runtime_properties["job_prefix"] + self.instance.id
+        self.job_id = runtime_properties.get("job_id")
+        # True once the job is in the infrastructure queue
+        self.queued = False
+        # instances sent in the same job array or pack as this one, if it
+        # sends them, or the instance that sends the array or pack it is in
+        self.group_members = []
+        self.group_leader = None
+        # name of the batch job that runs this job with others, see pack_instances
+        self.pack_name = None
+
+    def launch(self, callback=None):
+        """ Sends the job's instance to the infrastructure queue, without
+        waiting for it. Call launched with the result once it is set """
         self.instance.send_event('Queuing job..')
-        result = self.instance.execute_operation(
-            'croupier.interfaces.lifecycle.queue', kwargs={"name": self.name})
-        result.get()
-        if result.task.get_state() == tasks.TASK_FAILED:
+        kwargs = {"name": self.name}
+        # user provided scripts can not notify their end, nor array tasks
+        # (all of them would notify the array name) or packed jobs
+        job_options = self.node.cfy_node.properties["job_options"]
+        if callback and 'local_script' not in job_options and 'remote_script' not in job_options and \
+                not self.group_members and not self.pack_name:
+            kwargs["callback"] = callback
+        if self.pack_name:
+            kwargs["name"] = self.pack_name
+            kwargs["packed_jobs"] = [{"name": job_instance.name,
+                               "job_options": job_instance.node.cfy_node.properties["job_options"]}
+                              for job_instance in [self] + self.group_members]
+        elif self.group_members:
+            kwargs["array_size"] = len(self.group_members) + 1
+        self.notifies = "callback" in kwargs
+        # held by the infrastructure until the parent jobs end, if chained
+        dependencies = self.node.get_dependencies()
+        if dependencies:
+            kwargs["dependencies"] = dependencies
+        return self.instance.execute_operation(
+            'croupier.interfaces.lifecycle.queue', kwargs=kwargs)
+
+    def launched(self, result):
+        """ Updates the instance state with the result of its launch """
+        job_id = None
+        try:
+            job_id = result.get()
+            failed = result.task.get_state() == tasks.TASK_FAILED
+        except api.ExecutionCancelled:
+            raise
+        except Exception as exp:
+            self.instance.send_event('.. job could not be queued: ' + str(exp))
+            failed = True
+        # an array returns the id of every task, a pack its batch job id
+        job_ids = job_id if self.group_members and not self.pack_name and not failed \
+            else [job_id] * (len(self.group_members) + 1)
+        for job_instance, instance_job_id in zip([self] + self.group_members, job_ids):
+            job_instance.set_queued(instance_job_id, failed)
+
+    def set_queued(self, job_id, failed):
+        """ Updates the instance state with the job id it was queued with """
+        if failed:
             init_state = 'FAILED'
         else:
+            self.job_id = job_id
+            self.queued = True
             self.instance.send_event('.. job queued')
             init_state = 'PENDING'
         self.set_status(init_state)
-        return result
+        if self.queued:
+            self.node.instance_queued()
 
     def delete_reservation(self):
         """ Sends the job's instance to the infrastructure queue """
-        self.update_properties()
         self.instance.send_event('Deleting reservation...')
         result = self.instance.execute_operation('croupier.interfaces.lifecycle.delete_reservation',
                                                  kwargs={"name": self.name})
@@ -142,13 +220,23 @@ class JobGraphInstance(GraphInstance):
         """ Update the instance state """
 
         before = self.completed
+        if status == 'RUNNING' and self._status != 'RUNNING':
+            self.running_since = time.time()
         super().set_status(status)
 
         if self.completed and not before:
             self.publish()
 
+    def remaining_time(self):
+        """ Seconds until the job reaches its time limit, None if unknown """
+        if self.max_time is None or self.running_since is None:
+            return None
+        return self.max_time - (time.time() - self.running_since)
+
     def clean(self):
         """ Cleans job's aux files """
+        if self.group_leader is not None and not self.pack_name:  # the files are the array ones
+            return None
 
         self.instance.send_event('Cleaning job..')
         result = self.instance.execute_operation('croupier.interfaces.lifecycle.cleanup',
@@ -160,12 +248,16 @@ class JobGraphInstance(GraphInstance):
 
     def cancel(self):
         """ Cancels the job instance in the infrastructure """
+        if self.group_leader is not None:  # cancelled with the array or pack
+            self._status = 'CANCELLED'
+            return
+
         # First perform clean operation
         self.clean()
 
         self.instance.send_event('Cancelling job..')
         result = self.instance.execute_operation('croupier.interfaces.lifecycle.cancel',
-                                                 kwargs={"name": self.name})
+                                                 kwargs={"name": self.pack_name or self.name})
         self.instance.send_event('.. job canceled')
         result.get()
 
@@ -185,6 +277,12 @@ class GraphNode(object):
         self.parents = []
         self.children = []
         self.parent_dependencies_left = 0
+        self.children_ready = []
+        # parents whose instances are not all queued yet, and the children
+        # that can be chained to the parents in the infrastructure queue
+        self.parent_queues_left = 0
+        self.children_chained = []
+        self.started = False
         if self.is_job:
             self.status = 'WAITING'
         else:
@@ -199,25 +297,118 @@ class GraphNode(object):
                 graph_instance = GraphInstance(self, instance, root_nodes)
 
             self.instances.append(graph_instance)
+        # kept as the instances change state, so the node status is known
+        # without looking at all of them
+        self.completed_instances = sum(1 for instance in self.instances if instance.completed)
+        self.failed_instances = 0
+        self.queued_instances = 0
+        # called with the node when it completes or fails, and when all its
+        # instances are queued if it has children to chain, see Monitor
+        self.on_finished = None
+        self.on_queued = None
 
     def add_parent(self, node):
         """ Adds a parent node """
         self.parents.append(node)
         self.parent_dependencies_left += 1
+        if node.is_job:
+            self.parent_queues_left += 1
 
     def add_child(self, node):
         """ Adds a child node """
         self.children.append(node)
 
-    def launch_all_instances(self):
-        """ Launches all job instances """
-        jobs_result_list = []
+    def launch_all_instances(self, launcher, callback=None, job_arrays=False):
+        """ Launches all job instances, as a single job array if job_arrays
+        and they can be (see can_be_array). Packed instances are launched
+        by the first instance of their pack """
         if self.is_job:
+            if job_arrays and not any(job_instance.pack_name for job_instance in self.instances) and \
+                    self.can_be_array():
+                leader = self.instances[0]
+                leader.group_members = self.instances[1:]
+                for job_instance in leader.group_members:
+                    job_instance.group_leader = leader
             for job_instance in self.instances:
-                jobs_result_list.append(job_instance.launch())
+                if job_instance.group_leader is None:
+                    launcher.add(job_instance, callback)
             self.status = 'QUEUED'
 
-        return jobs_result_list
+    def can_be_array(self):
+        """
+        True if the node instances can be sent as the tasks of a job array:
+        there are several, with the same job options, host and working
+        directory in an infrastructure that monitors array tasks, that are
+        not simulated, not an array already and without data transfers
+        (done by instance)
+        """
+        if not self.is_job or len(self.instances) < 2:
+            return False
+        job_options = self.cfy_node.properties["job_options"]
+        if 'scale' in job_options and int(job_options['scale']) > 1:
+            return False
+        if any(dm.isDataManagementRelationship(relationship) for relationship in self.cfy_node.relationships):
+            return False
+        first = self.instances[0]
+        return all(instance.monitor_type in ARRAY_INTERFACES and
+                   instance.host == first.host and
+                   instance.workdir == first.workdir and
+                   not instance.simulate for instance in self.instances)
+
+    def can_be_chained(self):
+        """
+        True if the node jobs can be held in the infrastructure queue until
+        the parent jobs end: all of them are real jobs of the same host,
+        whose infrastructure supports dependencies between jobs. The rest of
+        parents (e.g. the infrastructure interface) must have completed
+        """
+        job_parents = [parent for parent in self.parents if parent.is_job]
+        if not self.is_job or not job_parents or \
+                not all(parent.completed for parent in self.parents if not parent.is_job):
+            return False
+        instances = [instance for node in [self] + job_parents for instance in node.instances]
+        return all(instance.monitor_type in CHAINED_INTERFACES and
+                   instance.host == instances[0].host and
+                   not instance.simulate for instance in instances)
+
+    def can_be_packed(self):
+        """
+        True if the node jobs ask to be packed with others (pack job
+        option), are built from commands, not simulated, not in a container,
+        an array or chained, and without data transfers (done by instance)
+        """
+        job_options = self.cfy_node.properties["job_options"]
+        if not self.is_job or not job_options.get('pack') or not job_options.get('commands') or \
+                'croupier.nodes.SingularityJob' in self.cfy_node.type_hierarchy:
+            return False
+        if 'scale' in job_options and int(job_options['scale']) > 1:
+            return False
+        if any(dm.isDataManagementRelationship(relationship) for relationship in self.cfy_node.relationships):
+            return False
+        return not self.get_dependencies() and \
+            all(instance.monitor_type in PACKED_INTERFACES and not instance.simulate for instance in self.instances)
+
+    def get_dependencies(self):
+        """ Job ids of the parent instances that have not completed yet """
+        dependencies = OrderedDict()  # packed instances share the id
+        for parent in self.parents:
+            if not parent.completed:
+                for instance in parent.instances:
+                    if not instance.completed:
+                        dependencies[instance.job_id] = None
+        return list(dependencies)
+
+    def instance_queued(self):
+        """ Counts the instances in the infrastructure queue. Once all are,
+        notifies on_queued if some children can be chained to them """
+        self.queued_instances += 1
+        if self.queued_instances == len(self.instances):
+            for child in self.children:
+                child.parent_queues_left -= 1
+                if child.parent_queues_left == 0 and child.can_be_chained():
+                    self.children_chained.append(child)
+            if self.children_chained and self.on_queued is not None:
+                self.on_queued(self)
 
     def is_ready(self):
         """ True if it has no more dependencies to satisfy """
@@ -227,6 +418,18 @@ class GraphNode(object):
         """ Removes a dependency of the Node already satisfied """
         for child in self.children:
             child.parent_dependencies_left -= 1
+            if child.is_ready():
+                self.children_ready.append(child)
+
+    def instance_status_changed(self, instance, was_completed, was_failed):
+        """ Updates the instance counters when an instance completes or
+        fails, and notifies on_finished if the whole node finished """
+        self.completed_instances += int(instance.completed) - int(was_completed)
+        self.failed_instances += int(instance.failed) - int(was_failed)
+        if not self.completed and not self.failed:
+            self.check_status()
+            if (self.completed or self.failed) and self.on_finished is not None:
+                self.on_finished(self)
 
     def check_status(self):
         """
@@ -236,41 +439,29 @@ class GraphNode(object):
         Returns True if there is no errors (no job has failed)
         """
         if not self.completed and not self.failed:
-            if not self.is_job:
-                self._remove_children_dependency()
+            if self.failed_instances > 0:
+                self.status = 'FAILED'
+                self.failed = True
+                self.completed = False
+                return False
+
+            if not self.is_job or self.completed_instances == len(self.instances):
+                # The node just finished, remove this dependency
                 self.status = 'COMPLETED'
+                self._remove_children_dependency()
                 self.completed = True
-            else:
-                completed = True
-                failed = False
-                for instance in self.instances:
-                    if instance.failed:
-                        failed = True
-                        break
-                    elif not instance.completed:
-                        completed = False
-
-                if failed:
-                    self.status = 'FAILED'
-                    self.failed = True
-                    self.completed = False
-                    return False
-
-                if completed:
-                    # The job node just finished, remove this dependency
-                    self.status = 'COMPLETED'
-                    self._remove_children_dependency()
-                    self.completed = True
 
         return not self.failed
 
     def get_children_ready(self):
-        """ Gets all children nodes that are ready to start """
-        ready = []
-        for child in self.children:
-            if child.is_ready():
-                ready.append(child)
-        return ready
+        """ Gets the children nodes that this node completion made ready to
+        start, so every node is only started by its last parent to finish """
+        return self.children_ready
+
+    def get_children_chained(self):
+        """ Gets the children nodes that can start in the infrastructure
+        queue, held until this node and the rest of their parents end """
+        return self.children_chained
 
     def __str__(self):
         to_print = self.name + '\n'
@@ -300,75 +491,243 @@ class GraphNode(object):
         self.status = 'CANCELLED'
 
 
+class Launcher(object):
+    """
+    Sends job instances to their infrastructure queue concurrently, at most
+    max_parallel at the same time, and updates the state of every instance
+    as the result of its launch arrives
+    """
+
+    def __init__(self, max_parallel=MAX_PARALLEL_LAUNCHES, on_launched=None):
+        self.max_parallel = max(int(max_parallel), 1)
+        # called with every instance queued
+        self.on_launched = on_launched
+        self._waiting = deque()
+        self._launching = 0
+        # (instance, result) of the launches ended, set by the task threads
+        self._ended = Queue()
+
+    def add(self, job_instance, callback=None):
+        """ Queues the launch of a job instance """
+        self._waiting.append((job_instance, callback))
+
+    def update(self):
+        """ Applies the results of the launches ended and starts new ones """
+        while True:
+            try:
+                job_instance, result = self._ended.get_nowait()
+            except Empty:
+                break
+            self._launching -= 1
+            job_instance.launched(result)
+            if self.on_launched is not None:
+                # the instances sent in the same job array are queued as well
+                for launched_instance in [job_instance] + job_instance.group_members:
+                    if launched_instance.queued:
+                        self.on_launched(launched_instance)
+
+        while self._waiting and self._launching < self.max_parallel:
+            job_instance, callback = self._waiting.popleft()
+            result = job_instance.launch(callback)
+            self._launching += 1
+            result.on_result(self._on_result, job_instance, result)
+
+    def is_launching(self):
+        return bool(self._waiting) or self._launching > 0
+
+    def wait(self, timeout):
+        """ Sleeps until a launch ends or timeout seconds pass """
+        try:
+            self._ended.put(self._ended.get(timeout=timeout))
+        except Empty:
+            pass
+
+    def _on_result(self, _, job_instance, result):
+        self._ended.put((job_instance, result))
+
+
 class Monitor(object):
-    """Monitor the instances"""
+    """
+    Monitor the instances
 
+    Only the instances that change state are visited: the executing ones
+    are kept apart (see watch), polled when their poll is due, and the nodes
+    that complete or fail are queued (see pop_finished_nodes).
+    """
+
+    # consecutive failed queries allowed per host
     MAX_ERRORS = 5
 
-    def __init__(self, job_instances_map, logger):
+    def __init__(self, job_instances_map, logger, listener=None, jobs_requester=None, launcher=None):
         self._execution_pool = {}
+        # job instances in the infrastructure queue, by name
+        self._executing = {}
+        # nodes that completed or failed, not processed yet
+        self._finished_nodes = deque()
+        # nodes queued with children to chain, not processed yet
+        self._queued_nodes = deque()
+        # (state, audit) notified by jobs not watched yet, by name
+        self._early_notifications = {}
+        self.listener = listener
+        self.launcher = launcher
         self.timestamp = 0
         self.job_instances_map = job_instances_map
         self.logger = logger
-        self.jobs_requester = JobRequester()
-        self.continued_errors = 0
+        # JobRequester, or the client of a shared MonitoringService
+        self.jobs_requester = jobs_requester or JobRequester()
+        self.host_errors = {}
+        self.scheduler = PollScheduler()
         self.monitor_start_time = datetime.now()
+        if launcher is not None:
+            launcher.on_launched = self.watch
+
+    def watch(self, job_instance):
+        """ Starts monitoring a job instance just queued """
+        if job_instance.simulate:
+            job_instance.set_status('COMPLETED')
+        elif job_instance.name in self._early_notifications:  # a short job that ended before
+            self._notified(job_instance, *self._early_notifications.pop(job_instance.name))
+        if job_instance.completed or job_instance.failed:  # its state will not change
+            return
+        self._executing[job_instance.name] = job_instance
+        self.scheduler.schedule(job_instance.name, time.time())  # not polled yet
 
     def update_status(self):
-        """Gets all executing instances and update their state"""
+        """Updates the state of the executing instances whose poll is due,
+        then sleeps until the next poll deadline"""
+        changed = []
+
+        # jobs that notified their end do not need to be polled
+        if self.listener is not None:
+            for inst_name, (state, audit) in self.listener.pop_notifications().items():
+                if inst_name in self._executing:
+                    self._notified(self._executing[inst_name], state, audit)
+                    changed.append(inst_name)
+                elif inst_name in self.job_instances_map:  # its launch has not been processed yet
+                    self._early_notifications[inst_name] = (state, audit)
 
         # first get the instances we need to check
         monitor_jobs = {}
-        for _, job_node in self.get_executions_iterator():
-            if job_node.is_job:
-                for job_instance in job_node.instances:
-                    if not job_instance.simulate:
-                        if job_instance.host in monitor_jobs:
-                            monitor_jobs[job_instance.host]['names'].append(
-                                job_instance.name)
-                        else:
-                            monitor_jobs[job_instance.host] = {
-                                'config': job_instance.monitor_config,
-                                'type': job_instance.monitor_type,
-                                'workdir': job_instance.workdir,
-                                'names': [job_instance.name],
-                                'period': job_instance.monitor_period,
-                                'timezone': job_instance.timezone
-                            }
-                    else:
-                        job_instance.set_status('COMPLETED')
-
-        # nothing to do if we don't have nothing to monitor
-        if not monitor_jobs:
-            return
-
-        # then look for the status of the instances through its name
-        try:
-            states, audits = self.jobs_requester.request(monitor_jobs, self.monitor_start_time, self.logger)
+        for name in self.scheduler.pop_due(time.time()):
+            job_instance = self._executing.get(name)
+            if job_instance is None:  # no longer executing
+                self.scheduler.remove(name)
+                continue
+            if job_instance.host in monitor_jobs:
+                monitor_jobs[job_instance.host]['names'].append(
+                    job_instance.name)
+            else:
+                monitor_jobs[job_instance.host] = {
+                    'config': job_instance.monitor_config,
+                    'type': job_instance.monitor_type,
+                    'workdir': job_instance.workdir,
+                    'names': [job_instance.name],
+                    'ids': {},
+                    # job name -> name of the batch job that runs it
+                    'packs': {},
+                    # the poll scheduler paces the queries
+                    'period': PollScheduler.MIN_INTERVAL,
+                    'timezone': job_instance.timezone
+                }
+            if job_instance.job_id:
+                monitor_jobs[job_instance.host]['ids'][job_instance.name] = job_instance.job_id
+            if job_instance.pack_name:
+                monitor_jobs[job_instance.host]['packs'][job_instance.name] = job_instance.pack_name
+
+        if monitor_jobs:
+            # then look for the status of the instances through its name
+            states, audits, errors = self.jobs_requester.request(monitor_jobs, self.monitor_start_time, self.logger)
 
             # set job audit
             for inst_name, audit in audits.items():
-                self.job_instances_map[inst_name].audit = audit
+                if inst_name in self._executing:
+                    self._executing[inst_name].audit = audit
 
             # finally set job status
             for inst_name, state in states.items():
-                self.job_instances_map[inst_name].set_status(state)
-
-            if self.continued_errors > 0:
-                self.logger.debug("Monitor error count reset to 0. States: " + str(states))
-                self.continued_errors = 0
-        except Exception as exp:
-            if self.continued_errors >= Monitor.MAX_ERRORS:
-                self.logger.error("Error when monitoring jobs: " + str(exp))
-                raise exp
-            else:
-                self.continued_errors += 1
-                count = str(self.continued_errors) + "/" + str(Monitor.MAX_ERRORS)
-                self.logger.warning("Error when monitoring jobs (" + count + "): " + str(exp))
+                if inst_name in self._executing:
+                    self._executing[inst_name].set_status(state)
+
+            for host, error in errors.items():
+                self._update_host_errors(host, error)
+
+            # and schedule their next poll
+            now = time.time()
+            for host, settings in monitor_jobs.items():
+                latency = self.jobs_requester.get_latency(host)
+                retry_at = self._get_skipped_host_retry(host, settings['names'], states, errors, now)
+                for name in settings['names']:
+                    job_instance = self._executing[name]
+                    if job_instance.completed or job_instance.failed:
+                        changed.append(name)
+                        continue
+                    if retry_at is not None:  # not queried, its backoff stays
+                        self.scheduler.schedule(name, retry_at)
+                        continue
+                    period = job_instance.monitor_period
+                    if job_instance.notifies:  # polls only reconcile lost notifications
+                        period = max(period, CallbackListener.RECONCILIATION_PERIOD)
+                    interval = self.scheduler.next_interval(name,
+                                                            job_instance._status,
+                                                            period,
+                                                            latency=latency,
+                                                            remaining_time=job_instance.remaining_time())
+                    self.scheduler.schedule(name, now + interval)
+
+        # the instances that ended are not polled anymore
+        for name in changed:
+            job_instance = self._executing.get(name)
+            if job_instance is not None and (job_instance.completed or job_instance.failed):
+                del self._executing[name]
+                self.scheduler.remove(name)
+
+        launching = self.launcher is not None and self.launcher.is_launching()
+        if not self._executing and not launching or self._finished_nodes or self._queued_nodes:
+            return
 
-        # We wait to slow down the loop
+        # We wait until the next poll is due
         sys.stdout.flush()  # necessary to output work properly with sleep
-        time.sleep(LOOP_PERIOD)
+        next_deadline = self.scheduler.next_deadline()
+        sleep_time = MAX_LOOP_SLEEP if next_deadline is None else \
+            min(max(next_deadline - time.time(), 0), MAX_LOOP_SLEEP)
+        if launching:
+            self.launcher.wait(sleep_time)  # returns as soon as a launch ends
+        elif self.listener is not None:
+            self.listener.wait(sleep_time)  # returns as soon as a job notifies its end
+        else:
+            time.sleep(sleep_time)
+
+    def _notified(self, job_instance, state, audit):
+        self.logger.debug("Job " + job_instance.name + " notified its end: " + state)
+        job_instance.audit = audit
+        job_instance.set_status(state)
+
+    @staticmethod
+    def _get_skipped_host_retry(host, names, states, errors, now):
+        """ When the jobs of a host that was not queried (throttled, or its
+        circuit is open) can be polled again, None if it was queried """
+        if isinstance(errors.get(host), HostUnavailableError):
+            return max(now + PollScheduler.MIN_INTERVAL, CircuitBreaker.for_host(host).retry_at)
+        if host not in errors and not any(name in states for name in names):
+            return now + PollScheduler.MIN_INTERVAL
+        return None
+
+    def _update_host_errors(self, host, error):
+        """ Keeps the error budget of a host, raises the error when spent """
+        if error is None:
+            if self.host_errors.get(host):
+                self.logger.debug("Monitor error count of host " + host + " reset to 0")
+            self.host_errors[host] = 0
+        elif isinstance(error, HostUnavailableError):
+            # the host was not contacted, its circuit breaker is backing off
+            self.logger.debug("Skipping monitoring of host " + host + ": " + str(error))
+        elif self.host_errors.get(host, 0) >= Monitor.MAX_ERRORS:
+            self.logger.error("Error when monitoring jobs on host " + host + ": " + str(error))
+            raise error
+        else:
+            self.host_errors[host] = self.host_errors.get(host, 0) + 1
+            count = str(self.host_errors[host]) + "/" + str(Monitor.MAX_ERRORS)
+            self.logger.warning("Error when monitoring jobs on host " + host + " (" + count + "): " + str(error))
 
     def get_executions_iterator(self):
         """ Executing nodes iterator """
@@ -377,6 +736,23 @@ class Monitor(object):
     def add_node(self, node):
         """ Adds a node to the execution pool """
         self._execution_pool[node.name] = node
+        node.on_finished = self._finished_nodes.append
+        node.on_queued = self._queued_nodes.append
+        if node.check_status() and node.completed or node.failed:  # e.g. not a job
+            self._finished_nodes.append(node)
+
+    def pop_finished_nodes(self):
+        """ Nodes that completed or failed since the last call """
+        finished = list(self._finished_nodes)
+        self._finished_nodes.clear()
+        return finished
+
+    def pop_queued_nodes(self):
+        """ Nodes whose instances got all queued since the last call, and
+        have children to chain """
+        queued = list(self._queued_nodes)
+        self._queued_nodes.clear()
+        return queued
 
     def finish_node(self, node_name):
         """ Delete a node from the execution pool """
@@ -477,47 +853,109 @@ def build_configure_graph(nodes):
     return jobs, interfaces
 
 
-@workflow
-def run_jobs(**kwargs):  # pylint: disable=W0613
-    """ Workflow to execute long running batch operations """
-    success = True
-    root_nodes, job_instances_map = build_graph(ctx.nodes)
-    monitor = Monitor(job_instances_map, ctx.logger)
-
+def pack_instances(nodes):
+    """
+    Packs the instances of the nodes given that can be (see
+    GraphNode.can_be_packed) in groups of the same host, working directory,
+    infrastructure and resources (partition, nodes, tasks, memory...), to
+    run every group in a single batch job, one job after another. The first
+    instance of a group sends it
+    """
+    groups = OrderedDict()
+    for node in nodes:
+        if not node.can_be_packed():
+            continue
+        job_options = node.cfy_node.properties["job_options"]
+        resources = tuple(str(job_options.get(option, '')) for option in PACK_RESOURCE_OPTIONS)
+        for job_instance in node.instances:
+            groups.setdefault((job_instance.host, job_instance.workdir, job_instance.monitor_type, resources),
+                              []).append(job_instance)
+
+    for group in groups.values():
+        for start in range(0, len(group), MAX_PACKED_JOBS):
+            pack = group[start:start + MAX_PACKED_JOBS]
+            if len(pack) < 2:
+                continue
+            leader = pack[0]
+            leader.group_members = pack[1:]
+            for job_instance in pack:
+                job_instance.pack_name = leader.name + '_pack'
+                if job_instance is not leader:
+                    job_instance.group_leader = leader
+
+
+def execute_graph(root_nodes, monitor, launcher, callback=None, scheduler_chained=False, job_arrays=False):
+    """
+    Monitoring and next executions loop: launches the nodes as their
+    parents complete, until all of them complete or the execution is
+    cancelled. Every loop only visits the instances and nodes that changed.
+    Returns False if a node failed (then the executing ones are cancelled)
+
+    If scheduler_chained, the nodes that can be chained (see
+    GraphNode.can_be_chained) are launched as soon as their parents are
+    queued, held by the infrastructure until the parents end successfully.
+    If job_arrays, the instances of a node are sent as a job array when
+    they can be (see GraphNode.can_be_array). The jobs that start together
+    and ask to be packed are run in a single batch job (see pack_instances)
+    """
     new_exec_nodes = root_nodes
-
-    # Monitoring and next executions loop
     while new_exec_nodes or monitor.is_something_executing() and not api.has_cancel_request():
         # perform new executions
-        jobs_result_list = []
+        started_nodes = []
         for new_node in new_exec_nodes:
+            if new_node.started:  # chained before its parents completed
+                continue
+            new_node.started = True
             monitor.add_node(new_node)
+            started_nodes.append(new_node)
+        pack_instances(started_nodes)
+        for new_node in started_nodes:
             if new_node.is_job:
-                jobs_result_list += new_node.launch_all_instances()
+                new_node.launch_all_instances(launcher, callback, job_arrays)
 
-        wait_jobs_to_finish(jobs_result_list)
+        launcher.update()
         # Monitor the infrastructure
         monitor.update_status()
-        exec_nodes_finished = []
         new_exec_nodes = []
-        for node_name, exec_node in monitor.get_executions_iterator():
-            if exec_node.check_status():
-                if exec_node.completed:
-                    exec_node.clean_all_instances()
-                    exec_nodes_finished.append(node_name)
-                    new_nodes_to_execute = exec_node.get_children_ready()
-                    for new_node in new_nodes_to_execute:
-                        new_exec_nodes.append(new_node)
-            else:
+        for exec_node in monitor.pop_queued_nodes():
+            if scheduler_chained:
+                new_exec_nodes += exec_node.get_children_chained()
+        for exec_node in monitor.pop_finished_nodes():
+            if exec_node.failed:
                 # Something went wrong in the node, cancel execution
                 cancel_all(monitor.get_executions_iterator())
-                return
+                return False
+            exec_node.clean_all_instances()
+            monitor.finish_node(exec_node.name)
+            new_exec_nodes += exec_node.get_children_ready()
+    return True
 
-        # remove finished nodes
-        for node_name in exec_nodes_finished:
-            monitor.finish_node(node_name)
 
-        wait_jobs_to_finish(jobs_result_list)
+@workflow
+def run_jobs(max_parallel_launches=MAX_PARALLEL_LAUNCHES, scheduler_chained=False, job_arrays=False,
+             **kwargs):  # pylint: disable=W0613
+    """ Workflow to execute long running batch operations """
+    success = True
+    metrics.export_from_config()
+    root_nodes, job_instances_map = build_graph(ctx.nodes)
+    listener = CallbackListener.from_config()
+    if listener is not None:
+        ctx.logger.info("Listening to job notifications in " + listener.url)
+    jobs_requester = MonitoringServiceClient.from_config()
+    if jobs_requester is not None:
+        ctx.logger.info("Monitoring the jobs through the service in " + jobs_requester.socket_path)
+    launcher = Launcher(max_parallel_launches)
+    monitor = Monitor(job_instances_map, ctx.logger, listener, jobs_requester, launcher)
+    callback = listener.callback() if listener is not None else None
+
+    if not execute_graph(root_nodes, monitor, launcher, callback, scheduler_chained, job_arrays):
+        # Something went wrong in a node, execution cancelled
+        if listener is not None:
+            listener.close()
+        return
+
+    if listener is not None:
+        listener.close()
 
     if monitor.is_something_executing():
         ctx.logger.info("Cancelling jobs...")